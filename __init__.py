@@ -1,10 +1,93 @@
-import tangos as db
-from stitched_reverse_property_cascade import *
-from stitched_merger_finder import *
-from makeHistory import *
-from getSuitableHalos import *
-from makeHistoryCollection import *
-from plotHistoryCollection import *
-from clusterProfiler_powerlaw import *
-from useProximityTable import *
-from plotProximityHistory import *
+"""
+HistoryMaker
+
+Submodules are imported the first time one of their names is used, so that a job that only reads proximity
+tables or history files does not pay for importing tangos, scipy and matplotlib.
+"""
+
+import sys
+import importlib
+from types import ModuleType
+
+#Each submodule and the public names it defines.  These are the names that used to be star-imported here.
+_submoduleNames = {
+	'compiledKernels': ['hasNumba', 'jit', 'flatten', 'stitchOverlappingMaximum', 'retraceProximityLoop', 'interpolateLogTables'],
+	'timestepIndex': ['defaultTolerance', 'TimestepIndex'],
+	'stitched_reverse_property_cascade': ['stitched_reverse_property_cascade', 'batched_reverse_property_cascade'],
+	'stitched_merger_finder': ['stitched_merger_finder', 'historyBranch', 'gatherMergerCandidates', 'findMergers'],
+	'spatialStitching': ['kpcPerGyrPerKms', 'SpatialMatcher'],
+	'mergerTree': ['defaultTreeProperties', 'MergerTree', 'extractMergerTree'],
+	'propertySchema': ['timeExpression', 'getPropertySchema', 'registerProperty', 'selectQuery', 'fullExpressions'],
+	'makeHistory': ['nbins', 'tmax_Gyr', 'bin_index', 'makeHistory', 'queryHistory', 'queryHistories', 'assembleHistory'],
+	'haloSelection': ['atLeast', 'greaterThan', 'lessThan', 'between', 'suitabilityCuts', 'HaloSelector', 'defaultSelector'],
+	'getSuitableHalos': ['getSuitableHalos'],
+	'forwardHistory': ['traceDescendants', 'queryForwardHistories', 'makeForwardHistories'],
+	'makeHistoryCollection': ['createHistoryCollection', 'ClusterEnvironment', 'addClusterEnvironment'],
+	'hostEnvironment': ['HostEnvironment', 'addHostEnvironment', 'HostStream', 'maximumBroadcastSize'],
+	'historyStorage': ['reducedPrecisionKeys', 'isCompact', 'compactHistory', 'expandHistory', 'compactCollection', \
+	'expandCollection', 'ExpandingCollection', 'HistoryCollectionWriter', 'HistoryCollectionReader', 'loadHistoryCollection', \
+	'pyramidFactor', 'pyramidMinimumLength', 'buildPyramids', 'chooseLevel', 'sliceSeries'],
+	'historySharding': ['shardOf', 'shardFileName', 'manifestFileName', 'writeManifest', 'readManifest', 'checkShards', \
+	'mergeTraceabilityReports', 'mergeHistoryShards'],
+	'traceability': ['TRACEABLE', 'PARTIAL', 'UNTRACEABLE', 'probeExpressions', 'checkTraceability'],
+	'costEstimator': ['fixedStages', 'perHaloStages', 'StageCounter', 'estimateCollectionCost', 'printEstimate'],
+	'derivedQuantities': ['derivedQuantities', 'registerDerivedQuantity', 'centredDerivative', 'dependsOn', \
+	'computeDerivedQuantity', 'DerivedHistoryBook'],
+	'historyStatistics': ['HistoryStatistics', 'StreamingHistoryStatistics', 'weightedPercentiles', 'weightedMean', \
+	'bootstrapChunkSize'],
+	'mergerCatalogue': ['mergerDtype', 'buildMergerCatalogue', 'MergerCatalogue'],
+	'encounterFinder': ['encounterDtype', 'gatherTracks', 'findEncounters', 'encountersOf'],
+	'plotHistoryCollection': ['HistoryPlotter'],
+	'clusterProfiler_powerlaw': ['ClusterProfiler', 'fitPowerLaws'],
+	'useProximityTable': ['ProximityCalculator'],
+	'plotProximityHistory': ['ProximityPlotter'],
+	'contactSheet': [],
+	'commandLine': [],
+}
+
+_exports = {}
+for _submodule, _names in _submoduleNames.items():
+	for _name in _names:
+		_exports[_name] = _submodule
+
+class _LazyPackage(ModuleType):
+	"""
+	The package module, which imports a submodule when one of its names is first asked for.
+	"""
+
+	def __getattr__(self, name):
+		if name == 'db':
+			import tangos
+			self.db = tangos
+			return tangos
+		if name in self._exports:
+			self._importSubmodule(self._exports[name])
+		elif name in self._submoduleNames:
+			self._importSubmodule(name)
+		else:
+			raise AttributeError("'{0}' has no attribute '{1}'".format(self.__name__, name))
+		return self.__dict__[name]
+
+	def _importSubmodule(self, submodule):
+		module = self._importlib.import_module('.' + submodule, self.__name__)
+		setattr(self, submodule, module)
+
+		#Importing a submodule, here or from another submodule, binds its module object to the package.  Names
+		#like makeHistory should be the function instead, so rebind the names of every submodule loaded so far.
+		for name, owner in self._exports.items():
+			loaded = self._sys.modules.get(self.__name__ + '.' + owner)
+			if (loaded is not None) and hasattr(loaded, name):
+				setattr(self, name, getattr(loaded, name))
+
+	def __dir__(self):
+		return sorted(set(self.__dict__.keys()) | set(self._exports.keys()) | set(self._submoduleNames.keys()))
+
+_package = _LazyPackage(__name__, __doc__)
+_package.__dict__.update(dict([(key, value) for key, value in globals().items() if key not in ['_package', '_submodule', \
+'_names', '_name']]))
+_package._sys = sys
+_package._importlib = importlib
+_package.__all__ = sorted(_exports.keys()) + ['db']
+#Keep the original module alive.  Python 2 clears the globals of a module when it is garbage collected.
+_package._original = sys.modules[__name__]
+sys.modules[__name__] = _package
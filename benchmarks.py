@@ -0,0 +1,493 @@
+"""
+ARR: 10.19.26
+
+Micro-benchmarks of the numerical kernels, driven by synthetic inputs of realistic sizes.  Each benchmark
+also runs a frozen reference implementation and checks that the kernel still gives the same output, so an
+optimized path cannot silently diverge.  Timings are saved per commit, and a kernel that gets slower than
+the previous commit by more than a threshold is flagged.
+
+	python benchmarks.py
+	python benchmarks.py --only assembleHistory crossmatch --threshold 0.5
+"""
+
+import os
+import sys
+import json
+import timeit
+import argparse
+import subprocess
+import tempfile
+import cPickle as pickle
+import numpy as np
+from util.cache import defaultCacheDirectory
+
+#Kept with the other caches, outside of the repository.
+defaultResultsFile = os.path.join(defaultCacheDirectory, 'benchmarkResults.json')
+
+#(name, function that returns (kernel, reference) or (kernel, reference, normalize)).  The kernel and reference take
+#no arguments.  If given, normalize puts both outputs in a canonical form before they are compared.
+_benchmarks = []
+
+def benchmark(name):
+	"""
+	Register a benchmark.  The decorated function prepares the inputs and returns (kernel, reference), optionally with
+	a normalize function.
+	"""
+
+	def register(setup):
+		_benchmarks.append((name, setup))
+		return setup
+	return register
+
+#Synthetic inputs
+
+def syntheticCascade(nSteps=100, tEnd=13.7, seed=0):
+	"""
+	The raw columns of a cascade along a main branch, as queryHistory returns them.  Histograms cover the whole
+	history up to each step, like the SFR and BH accretion histograms of tangos.
+	"""
+
+	from makeHistory import bin_index
+
+	random = np.random.RandomState(seed)
+	times = np.linspace(tEnd, 0.5, nSteps)
+	rawColumns = {'t()': times.tolist()}
+	rawColumns['raw(SFR_histogram)'] = [random.lognormal(0, 1, bin_index(t))*1e9 for t in times]
+	rawColumns['BH.raw(BH_mdot_histogram)'] = [random.lognormal(-7, 1, bin_index(t)) for t in times]
+	rawColumns['BH.BH_mass'] = (1e8*np.exp(-times[::-1]/5))[::-1].tolist()
+	rawColumns['Mstar'] = (1e10*np.exp(-(tEnd-times)/4)).tolist()
+	rawColumns['shrink_center'] = random.uniform(0, 5e4, (nSteps, 3)).tolist()
+	rawColumns['Vcom'] = random.normal(0, 300, (nSteps, 3)).tolist()
+	return rawColumns
+
+def _syntheticSchema():
+	return {'SFR': (['raw(SFR_histogram)'], 'sfrHistogram', False), 'BHAR': (['raw(BH_mdot_histogram)'], 'bharHistogram', True), \
+	'Mbh': (['BH_mass', 'raw(BH_mdot_histogram)'], 'bhMass', True), 'Mstar': (['Mstar'], 'interpolate', False), \
+	'SSC': (['shrink_center'], 'vector', False), 'Vcom': (['Vcom'], 'vectorZero', False)}
+
+def syntheticClusterProfiles(nSteps=100, nBins=5000, seed=0):
+	"""
+	Gas density profiles of a cluster that declines as a power law with some noise and a few empty bins.
+	"""
+
+	random = np.random.RandomState(seed)
+	times = np.linspace(13.7, 0.5, nSteps)
+	Rvir = np.linspace(1000, 100, nSteps)
+	profiles = []
+	for t_index in range(nSteps):
+		radii = (np.arange(nBins)+0.5)*0.1
+		profile = 1e5 * (radii/10.0)**-2 * random.lognormal(0, 0.1, nBins)
+		profile[random.uniform(size=nBins) < 0.05] = 0
+		profiles.append(profile)
+	return times, profiles, Rvir
+
+def syntheticProximityTable(nSteps=100, nHalos=150, seed=0):
+	"""
+	A proximity table like the ones read by ProximityCalculator.
+	"""
+
+	random = np.random.RandomState(seed)
+	table = {'time': np.linspace(13.7, 0.5, nSteps), 'redshift': np.linspace(0, 8, nSteps)}
+	table['haloNumber'] = [np.arange(1, nHalos+1) for t_index in range(nSteps)]
+	table['Mstar'] = [random.lognormal(20, 2, nHalos) for t_index in range(nSteps)]
+	table['Rvir'] = [random.uniform(10, 500, nHalos) for t_index in range(nSteps)]
+	distanceMatrix = []
+	for t_index in range(nSteps):
+		positions = random.uniform(0, 5e3, (nHalos, 3))
+		distanceMatrix.append(np.sqrt(np.sum((positions[:,np.newaxis,:] - positions[np.newaxis,:,:])**2, axis=2)))
+	table['distanceMatrix'] = distanceMatrix
+	return table
+
+#Reference implementations, frozen as they were when first timed
+
+def _referenceAssembleHistory(rawColumns, schema, keys, bhString):
+	from makeHistory import bin_index, nbins, tmax_Gyr
+
+	time = rawColumns['t()']
+	nTracedBins = bin_index(time[0])
+	tracedTime = time[0] - np.arange(nTracedBins-1,-1,-1)*tmax_Gyr/nbins
+	historyBook = {'time': tracedTime, 't_slice': time}
+	for key in keys:
+		expressions, rule, requiresBH = schema[key]
+		columns = [rawColumns[bhString + '.' + e if requiresBH else e] for e in expressions]
+		if rule == 'sfrHistogram':
+			output = np.zeros(len(tracedTime))
+			for t_i, sfr_i in zip(time, columns[0]):
+				end = bin_index(t_i)
+				start = np.max((end - len(sfr_i), 0))
+				output[start:end] = np.array(sfr_i) / 1e9
+		elif rule == 'bharHistogram':
+			output = np.zeros(len(tracedTime))
+			for t_i, bhar_i in zip(time, columns[0]):
+				end = bin_index(t_i)
+				start = np.max((end - len(bhar_i), 0))
+				output[start:end] = np.maximum(bhar_i[-(end-start):], output[start:end])
+		elif rule == 'bhMass':
+			output = np.zeros(len(tracedTime))
+			for t_i, m_i, bhar_i in zip(time, columns[0], columns[1]):
+				end = bin_index(t_i)
+				start = np.max((end - len(bhar_i), 0))
+				cumulativeBHAR = np.cumsum(bhar_i) * tmax_Gyr * 1e9 / nbins
+				cumulativeBHAR -= cumulativeBHAR[-1]
+				output[start:end] = cumulativeBHAR + m_i
+		elif rule in ['interpolate', 'interpolateInf']:
+			left = np.inf if rule == 'interpolateInf' else 0
+			output = np.interp(tracedTime, np.flipud(time), np.flipud(columns[0]), left=left)
+		elif rule in ['vector', 'vectorZero']:
+			left = 0 if rule == 'vectorZero' else np.inf
+			values = np.array(columns[0])
+			output = np.vstack([np.interp(tracedTime, np.flipud(time), np.flipud(values[:,i]), left=left) for i in range(values.shape[1])])
+		else:
+			output = np.array(columns[0])
+		historyBook[key] = output
+	return historyBook
+
+def _referenceCrossmatch(x, y):
+	positions = dict([(value, index) for index, value in enumerate(y)])
+	idx_x = [index for index, value in enumerate(x) if value in positions]
+	idx_y = [positions[x[index]] for index in idx_x]
+	return np.array(idx_x, dtype=int), np.array(idx_y, dtype=int)
+
+def _referenceGasDensity(times, logTables, distanceInRvir, timeArr):
+	from scipy.interpolate import interp1d
+
+	output = np.zeros(len(distanceInRvir))
+	for d_index in range(len(distanceInRvir)):
+		if timeArr[d_index] < times[-1]:
+			output[d_index] = 0
+		else:
+			logx, logy, innerLogDensity = logTables[np.argmin(np.abs(times-timeArr[d_index]))]
+			interpFunct = interp1d(logx, logy, bounds_error=False, fill_value=(innerLogDensity,-np.inf))
+			output[d_index] = 10**interpFunct(np.log10(distanceInRvir[d_index]))
+	return output
+
+def _referencePowerLawDensity(times, lineSlopes, lineIntercepts, distanceInRvir, timeArr):
+	order = np.argsort(times)
+	slopes = np.interp(timeArr, times[order], lineSlopes[order], left=0, right=0)
+	intercepts = np.interp(timeArr, times[order], lineIntercepts[order], left=0, right=0)
+	return 10**(slopes*np.log10(distanceInRvir) + intercepts)
+
+def _referenceRetrace(table, haloNumbers, times, quantity, mode='threshold', ratioThreshold=0.1):
+	output = np.zeros(len(haloNumbers))
+	for i in range(len(haloNumbers)):
+		t_index = np.argmin(np.abs(table['time'] - times[i]))
+		haloMatch = table['haloNumber'][t_index] == haloNumbers[i]
+		if not any(haloMatch):
+			output[i] = np.nan
+		elif quantity == 'clusterDistance':
+			output[i] = table['distanceMatrix'][t_index][haloMatch,0]
+		elif quantity == 'virialRadius':
+			output[i] = table['Rvir'][t_index][haloMatch]
+		else:
+			mass = table['Mstar'][t_index]
+			relevanceMask = (table['haloNumber'][t_index] != 1) & (table['haloNumber'][t_index] != haloNumbers[i]) & \
+			(mass/mass[haloMatch] >= ratioThreshold)
+			if any(relevanceMask):
+				output[i] = np.min(table['distanceMatrix'][t_index][haloMatch,relevanceMask])
+			else:
+				output[i] = np.inf
+	return output
+
+def _referenceTidalProximity(table, haloNumbers, times):
+	output = np.zeros(len(haloNumbers))
+	for i in range(len(haloNumbers)):
+		t_index = np.argmin(np.abs(table['time'] - times[i]))
+		haloMatch = table['haloNumber'][t_index] == haloNumbers[i]
+		if not any(haloMatch):
+			output[i] = np.nan
+			continue
+		mass = table['Mstar'][t_index]
+		relevanceMask = (table['haloNumber'][t_index] != 1) & (table['haloNumber'][t_index] != haloNumbers[i])
+		if any(relevanceMask):
+			output[i] = np.max(table['Rvir'][t_index][haloMatch] / table['distanceMatrix'][t_index][haloMatch,relevanceMask] * \
+			(mass[relevanceMask] / mass[haloMatch])**(1.0/3.0))
+	return output
+
+def _referenceStitchBHAR(time, nBins, bhar):
+	from makeHistory import bin_index
+
+	output = np.zeros(nBins)
+	for t_i, bhar_i in zip(time, bhar):
+		end = bin_index(t_i)
+		start = np.max((end - len(bhar_i), 0))
+		output[start:end] = np.maximum(bhar_i[-(end-start):], output[start:end])
+	return output
+
+def _sortedPairs(indices):
+	#Matches in order of their position in x
+	idx_x, idx_y = indices
+	order = np.argsort(idx_x, kind='mergesort')
+	return idx_x[order], idx_y[order]
+
+def _referenceSmoothing(values, kernel):
+	values = np.asarray(values, dtype=float)
+	kernel = np.asarray(kernel, dtype=float)
+	halfWidth = len(kernel)//2
+	output = np.zeros(len(values))
+	for i in range(len(values)):
+		for k in range(len(kernel)):
+			j = i + halfWidth - k
+			if (j >= 0) & (j < len(values)):
+				output[i] += values[j] * kernel[k]
+	return output
+
+#Benchmarks
+
+@benchmark('assembleHistory')
+def _assembleHistoryBenchmark():
+	from makeHistory import assembleHistory
+
+	rawColumns = syntheticCascade()
+	schema = _syntheticSchema()
+	keys = sorted(schema.keys())
+	kernel = lambda: assembleHistory(rawColumns, schema, keys, bhString='BH')
+	reference = lambda: _referenceAssembleHistory(rawColumns, schema, keys, 'BH')
+	return kernel, reference
+
+@benchmark('crossmatch')
+def _crossmatchBenchmark():
+	from util.crossmatch import crossmatch
+
+	random = np.random.RandomState(0)
+	x = random.randint(0, 200000, 100000)
+	y = random.permutation(np.arange(0, 300000, 2))[:100000]
+	return lambda: crossmatch(x, y), lambda: _referenceCrossmatch(x, y), _sortedPairs
+
+@benchmark('computeGasDensity')
+def _gasDensityBenchmark():
+	from clusterProfiler import ClusterProfiler
+
+	times, profiles, Rvir = syntheticClusterProfiles()
+	profiler = ClusterProfiler.fromProfiles(times, profiles, Rvir)
+	random = np.random.RandomState(0)
+	distances = random.uniform(0.1, 5, 2000)
+	timeArr = np.linspace(13.7, 0.1, 2000)
+	kernel = lambda: profiler.computeGasDensity(distances, timeArr)
+	reference = lambda: _referenceGasDensity(profiler.times, profiler.logTables, distances, timeArr)
+	return kernel, reference
+
+@benchmark('computeGasDensity_powerlaw')
+def _powerLawDensityBenchmark():
+	from clusterProfiler_powerlaw import ClusterProfiler
+
+	times, profiles, Rvir = syntheticClusterProfiles()
+	profiler = ClusterProfiler.fromProfiles(times, profiles, Rvir)
+	random = np.random.RandomState(0)
+	distances = random.uniform(0.1, 5, 2000)
+	timeArr = np.linspace(13.7, 0.1, 2000)
+	kernel = lambda: profiler.computeGasDensity(distances, timeArr)
+	reference = lambda: _referencePowerLawDensity(profiler.times, profiler.lineSlopes, profiler.lineIntercepts, distances, timeArr)
+	return kernel, reference
+
+def _proximityBenchmark(quantity, mode='threshold'):
+	from useProximityTable import ProximityCalculator
+
+	table = syntheticProximityTable()
+	tableFile = tempfile.NamedTemporaryFile(suffix='.pkl', delete=False)
+	try:
+		pickle.dump(table, tableFile)
+		tableFile.close()
+		calculator = ProximityCalculator(tableFile.name, mode=mode, ratioThreshold=0.1)
+	finally:
+		os.remove(tableFile.name)
+
+	random = np.random.RandomState(0)
+	times = table['time'] + random.uniform(-0.01, 0.01, len(table['time']))
+	haloNumbers = random.randint(1, 200, len(times))
+	functions = {'proximity': calculator.retraceProximity, 'clusterDistance': calculator.retraceClusterDistance, \
+	'virialRadius': calculator.retraceVirialRadius}
+	kernel = lambda: functions[quantity](haloNumbers, times)
+	if mode == 'tidal':
+		reference = lambda: _referenceTidalProximity(table, haloNumbers, times)
+	else:
+		reference = lambda: _referenceRetrace(table, haloNumbers, times, quantity, ratioThreshold=0.1)
+	return kernel, reference
+
+benchmark('retraceProximity')(lambda: _proximityBenchmark('proximity'))
+benchmark('retraceClusterDistance')(lambda: _proximityBenchmark('clusterDistance'))
+benchmark('retraceVirialRadius')(lambda: _proximityBenchmark('virialRadius'))
+benchmark('retraceProximityTidal')(lambda: _proximityBenchmark('proximity', mode='tidal'))
+
+@benchmark('stitchBHAR')
+def _stitchBHARBenchmark():
+	from makeHistory import _stitchBHAR, bin_index
+
+	rawColumns = syntheticCascade()
+	time = rawColumns['t()']
+	bhar = rawColumns['BH.raw(BH_mdot_histogram)']
+	tracedTime = np.zeros(bin_index(time[0]))
+	return lambda: _stitchBHAR(time, tracedTime, bhar), lambda: _referenceStitchBHAR(time, len(tracedTime), bhar)
+
+#The same kernels through compiledKernels, whether or not Numba is there to compile them.
+
+def _usingCompiledKernels(setup):
+	def compiledSetup():
+		functions = setup()
+		def kernel():
+			import compiledKernels
+			previous = compiledKernels.useCompiled
+			compiledKernels.useCompiled = True
+			try:
+				return functions[0]()
+			finally:
+				compiledKernels.useCompiled = previous
+		return (kernel,) + tuple(functions[1:])
+	return compiledSetup
+
+benchmark('computeGasDensity_compiled')(_usingCompiledKernels(_gasDensityBenchmark))
+benchmark('retraceProximity_compiled')(_usingCompiledKernels(lambda: _proximityBenchmark('proximity')))
+benchmark('retraceProximityTidal_compiled')(_usingCompiledKernels(lambda: _proximityBenchmark('proximity', mode='tidal')))
+benchmark('stitchBHAR_compiled')(_usingCompiledKernels(_stitchBHARBenchmark))
+
+@benchmark('smoothing')
+def _smoothingBenchmark():
+	from util.makeGaussianSmoothingKernel import makeGaussianSmoothingKernel
+
+	random = np.random.RandomState(0)
+	values = random.lognormal(0, 1, 2000)
+	smoothingKernel = makeGaussianSmoothingKernel(3)
+	kernel = lambda: np.convolve(values, smoothingKernel, mode='same')
+	reference = lambda: _referenceSmoothing(values, smoothingKernel)
+	return kernel, reference
+
+#Running
+
+def equivalent(output, reference, rtol=1e-9, atol=0):
+	"""
+	Whether two outputs agree, element by element.  Works on arrays and on lists, tuples and dictionaries of them.
+	nan matches nan, and infinities must match exactly.
+	"""
+
+	if isinstance(reference, dict):
+		if (not isinstance(output, dict)) or (sorted(output.keys()) != sorted(reference.keys())):
+			return False
+		return all([equivalent(output[key], reference[key], rtol=rtol, atol=atol) for key in reference.keys()])
+	if isinstance(reference, (tuple, list)) and (len(reference) > 0) and isinstance(reference[0], np.ndarray):
+		if len(output) != len(reference):
+			return False
+		return all([equivalent(o, r, rtol=rtol, atol=atol) for o, r in zip(output, reference)])
+	output = np.asarray(output, dtype=float)
+	reference = np.asarray(reference, dtype=float)
+	if output.shape != reference.shape:
+		return False
+	infinite = np.isinf(reference)
+	if np.any(output[infinite] != reference[infinite]):
+		return False
+	finite = ~infinite
+	return np.allclose(output[finite], reference[finite], rtol=rtol, atol=atol, equal_nan=True)
+
+def timeKernel(kernel, repeat=5, number=None):
+	"""
+	The best and median time per call of a kernel, in seconds.  The number of calls per measurement is chosen so
+	that each takes at least about 0.1 s.
+	"""
+
+	timer = timeit.Timer(kernel)
+	if number is None:
+		number = 1
+		while timer.timeit(number) < 0.1:
+			number *= 2
+			if number > 2**16:
+				break
+	times = np.array(timer.repeat(repeat=repeat, number=number)) / number
+	return {'best': float(np.min(times)), 'median': float(np.median(times)), 'number': number, 'repeat': repeat}
+
+def currentCommit():
+	"""
+	The hash of the checked-out commit, with a suffix if there are uncommitted changes.  'unknown' outside of git.
+	"""
+
+	directory = os.path.dirname(os.path.abspath(__file__))
+	try:
+		commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=directory).strip()
+		changes = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=directory).strip()
+	except (OSError, subprocess.CalledProcessError):
+		return 'unknown'
+	return commit + ('-dirty' if changes else '')
+
+def loadResults(resultsFile=defaultResultsFile):
+	if not os.path.exists(resultsFile):
+		return {'commits': [], 'results': {}}
+	with open(resultsFile, 'r') as myfile:
+		return json.load(myfile)
+
+def saveResults(results, resultsFile=defaultResultsFile):
+	directory = os.path.dirname(resultsFile)
+	if (directory != '') and (not os.path.isdir(directory)):
+		os.makedirs(directory)
+	with open(resultsFile, 'w') as myfile:
+		json.dump(results, myfile, indent=1, sort_keys=True)
+
+def runBenchmarks(names=None, repeat=5, threshold=0.25, resultsFile=defaultResultsFile, save=True, baseline=None):
+	"""
+	Run the benchmarks, check them against their references, and compare timings with an earlier commit.
+
+	:kwarg names - the benchmarks to run.  None runs all of them.
+	:kwarg repeat - the number of timing measurements of each kernel
+	:kwarg threshold - the fractional slowdown of the best time that counts as a regression
+	:kwarg resultsFile - the JSON file of timings per commit
+	:kwarg save - whether to add these timings to resultsFile
+	:kwarg baseline - the commit to compare with.  None means the most recent other commit in resultsFile.
+
+	:returns timings - dictionary of name:  timing
+	:returns failures - list of the names that were not equivalent to their references
+	:returns regressions - list of (name, ratio of best times)
+	"""
+
+	results = loadResults(resultsFile)
+	commit = currentCommit()
+	if baseline is None:
+		earlierCommits = [c for c in results['commits'] if c != commit]
+		baseline = earlierCommits[-1] if len(earlierCommits) > 0 else None
+	baselineTimings = results['results'].get(baseline, {}) if baseline is not None else {}
+
+	timings = {}
+	failures = []
+	regressions = []
+	for name, setup in _benchmarks:
+		if (names is not None) and (name not in names):
+			continue
+		functions = setup()
+		kernel, reference = functions[:2]
+		normalize = functions[2] if len(functions) > 2 else (lambda output: output)
+		if not equivalent(normalize(kernel()), normalize(reference())):
+			failures.append(name)
+		timings[name] = timeKernel(kernel, repeat=repeat)
+		line = "{0:30s} {1:12.3e} s".format(name, timings[name]['best'])
+		if name in baselineTimings:
+			ratio = timings[name]['best'] / baselineTimings[name]['best']
+			line += "   {0:6.2f}x of {1}".format(ratio, baseline)
+			if ratio > 1 + threshold:
+				regressions.append((name, ratio))
+				line += "   REGRESSION"
+		if name in failures:
+			line += "   NOT EQUIVALENT TO REFERENCE"
+		print line
+
+	if save:
+		if commit not in results['commits']:
+			results['commits'].append(commit)
+		results['results'].setdefault(commit, {}).update(timings)
+		saveResults(results, resultsFile)
+	return timings, failures, regressions
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Time the numerical kernels and check them against their references.')
+	parser.add_argument('--only', nargs='+', default=None, choices=[name for name, setup in _benchmarks])
+	parser.add_argument('--repeat', type=int, default=5)
+	parser.add_argument('--threshold', type=float, default=0.25, help='fractional slowdown that counts as a regression')
+	parser.add_argument('--results', default=defaultResultsFile, help='the JSON file of timings per commit')
+	parser.add_argument('--baseline', default=None, help='the commit to compare with')
+	parser.add_argument('--noSave', action='store_true')
+	args = parser.parse_args(argv)
+
+	timings, failures, regressions = runBenchmarks(names=args.only, repeat=args.repeat, threshold=args.threshold, \
+	resultsFile=args.results, save=not args.noSave, baseline=args.baseline)
+	if len(failures) > 0:
+		print "Not equivalent to the reference:  {0}".format(', '.join(failures))
+	if len(regressions) > 0:
+		print "Slower than the baseline by more than {0:.0%}:  {1}".format(args.threshold, ', '.join([name for name, ratio in regressions]))
+	return 1 if (len(failures) > 0) or (len(regressions) > 0) else 0
+
+if __name__ == '__main__':
+	sys.exit(main())
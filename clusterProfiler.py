@@ -1,44 +1,77 @@
-import tangos as db
 import numpy as np
 from scipy.interpolate import interp1d
+from util.cache import cachePath, loadCache, saveCache
+from timestepIndex import TimestepIndex
+import compiledKernels
 
 class ClusterProfiler(object):
 
-	def __init__(self, step):
+	def __init__(self, step, useCache=True, cacheDirectory=None, haloNumber=1):
 		"""
-		Assume that halo 1 in this step is the main cluster.  Then, create an interpolation scheme.
+		Assume that halo 1 in this step is the main cluster, or profile another host with haloNumber.  Then, create an
+		interpolation scheme.
 
 		Not doing a 2d interpolation scheme because the bins are not the same from time step to time step.
+
+		The log-space tables are saved in a cache file for this simulation and step, so only the first profiler of
+		a step needs the database.
+
+		:kwarg useCache - read and write the cache file
+		:kwarg cacheDirectory - where cache files go.  Default is util.cache.defaultCacheDirectory.
+		:kwarg haloNumber - the halo number of the halo to profile
 		"""
 
-		#Obtain data
-		clusterHalo = step.halos[0]
-		times, profiles, Rvir = clusterHalo.reverse_property_cascade('t()', 'gas_density_profile', 'Rvir')
-		logInterpolationFunctions = []
+		stepName = step.extension if haloNumber == 1 else '{0}_halo{1}'.format(step.extension, haloNumber)
+		cacheFile = cachePath('clusterProfile', step.simulation.basename, stepName, cacheDirectory=cacheDirectory)
+		tables = loadCache(cacheFile) if useCache else None
 
-		#At each time step, compute the profile.
-		for t_index in range(len(times)):
-			xvalues = np.arange(len(profiles[t_index]))*0.1 / Rvir[t_index]
+		if tables is None:
+			#Obtain data
+			clusterHalo = step.halos.filter_by(halo_number=haloNumber).one()
+			times, profiles, Rvir = clusterHalo.reverse_property_cascade('t()', 'gas_density_profile', 'Rvir')
+			tables = {'times': np.array(times), 'logTables': makeLogTables(profiles, Rvir)}
+			if useCache:
+				saveCache(cacheFile, tables)
 
-			#Masking zeroes for better interpolation behavior.
-			isZero = profiles[t_index] == 0
-	
-			#Also, let's get rid of kooky behavior within 0.05 Rvir
-			sufficientlyFar = xvalues > 0.05
+		self._setTables(tables['times'], tables['logTables'])
 
-			logInterpolationFunctions.append(interp1d(np.log10(xvalues[(~isZero) & (sufficientlyFar)]), \
-			np.log10(profiles[t_index][(~isZero) & (sufficientlyFar)]), bounds_error=False, \
-			fill_value=(np.log10(profiles[t_index][~isZero][0]),-np.inf)))
+	@classmethod
+	def fromProfiles(cls, times, profiles, Rvir):
+		"""
+		Make a profiler directly from cascaded profiles, without the database.
+		"""
+
+		profiler = cls.__new__(cls)
+		profiler._setTables(np.array(times), makeLogTables(profiles, Rvir))
+		return profiler
+
+	def _setTables(self, times, logTables):
+		logInterpolationFunctions = []
+		for logx, logy, innerLogDensity in logTables:
+			logInterpolationFunctions.append(interp1d(logx, logy, bounds_error=False, fill_value=(innerLogDensity,-np.inf)))
 
 		self.times = times
+		self.timeIndex = TimestepIndex(times)
+		self.logTables = logTables
 		self.logInterpolationFunctions = logInterpolationFunctions
 
+		#The tables flattened for compiledKernels, made when first needed.
+		self._flatLogTables = None
+
+	def _flattenLogTables(self):
+		if self._flatLogTables is None:
+			xValues, offsets = compiledKernels.flatten([logx for logx, logy, innerLogDensity in self.logTables])
+			yValues = compiledKernels.flatten([logy for logx, logy, innerLogDensity in self.logTables])[0]
+			innerLogDensities = np.array([innerLogDensity for logx, logy, innerLogDensity in self.logTables], dtype=float)
+			self._flatLogTables = (xValues, yValues, offsets, innerLogDensities)
+		return self._flatLogTables
+
 	def _selectNearestFunction(self, time):
 		"""
 		Given a time, find the closest one for which we have data and return the function.
 		"""
 
-		return self.logInterpolationFunctions[np.argmin(np.abs(self.times-time))]
+		return self.logInterpolationFunctions[self.timeIndex.nearest(time)]
 
 	def computeGasDensity(self, distanceInRvir, timeArr):
 		"""
@@ -52,11 +85,43 @@ class ClusterProfiler(object):
 		output = np.zeros(len(distanceInRvir))
 
 		#First, find the nearest time and get its interpolation function.
+		nearestIndices = self.timeIndex.nearest(timeArr)
+		if compiledKernels.useCompiled:
+			tableIndices = np.where(np.asarray(timeArr) < self.times[-1], -1, nearestIndices).astype(np.int64)
+			with np.errstate(divide='ignore', invalid='ignore'):
+				logDistances = np.log10(np.asarray(distanceInRvir, dtype=float))
+			return compiledKernels.interpolateLogTables(logDistances, tableIndices, *self._flattenLogTables())
+
 		for d_index in range(len(distanceInRvir)):
 			if timeArr[d_index] < self.times[-1]:
 				output[d_index] = 0
 			else:
-				interpFunct = self._selectNearestFunction(timeArr[d_index])
+				interpFunct = self.logInterpolationFunctions[nearestIndices[d_index]]
 				output[d_index] = 10**interpFunct(np.log10(distanceInRvir[d_index]))
 
 		return output
+
+def makeLogTables(profiles, Rvir):
+	"""
+	The log-space points of the gas density profile of every time step.
+
+	:arg profiles - the gas_density_profile of each time step
+	:arg Rvir - the radius of the cluster at each time step
+
+	:returns logTables - list of (log10 distance in Rvir, log10 density, log10 of the innermost nonzero density)
+	"""
+
+	logTables = []
+	for t_index in range(len(profiles)):
+		profile = np.asarray(profiles[t_index])
+		xvalues = np.arange(len(profile))*0.1 / Rvir[t_index]
+
+		#Masking zeroes for better interpolation behavior.
+		isZero = profile == 0
+
+		#Also, let's get rid of kooky behavior within 0.05 Rvir
+		sufficientlyFar = xvalues > 0.05
+
+		logTables.append((np.log10(xvalues[(~isZero) & (sufficientlyFar)]), np.log10(profile[(~isZero) & (sufficientlyFar)]), \
+		np.log10(profile[~isZero][0])))
+	return logTables
@@ -1,38 +1,51 @@
-import tangos as db
 import numpy as np
 from scipy.interpolate import interp1d
-from scipy.stats import linregress
+from util.cache import cachePath, loadCache, saveCache
 
 class ClusterProfiler(object):
 
-	def __init__(self, step):
+	def __init__(self, step, useCache=True, cacheDirectory=None, haloNumber=1):
 		"""
-		Assume that halo 1 in this step is the main cluster.  Then, create an interpolation scheme.
+		Assume that halo 1 in this step is the main cluster, or profile another host with haloNumber.  Then, create an
+		interpolation scheme.
 
 		Not doing a 2d interpolation scheme because the bins are not the same from time step to time step.
+
+		The fitted slopes and intercepts are saved in a cache file for this simulation and step, so only the first
+		profiler of a step needs the database.
+
+		:kwarg useCache - read and write the cache file
+		:kwarg cacheDirectory - where cache files go.  Default is util.cache.defaultCacheDirectory.
+		:kwarg haloNumber - the halo number of the halo to profile
 		"""
 
-		#Obtain data
-		clusterHalo = step.halos[0]
-		times, profiles, Rvir = clusterHalo.reverse_property_cascade('t()', 'gas_density_profile', 'radius(200)')
-		lineSlopes = []
-		lineIntercepts = []
+		stepName = step.extension if haloNumber == 1 else '{0}_halo{1}'.format(step.extension, haloNumber)
+		cacheFile = cachePath('clusterProfile_powerlaw', step.simulation.basename, stepName, cacheDirectory=cacheDirectory)
+		fit = loadCache(cacheFile) if useCache else None
 
-		#At each time step, compute the profile.
-		for t_index in range(len(times)):
-			xvalues = np.arange(len(profiles[t_index]))*0.1 / Rvir[t_index]
+		if fit is None:
+			#Obtain data
+			clusterHalo = step.halos.filter_by(halo_number=haloNumber).one()
+			times, profiles, Rvir = clusterHalo.reverse_property_cascade('t()', 'gas_density_profile', 'radius(200)')
+			lineSlopes, lineIntercepts = fitPowerLaws(profiles, Rvir)
+			fit = {'times': np.array(times), 'lineSlopes': lineSlopes, 'lineIntercepts': lineIntercepts}
+			if useCache:
+				saveCache(cacheFile, fit)
 
-			#Masking zeroes for better interpolation behavior.
-			isZero = profiles[t_index] == 0
-	
-			#Also, let's get rid of kooky behavior within 0.05 Rvir
-			sufficientlyFar = xvalues > 0.05
+		self._setFit(fit['times'], fit['lineSlopes'], fit['lineIntercepts'])
 
-			#Fit a power law (a line in log space)
-			lineParameters = linregress(np.log10(xvalues[(~isZero) & (sufficientlyFar)]), np.log10(profiles[t_index][(~isZero) & (sufficientlyFar)]))
-			lineSlopes.append(lineParameters[0])
-			lineIntercepts.append(lineParameters[1])
+	@classmethod
+	def fromProfiles(cls, times, profiles, Rvir):
+		"""
+		Make a profiler directly from cascaded profiles, without the database.
+		"""
 
+		profiler = cls.__new__(cls)
+		lineSlopes, lineIntercepts = fitPowerLaws(profiles, Rvir)
+		profiler._setFit(np.array(times), lineSlopes, lineIntercepts)
+		return profiler
+
+	def _setFit(self, times, lineSlopes, lineIntercepts):
 		self.times = times
 		self.lineSlopes = np.array(lineSlopes)
 		self.lineIntercepts = np.array(lineIntercepts)
@@ -61,3 +74,41 @@ class ClusterProfiler(object):
 		output = 10**(self.slopeOfT(timeArr)*np.log10(distanceInRvir) + self.interceptOfT(timeArr))
 
 		return output
+
+def fitPowerLaws(profiles, Rvir):
+	"""
+	Fit a power law (a line in log space) to the gas density profile of every time step in one least-squares solve.
+
+	:arg profiles - the gas_density_profile of each time step, which may have different lengths
+	:arg Rvir - the radius of the cluster at each time step
+
+	:returns lineSlopes, lineIntercepts - arrays with the fit of each time step.  nan if a step has fewer than two
+	usable points.
+	"""
+
+	#Pad the profiles into one array.  Padding is masked out just like zeroes.
+	lengths = np.array([len(profile) for profile in profiles])
+	paddedProfiles = np.zeros((len(profiles), np.max(lengths) if len(lengths) > 0 else 0))
+	for t_index in range(len(profiles)):
+		paddedProfiles[t_index,:lengths[t_index]] = profiles[t_index]
+
+	xvalues = np.arange(paddedProfiles.shape[1])[np.newaxis,:]*0.1 / np.asarray(Rvir, dtype=float)[:,np.newaxis]
+
+	#Masking zeroes for better interpolation behavior.  Also, let's get rid of kooky behavior within 0.05 Rvir
+	usable = (paddedProfiles > 0) & (xvalues > 0.05)
+
+	with np.errstate(divide='ignore', invalid='ignore'):
+		logx = np.where(usable, np.log10(xvalues), 0.0)
+		logy = np.where(usable, np.log10(paddedProfiles), 0.0)
+		nPoints = np.sum(usable, axis=1)
+		meanx = np.sum(logx, axis=1) / nPoints
+		meany = np.sum(logy, axis=1) / nPoints
+		dx = np.where(usable, logx - meanx[:,np.newaxis], 0.0)
+		dy = np.where(usable, logy - meany[:,np.newaxis], 0.0)
+		lineSlopes = np.sum(dx*dy, axis=1) / np.sum(dx*dx, axis=1)
+		lineIntercepts = meany - lineSlopes*meanx
+
+	tooFew = nPoints < 2
+	lineSlopes[tooFew] = np.nan
+	lineIntercepts[tooFew] = np.nan
+	return lineSlopes, lineIntercepts
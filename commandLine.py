@@ -0,0 +1,208 @@
+"""
+ARR: 10.19.26
+
+Thin command-line entry points for batch jobs.  Each one imports only what its job needs.
+
+	python commandLine.py build h1.cosmo50 %00004096 collection.pkl --pipeline --batchSize 8
+	python commandLine.py build h1.cosmo50 %00004096 collection.pkl --shard 0 16
+	python commandLine.py build h1.cosmo50 %00004096 collection.pkl --dryRun 0.02 --targetHours 12
+	python commandLine.py merge collection.pkl 16
+	python commandLine.py plot collection.pkl --outputDirectory plots/ --haloNumbers 2 3
+	python commandLine.py proximity collection.pkl proximity.pkl --outputDirectory proximityPlots/
+	python commandLine.py encounters collection.pkl encounters.pkl --factor 1.5
+"""
+
+import sys
+import argparse
+
+def buildMain(argv=None):
+	"""
+	Make a history collection with createHistoryCollection.
+	"""
+
+	parser = argparse.ArgumentParser(prog='build', description='Make a collection of histories.')
+	parser.add_argument('simulation', help='the name of the simulation in the tangos database')
+	parser.add_argument('timestep', help='the timestep to start from, e.g. %%00004096')
+	parser.add_argument('pickleName', help='the name of the output file')
+	parser.add_argument('--maximumSkips', type=int, default=5)
+	parser.add_argument('--cutoffDistance', type=float, default=2)
+	parser.add_argument('--minStellarMass', type=float, default=1e8)
+	parser.add_argument('--contaminationTolerance', type=float, default=0.05)
+	parser.add_argument('--minDarkParticles', type=float, default=1e4)
+	parser.add_argument('--keys', nargs='+', default=None, help='only build these keys of each historyBook')
+	parser.add_argument('--noMergers', action='store_true', help='do not look for mergers')
+	parser.add_argument('--noRamPressure', action='store_true', help='do not compute ram pressures')
+	parser.add_argument('--pipeline', action='store_true', help='fetch upcoming halos in a background thread')
+	parser.add_argument('--batchSize', type=int, default=1)
+	parser.add_argument('--compact', action='store_true', help='save compact historyBooks')
+	parser.add_argument('--stream', action='store_true', help='write each historyBook as soon as it is made')
+	parser.add_argument('--pyramids', action='store_true', help='with --stream, also store decimation pyramids')
+	parser.add_argument('--mergerTree', action='store_true', help='find mergers with the cached MergerTree of the simulation')
+	parser.add_argument('--spatialStitching', action='store_true', \
+	help='stitch gaps by position, velocity and mass where no central black hole can be followed')
+	parser.add_argument('--prevalidate', action='store_true', help='skip halos that cannot be traced before tracing any')
+	parser.add_argument('--requireComplete', action='store_true', help='with --prevalidate, also skip partly traceable halos')
+	parser.add_argument('--hosts', type=int, nargs='+', default=None, metavar='HALONUMBER', \
+	help='halo numbers of groups and clusters, for the distance to and ram pressure of the nearest host')
+	parser.add_argument('--shard', type=int, nargs=2, default=None, metavar=('INDEX', 'COUNT'), \
+	help='make only shard INDEX of COUNT, to be combined with the merge command')
+	parser.add_argument('--dryRun', type=float, default=None, metavar='FRACTION', \
+	help='write nothing, and estimate the cost of the job from this fraction of its halos')
+	parser.add_argument('--targetHours', type=float, default=None, help='with --dryRun, suggest shards of at most this many hours')
+	parser.add_argument('--maximumQueryRate', type=float, default=None, \
+	help='with --dryRun, suggest no more shards than keep the database under this many queries per second')
+	parser.add_argument('--emailAddress', default=None)
+	args = parser.parse_args(argv)
+
+	import tangos as db
+	from makeHistoryCollection import createHistoryCollection
+
+	step = db.get_timestep('{0}/{1}'.format(args.simulation, args.timestep))
+	if args.mergerTree:
+		from mergerTree import MergerTree
+		mergerTree = MergerTree.fromSimulation(step.simulation)
+	else:
+		mergerTree = None
+	if args.spatialStitching:
+		from spatialStitching import SpatialMatcher
+		spatialMatcher = SpatialMatcher(maximumSkips=args.maximumSkips)
+	else:
+		spatialMatcher = None
+
+	if args.dryRun is not None:
+		from costEstimator import estimateCollectionCost
+		estimateCollectionCost(step, sampleFraction=args.dryRun, maximumSkips=args.maximumSkips, cutoffDistance=args.cutoffDistance, \
+		minStellarMass=args.minStellarMass, contaminationTolerance=args.contaminationTolerance, minDarkParticles=args.minDarkParticles, \
+		computeRamPressure=not args.noRamPressure, computeMergers=not args.noMergers, keys=args.keys, batchSize=args.batchSize, \
+		compact=args.compact, streamOutput=args.stream, mergerTree=mergerTree, spatialMatcher=spatialMatcher, shard=args.shard, \
+		pyramids=args.pyramids, prevalidate=args.prevalidate, requireComplete=args.requireComplete, \
+		hostHaloNumbers=args.hosts, targetHours=args.targetHours, maximumQueryRate=args.maximumQueryRate)
+		return
+
+	createHistoryCollection(step, args.pickleName, maximumSkips=args.maximumSkips, cutoffDistance=args.cutoffDistance, \
+	minStellarMass=args.minStellarMass, contaminationTolerance=args.contaminationTolerance, minDarkParticles=args.minDarkParticles, \
+	emailAddress=args.emailAddress, computeRamPressure=not args.noRamPressure, computeMergers=not args.noMergers, \
+	keys=args.keys, pipeline=args.pipeline, batchSize=args.batchSize, compact=args.compact, streamOutput=args.stream, \
+	mergerTree=mergerTree, spatialMatcher=spatialMatcher, shard=args.shard, pyramids=args.pyramids, \
+	prevalidate=args.prevalidate, requireComplete=args.requireComplete, hostHaloNumbers=args.hosts)
+
+def mergeMain(argv=None):
+	"""
+	Combine the shards of a build with mergeHistoryShards.
+	"""
+
+	parser = argparse.ArgumentParser(prog='merge', description='Combine the shards of a collection.')
+	parser.add_argument('pickleName', help='the pickleName given to each shard of the build')
+	parser.add_argument('nShards', type=int)
+	parser.add_argument('--noRamPressure', action='store_true', help='do not compute ram pressures')
+	parser.add_argument('--compact', action='store_true', help='save compact historyBooks')
+	parser.add_argument('--removeShards', action='store_true', help='delete the shards once they are merged')
+	parser.add_argument('--pyramids', action='store_true', help='also store decimation pyramids')
+	args = parser.parse_args(argv)
+
+	from historySharding import mergeHistoryShards
+
+	mergeHistoryShards(args.pickleName, args.nShards, computeRamPressure=False if args.noRamPressure else None, \
+	compact=True if args.compact else None, removeShards=args.removeShards, pyramids=args.pyramids)
+
+def plotMain(argv=None):
+	"""
+	Save the plots of HistoryPlotter for some or all halos of a collection.
+	"""
+
+	parser = argparse.ArgumentParser(prog='plot', description='Plot the histories of a collection.')
+	parser.add_argument('pickleName', help='a collection made by createHistoryCollection')
+	parser.add_argument('--outputDirectory', default='./', help='where the plots go')
+	parser.add_argument('--haloNumbers', type=int, nargs='+', default=None, help='default is every halo')
+	parser.add_argument('--plots', nargs='+', default=['growth', 'specificGrowth', 'mass'], \
+	choices=['growth', 'specificGrowth', 'mass'])
+	parser.add_argument('--showDistance', action='store_true')
+	parser.add_argument('--noPressure', action='store_true')
+	parser.add_argument('--smoothingWidth', type=float, default=3)
+	args = parser.parse_args(argv)
+
+	#Plots are only saved, so no display is needed.
+	import matplotlib
+	matplotlib.use('Agg')
+	from plotHistoryCollection import HistoryPlotter
+
+	plotter = HistoryPlotter(args.pickleName, showDistance=args.showDistance, showPressure=not args.noPressure, \
+	smoothingWidth=args.smoothingWidth, outputDirectory=args.outputDirectory)
+	haloNumbers = plotter.haloNumbers if args.haloNumbers is None else args.haloNumbers
+	plotFunctions = {'growth': plotter.plotGrowth, 'specificGrowth': plotter.plotSpecificGrowth, 'mass': plotter.plotMass}
+	for haloNumber in haloNumbers:
+		print "Plotting halo number {0}.".format(haloNumber)
+		for plotName in args.plots:
+			plotFunctions[plotName](haloNumber)
+
+def proximityMain(argv=None):
+	"""
+	Save the proximity plots of ProximityPlotter for some or all halos of a collection.
+	"""
+
+	parser = argparse.ArgumentParser(prog='proximity', description='Plot distances to neighbors and to the cluster.')
+	parser.add_argument('pickleName', help='a collection made by createHistoryCollection')
+	parser.add_argument('proximityFile', help='a proximity table')
+	parser.add_argument('--outputDirectory', default='./proximityPlots/', help='where the plots go')
+	parser.add_argument('--haloNumbers', type=int, nargs='+', default=None, help='default is every halo')
+	parser.add_argument('--mode', default='threshold', choices=['threshold', 'tidal'])
+	parser.add_argument('--massType', default='Mstar')
+	parser.add_argument('--ratioThreshold', type=float, default=0.1)
+	args = parser.parse_args(argv)
+
+	import matplotlib
+	matplotlib.use('Agg')
+	from plotProximityHistory import ProximityPlotter
+
+	outputDirectory = args.outputDirectory
+	if outputDirectory[-1] != '/':
+		outputDirectory = outputDirectory + '/'
+	plotter = ProximityPlotter(args.pickleName, args.proximityFile, mode=args.mode, massType=args.massType, \
+	ratioThreshold=args.ratioThreshold)
+	if args.haloNumbers is None:
+		plotter.makePlotDirectory(saveDirectory=outputDirectory)
+	else:
+		for haloNumber in args.haloNumbers:
+			print "Halo Number = {0}".format(haloNumber)
+			plotter.plotProximity(haloNumber, savename=outputDirectory+'proximity_halo{0}.png'.format(haloNumber))
+
+def encountersMain(argv=None):
+	"""
+	Save the close encounters between the halos of a collection, found with findEncounters.
+	"""
+
+	parser = argparse.ArgumentParser(prog='encounters', description='Find close encounters between the halos of a collection.')
+	parser.add_argument('pickleName', help='a collection made by createHistoryCollection')
+	parser.add_argument('outputName', help='where the table of encounters is pickled')
+	parser.add_argument('--factor', type=float, default=1.0, help='the multiple of R200 that counts as an encounter')
+	parser.add_argument('--haloNumbers', type=int, nargs='+', default=None, help='default is every halo')
+	parser.add_argument('--stride', type=int, default=1, help='search every stride-th time slice')
+	args = parser.parse_args(argv)
+
+	import cPickle as pickle
+	from historyStorage import loadHistoryCollection
+	from encounterFinder import findEncounters
+
+	historyCollection = loadHistoryCollection(args.pickleName, lazy=True)
+	encounters = findEncounters(historyCollection, factor=args.factor, haloNumbers=args.haloNumbers, stride=args.stride)
+	with open(args.outputName, 'w') as myfile:
+		pickle.dump(encounters, myfile)
+	print "Saved {0} encounters to {1}.".format(len(encounters), args.outputName)
+
+_commands = {'build': buildMain, 'merge': mergeMain, 'plot': plotMain, 'proximity': proximityMain, 'encounters': encountersMain}
+
+def main(argv=None):
+	"""
+	Run one of the commands:  build, merge, plot, proximity or encounters.
+	"""
+
+	if argv is None:
+		argv = sys.argv[1:]
+	if (len(argv) == 0) or (argv[0] not in _commands):
+		print "Usage:  {0} {{{1}}} [arguments]".format(sys.argv[0], ','.join(sorted(_commands.keys())))
+		return 1
+	_commands[argv[0]](argv[1:])
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
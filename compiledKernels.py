@@ -0,0 +1,163 @@
+"""
+ARR: 10.19.26
+
+Inner loops that stay branchy even with NumPy, written as plain loops over flat arrays so that Numba can compile them.
+If Numba is installed they are compiled the first time they are called and used automatically.  Otherwise the callers
+keep their NumPy paths.  The loops still run without Numba, only slowly, which is how benchmarks.py checks them.
+"""
+
+import numpy as np
+
+try:
+	import numba
+	hasNumba = True
+except ImportError:
+	numba = None
+	hasNumba = False
+
+#Whether callers use these kernels.  Set to False to force the NumPy paths.
+useCompiled = hasNumba
+
+def jit(function):
+	"""
+	Compile a function with Numba in nopython mode, with NumPy's handling of division by zero.  Without Numba, the
+	function is returned as it is.
+	"""
+
+	if hasNumba:
+		return numba.njit(cache=True, error_model='numpy')(function)
+	return function
+
+def flatten(arrays, dtype=float):
+	"""
+	Concatenate a list of arrays of different sizes.  Arrays of more than one dimension are raveled.
+
+	:returns values - the concatenated arrays
+	:returns offsets - array of len(arrays)+1, so that arrays[i] is values[offsets[i]:offsets[i+1]]
+	"""
+
+	lengths = np.array([np.size(array) for array in arrays], dtype=np.int64)
+	offsets = np.zeros(len(arrays)+1, dtype=np.int64)
+	offsets[1:] = np.cumsum(lengths)
+	if len(arrays) == 0:
+		return np.zeros(0, dtype=dtype), offsets
+	return np.concatenate([np.asarray(array, dtype=dtype).ravel() for array in arrays]), offsets
+
+@jit
+def stitchOverlappingMaximum(ends, values, offsets, nBins):
+	"""
+	The loop of makeHistory._stitchBHAR.  Histogram i covers the bins before ends[i], and where histograms overlap the
+	largest value is kept.
+
+	:arg ends - the bin after the last bin of each histogram
+	:arg values, offsets - the histograms, flattened
+	:arg nBins - the length of the output
+	"""
+
+	combined = np.zeros(nBins)
+	for h_index in range(len(ends)):
+		length = offsets[h_index+1] - offsets[h_index]
+		end = ends[h_index]
+		start = max(end - length, 0)
+		first = offsets[h_index+1] - (end - start)
+		for b_index in range(start, min(end, nBins)):
+			value = values[first + b_index - start]
+			#np.maximum, which keeps nan.
+			if (value > combined[b_index]) or (value != value):
+				combined[b_index] = value
+	return combined
+
+@jit
+def retraceProximityLoop(timeIndices, haloNumbers, numbers, masses, radii, offsets, distances, distanceOffsets, \
+	tidal, ratioThreshold):
+	"""
+	The loop of ProximityCalculator.retraceProximity, for either mode, on a flattened proximity table.
+
+	:arg timeIndices - the step of each lookup
+	:arg haloNumbers - the halo number of each lookup
+	:arg numbers, masses, radii, offsets - the halo numbers, masses and Rvir of every step, flattened
+	:arg distances, distanceOffsets - the distance matrix of every step, flattened
+	:arg tidal - whether the mode is 'tidal' rather than 'threshold'
+	:arg ratioThreshold - the mass ratio of the 'threshold' mode
+	"""
+
+	output = np.zeros(len(haloNumbers))
+	for i in range(len(haloNumbers)):
+		t_index = timeIndices[i]
+		start = offsets[t_index]
+		nHalos = offsets[t_index+1] - start
+		match = -1
+		for j in range(nHalos):
+			if numbers[start+j] == haloNumbers[i]:
+				match = j
+				break
+		if match < 0:
+			output[i] = np.nan
+			continue
+
+		row = distanceOffsets[t_index] + match*nHalos
+		matchMass = masses[start+match]
+		if tidal:
+			result = 0.0
+		else:
+			result = np.inf
+		found = False
+		for j in range(nHalos):
+			number = numbers[start+j]
+			if (number == 1) or (number == haloNumbers[i]):
+				continue
+			if tidal:
+				value = radii[start+match] / distances[row+j] * (masses[start+j] / matchMass)**(1.0/3.0)
+			else:
+				if not (masses[start+j] / matchMass >= ratioThreshold):
+					continue
+				value = distances[row+j]
+			#np.min and np.max, which keep nan.
+			if value != value:
+				result = value
+				break
+			if (not found) or (tidal and (value > result)) or ((not tidal) and (value < result)):
+				result = value
+			found = True
+		output[i] = result
+	return output
+
+@jit
+def interpolateLogTables(logDistances, tableIndices, xValues, yValues, offsets, innerLogDensities):
+	"""
+	The loop of ClusterProfiler.computeGasDensity.  Each lookup interpolates one log table linearly, as interp1d does,
+	with the innermost density below the table and zero above it.
+
+	:arg logDistances - log10 of each distance in Rvir
+	:arg tableIndices - the table of each lookup, or -1 for a density of zero
+	:arg xValues, yValues, offsets - the log distances and log densities of every table, flattened
+	:arg innerLogDensities - log10 of the innermost nonzero density of each table
+	"""
+
+	output = np.zeros(len(logDistances))
+	for d_index in range(len(logDistances)):
+		t_index = tableIndices[d_index]
+		if t_index < 0:
+			continue
+		x = logDistances[d_index]
+		start = offsets[t_index]
+		end = offsets[t_index+1]
+		if x != x:
+			output[d_index] = np.nan
+		elif x < xValues[start]:
+			output[d_index] = 10**innerLogDensities[t_index]
+		elif x > xValues[end-1]:
+			output[d_index] = 0.0
+		else:
+			#The first point at or above x, as np.searchsorted, but never the first point.
+			low = start + 1
+			high = end - 1
+			while low < high:
+				middle = (low + high) // 2
+				if xValues[middle] < x:
+					low = middle + 1
+				else:
+					high = middle
+			slope = (yValues[low] - yValues[low-1]) / (xValues[low] - xValues[low-1])
+			output[d_index] = 10**(slope*(x - xValues[low-1]) + yValues[low-1])
+	return output
@@ -0,0 +1,95 @@
+"""
+ARR: 10.19.26
+
+Contact sheets:  many halos on one figure, as a grid of small panels that share their axes.  Each panel is
+drawn with one LineCollection for its curves and one PolyCollection for its merger bands, so a whole
+collection can be looked over with a handful of figure saves.
+"""
+
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection, PolyCollection
+from matplotlib.colors import to_rgba
+
+def pages(haloNumbers, nRows=5, nColumns=5):
+	"""
+	Split halo numbers into groups that fill one sheet each.
+	"""
+
+	perPage = nRows * nColumns
+	return [haloNumbers[i:i+perPage] for i in range(0, len(haloNumbers), perPage)]
+
+def makeSheet(nRows=5, nColumns=5, xlim=None, ylim=None, yscale='linear', xlabel=None, ylabel=None, panelSize=2.2):
+	"""
+	An empty grid of panels with shared axes.
+
+	:returns fig, axes - axes is flattened, in reading order
+	"""
+
+	fig, axes = plt.subplots(nRows, nColumns, sharex=True, sharey=True, squeeze=False, \
+	figsize=(panelSize*nColumns, panelSize*nRows))
+	axes = axes.flatten()
+	axes[0].set_yscale(yscale)
+	if xlim is not None:
+		axes[0].set_xlim(xlim[0], xlim[1])
+	if ylim is not None:
+		axes[0].set_ylim(ylim[0], ylim[1])
+	for ax in axes:
+		ax.tick_params(labelsize=8)
+	if xlabel is not None:
+		fig.text(0.5, 0.01, xlabel, ha='center', fontsize=14)
+	if ylabel is not None:
+		fig.text(0.01, 0.5, ylabel, va='center', rotation='vertical', fontsize=14)
+	fig.subplots_adjust(left=0.07, right=0.99, bottom=0.06, top=0.99, wspace=0, hspace=0)
+	return fig, axes
+
+def addCurves(ax, curves, lw=1):
+	"""
+	Draw curves on a panel as one LineCollection.
+
+	:arg curves - list of (x, y, color)
+	"""
+
+	if len(curves) == 0:
+		return None
+	segments = [np.column_stack((np.asarray(x, dtype=float), np.asarray(y, dtype=float))) for x, y, color in curves]
+	lines = LineCollection(segments, colors=[color for x, y, color in curves], linewidths=lw)
+	ax.add_collection(lines)
+	return lines
+
+def addMergerBands(ax, mergers, majorMergerThreshold=0.25):
+	"""
+	Draw merger bars on a panel as one PolyCollection spanning its full height.  Major mergers are red and minor ones
+	black, with opacity set by the mass ratio, as in the single-halo plots.
+
+	:arg mergers - structured array with tStart, tEnd and ratio, as returned by MergerCatalogue
+	"""
+
+	if len(mergers) == 0:
+		return None
+	vertices = [[(start, 0), (end, 0), (end, 1), (start, 1)] for start, end in zip(mergers['tStart'], mergers['tEnd'])]
+	colors = [to_rgba('r' if ratio > majorMergerThreshold else 'k', alpha=min(ratio, 1.0)) for ratio in mergers['ratio']]
+	bands = PolyCollection(vertices, facecolors=colors, edgecolors='none', transform=ax.get_xaxis_transform())
+	ax.add_collection(bands)
+	return bands
+
+def labelPanel(ax, label):
+	ax.text(0.05, 0.92, label, transform=ax.transAxes, fontsize=8, va='top')
+
+def finishSheet(fig, axes, nUsed, nColumns=5, saveName=None):
+	"""
+	Hide the unused panels, then save or show the sheet.
+	"""
+
+	for ax in axes[nUsed:]:
+		ax.set_visible(False)
+	#Panels above a hidden one are now at the bottom of their column, so they need time labels.
+	for ax in axes[max(nUsed-nColumns, 0):nUsed]:
+		ax.xaxis.set_tick_params(labelbottom=True)
+	if saveName is not None:
+		fig.savefig(saveName)
+		plt.close(fig)
+	else:
+		fig.show()
+		raw_input("Please enter when finished.\n")
+		plt.close(fig)
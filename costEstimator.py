@@ -0,0 +1,242 @@
+"""
+ARR: 10.19.26
+
+Estimate what a createHistoryCollection job will cost before running it.  A small sample of the selected halos goes
+through every stage of the job, the queries sent to the database and the time of each stage are counted, and the
+totals are projected to the whole selection.
+"""
+
+import time
+import cPickle as pickle
+import numpy as np
+from contextlib import contextmanager
+from getSuitableHalos import getSuitableHalos
+from stitched_merger_finder import historyBranch, gatherMergerCandidates, findMergers
+from makeHistory import assembleHistory
+from historyStorage import compactHistory, buildPyramids
+from historySharding import shardOf
+from traceability import checkTraceability, PARTIAL, UNTRACEABLE
+import stitched_reverse_property_cascade
+
+#The stages paid once per job, and those paid once per halo.
+fixedStages = ['select', 'environment']
+perHaloStages = ['prevalidate', 'cascade', 'mergers', 'assemble', 'output']
+
+class StageCounter(object):
+	"""
+	Count the queries sent to the database and the seconds spent in each stage of a job.
+
+		with StageCounter() as counter:
+			with counter.stage('cascade'):
+				...
+	"""
+
+	def __init__(self, engine=None):
+		"""
+		:kwarg engine - the SQLAlchemy engine to listen to.  Default is the engine of the tangos database.
+		"""
+
+		self.engine = engine
+		self.queries = {}
+		self.seconds = {}
+		self.currentStage = None
+
+	def _countQuery(self, connection, cursor, statement, parameters, context, executemany):
+		if self.currentStage is not None:
+			self.queries[self.currentStage] = self.queries.get(self.currentStage, 0) + 1
+
+	def __enter__(self):
+		from sqlalchemy import event
+		if self.engine is None:
+			import tangos as db
+			self.engine = db.core.get_default_engine()
+		event.listen(self.engine, 'before_cursor_execute', self._countQuery)
+		return self
+
+	def __exit__(self, excType, excValue, traceback):
+		from sqlalchemy import event
+		event.remove(self.engine, 'before_cursor_execute', self._countQuery)
+		return False
+
+	@contextmanager
+	def stage(self, name):
+		"""
+		Count everything inside the with block as stage name.  Stages inside other stages are counted on their own.
+		"""
+
+		previousStage = self.currentStage
+		self.currentStage = name
+		t_start = time.time()
+		try:
+			yield
+		finally:
+			elapsed = time.time() - t_start
+			self.seconds[name] = self.seconds.get(name, 0.0) + elapsed
+			self.currentStage = previousStage
+			if previousStage is not None:
+				#The outer stage does not pay for this one twice.
+				self.seconds[previousStage] = self.seconds.get(previousStage, 0.0) - elapsed
+
+def estimateCollectionCost(step, sampleFraction=0.05, minimumSample=5, seed=0, maximumSkips=5, cutoffDistance=2, \
+	minStellarMass=1e8, contaminationTolerance=0.05, minDarkParticles=1e4, requireBH=True, computeRamPressure=True, \
+	computeMergers=True, massForRatio='Mstar', bhString="bh('BH_mass', 'max', 'BH_central')", keys=None, batchSize=1, \
+	compact=False, compactDtype=np.float32, streamOutput=False, mergerTree=None, spatialMatcher=None, shard=None, \
+	pyramids=False, prevalidate=False, requireComplete=False, hostHaloNumbers=None, targetHours=None, maximumQueryRate=None, engine=None):
+	"""
+	Run a sample of the halos of a createHistoryCollection job through every stage, without writing anything, and
+	project the cost of the whole job.
+
+	:arg step - the timestep the job starts from
+
+	:kwarg sampleFraction - the fraction of the selected halos to run
+	:kwarg minimumSample - run at least this many halos, if there are that many
+	:kwarg seed - the seed of the random sample
+	:kwarg targetHours - if given, suggest the number of shards that brings each under this many hours
+	:kwarg maximumQueryRate - if given, the most queries per second the database should see from all shards together
+	:kwarg engine - the SQLAlchemy engine to count queries on.  Default is that of the tangos database.
+
+	The other kwargs are those of createHistoryCollection.
+
+	:returns estimate - a dictionary of
+		nSelected, nSampled - the number of halos in the job and in the sample
+		failureFraction - the fraction of the sample that failed
+		meanSteps - the mean number of steps in the main branches of the sample
+		stitchSearchesPerHalo, stitchesPerHalo - gaps searched across and stitched per halo
+		stageSeconds, stageQueries - the measured seconds and queries of each stage
+		projectedSeconds, projectedQueries - the same, projected to the whole job
+		totalHours, totalQueries, queryRate - for the whole job on one worker, and its queries per second
+		outputBytes - the projected size of the output
+		suggestedShards - the number of shards suggested by targetHours and maximumQueryRate, or None
+	"""
+
+	with StageCounter(engine=engine) as counter:
+		with counter.stage('select'):
+			haloList = getSuitableHalos(step, requireBH=requireBH, minStellarMass=minStellarMass, \
+			contaminationTolerance=contaminationTolerance, minDarkParticles=minDarkParticles)
+		if shard is not None:
+			shardIndex, nShards = shard
+			haloList = [halo for halo in haloList if shardOf(halo.halo_number, nShards) == shardIndex]
+		nSelected = len(haloList)
+		if nSelected == 0:
+			print "No halos are selected.  There is nothing to estimate."
+			return None
+
+		nSampled = min(nSelected, max(minimumSample, int(np.ceil(sampleFraction*nSelected))))
+		sample = [haloList[i] for i in np.sort(np.random.RandomState(seed).choice(nSelected, nSampled, replace=False))]
+
+		#The profilers of the cluster and of the hosts are made once per job, if the job adds their environment.
+		hasCluster = step.simulation.basename == 'h1.cosmo50'
+		profiledHalos = [1] if hasCluster else []
+		if hostHaloNumbers is not None:
+			profiledHalos = sorted(set(profiledHalos) | set(hostHaloNumbers))
+		if computeRamPressure & (shard is None) & (len(profiledHalos) > 0):
+			with counter.stage('environment'):
+				from clusterProfiler_powerlaw import ClusterProfiler
+				for haloNumber in profiledHalos:
+					ClusterProfiler(step, haloNumber=haloNumber)
+
+		if prevalidate:
+			with counter.stage('prevalidate'):
+				report = checkTraceability(sample, bhString=bhString, keys=keys, maximumSkips=maximumSkips, \
+				cutoffDistance=cutoffDistance, spatialMatcher=spatialMatcher)
+			skippedHaloNumbers = report[UNTRACEABLE] + (report[PARTIAL] if requireComplete else [])
+			traced = [halo for halo in sample if halo.halo_number not in skippedHaloNumbers]
+		else:
+			traced = sample
+
+		from makeHistoryCollection import _fetchHalos
+		stitchSearches = stitched_reverse_property_cascade.stitchCounts['searches']
+		stitches = stitched_reverse_property_cascade.stitchCounts['stitched']
+		nSteps = []
+		nFailed = nSampled - len(traced)
+		outputBytes = 0
+		for b_index in range(0, len(traced), batchSize):
+			batch = traced[b_index:b_index+batchSize]
+			print "Sampling halos {0}.".format([halo.halo_number for halo in batch])
+			with counter.stage('cascade'):
+				fetchedHalos = _fetchHalos(batch, maximumSkips=maximumSkips, cutoffDistance=cutoffDistance, bhString=bhString, \
+				keys=keys, computeMergers=False, spatialMatcher=spatialMatcher)
+			for halo, (haloNumber, rawHistory, mergerCandidates) in zip(batch, fetchedHalos):
+				if rawHistory is None:
+					nFailed += 1
+					continue
+				rawColumns, schema, usedKeys = rawHistory
+				nSteps.append(len(rawColumns['t()']))
+				if computeMergers:
+					with counter.stage('mergers'):
+						times, halo_numbers = historyBranch(rawHistory)
+						mergerCandidates = gatherMergerCandidates(halo, maximumSkips=maximumSkips, cutoffDistance=cutoffDistance, \
+						massForRatio=massForRatio, times=times, halo_numbers=halo_numbers, tree=mergerTree, \
+						spatialMatcher=spatialMatcher)
+				with counter.stage('assemble'):
+					historyBook = assembleHistory(rawColumns, schema, usedKeys, bhString=bhString)
+					if computeMergers:
+						historyBook['mergerTimes'], historyBook['mergerRatios'], historyBook['mergerProgenitors'] = \
+						findMergers(mergerCandidates, returnProgenitors=True)
+				with counter.stage('output'):
+					#The same pickling as the output would get.
+					if compact:
+						historyBook = compactHistory(historyBook, dtype=compactDtype)
+					if streamOutput:
+						outputBytes += len(pickle.dumps((haloNumber, historyBook), protocol=pickle.HIGHEST_PROTOCOL))
+						if pyramids:
+							outputBytes += len(pickle.dumps((haloNumber, buildPyramids(historyBook)), protocol=pickle.HIGHEST_PROTOCOL))
+					else:
+						outputBytes += len(pickle.dumps(historyBook))
+		stitchSearches = stitched_reverse_property_cascade.stitchCounts['searches'] - stitchSearches
+		stitches = stitched_reverse_property_cascade.stitchCounts['stitched'] - stitches
+
+	#Each stage paid per halo is scaled from the sample to the whole selection.
+	scale = float(nSelected) / nSampled
+	projectedSeconds = {}
+	projectedQueries = {}
+	for stage in fixedStages + perHaloStages:
+		factor = scale if stage in perHaloStages else 1
+		projectedSeconds[stage] = counter.seconds.get(stage, 0.0) * factor
+		projectedQueries[stage] = counter.queries.get(stage, 0) * factor
+	totalSeconds = sum(projectedSeconds.values())
+	totalQueries = sum(projectedQueries.values())
+	queryRate = totalQueries / totalSeconds if totalSeconds > 0 else 0.0
+
+	#Every shard selects its halos again, so only the per halo stages are divided among shards.
+	suggestedShards = None
+	perHaloSeconds = sum([projectedSeconds[stage] for stage in perHaloStages])
+	fixedSeconds = sum([projectedSeconds[stage] for stage in fixedStages])
+	if targetHours is not None:
+		availableSeconds = targetHours*60*60 - fixedSeconds
+		if availableSeconds <= 0:
+			print "The stages paid once per job already take longer than {0} hours.".format(targetHours)
+			suggestedShards = nSelected
+		else:
+			suggestedShards = int(np.ceil(perHaloSeconds / availableSeconds))
+	if (maximumQueryRate is not None) and (queryRate > 0):
+		mostShards = max(int(np.floor(maximumQueryRate / queryRate)), 1)
+		suggestedShards = mostShards if suggestedShards is None else min(suggestedShards, mostShards)
+	if suggestedShards is not None:
+		suggestedShards = int(min(max(suggestedShards, 1), nSelected))
+
+	estimate = {'nSelected': nSelected, 'nSampled': nSampled, 'failureFraction': float(nFailed) / nSampled, \
+	'meanSteps': np.mean(nSteps) if len(nSteps) > 0 else 0.0, 'stitchSearchesPerHalo': float(stitchSearches) / nSampled, \
+	'stitchesPerHalo': float(stitches) / nSampled, 'stageSeconds': dict(counter.seconds), 'stageQueries': dict(counter.queries), \
+	'projectedSeconds': projectedSeconds, 'projectedQueries': projectedQueries, 'totalHours': totalSeconds/60/60, \
+	'totalQueries': totalQueries, 'queryRate': queryRate, 'outputBytes': outputBytes * scale, 'suggestedShards': suggestedShards}
+	printEstimate(estimate)
+	return estimate
+
+def printEstimate(estimate):
+	"""
+	Print the output of estimateCollectionCost.
+	"""
+
+	print "Sampled {0} of {1} halos.  {2:3.1f}% failed.".format(estimate['nSampled'], estimate['nSelected'], \
+	100*estimate['failureFraction'])
+	print "Main branches span {0:3.1f} steps, with {1:3.2f} stitch searches and {2:3.2f} stitches per halo.".format( \
+	estimate['meanSteps'], estimate['stitchSearchesPerHalo'], estimate['stitchesPerHalo'])
+	for stage in fixedStages + perHaloStages:
+		if estimate['projectedSeconds'][stage] > 0:
+			print "   {0:12s} {1:10.3f} hours {2:12.0f} queries".format(stage, estimate['projectedSeconds'][stage]/60/60, \
+			estimate['projectedQueries'][stage])
+	print "Projected total:  {0:3.2f} hours, {1:.0f} queries ({2:3.1f} per second), {3:3.1f} MB of output.".format( \
+	estimate['totalHours'], estimate['totalQueries'], estimate['queryRate'], estimate['outputBytes']/2.0**20)
+	if estimate['suggestedShards'] is not None:
+		print "Suggested shards:  {0}".format(estimate['suggestedShards'])
@@ -0,0 +1,145 @@
+"""
+ARR: 10.19.26
+
+Quantities derived from the series of a historyBook, such as specific rates and the rate of change of
+the gas mass.  Each is declared once with the keys it depends on, computed only when asked for, and
+remembered until one of those keys changes.
+"""
+
+import numpy as np
+
+#Name:  (function, keys it depends on).  The function takes the dependencies in order, with time along the last
+#axis, so the same function works on one historyBook or on a stack of many.
+derivedQuantities = {}
+
+def registerDerivedQuantity(name, function, dependencies):
+	"""
+	Declare a derived quantity.  Dependencies may be other derived quantities.
+
+	:arg name - the key to ask for, e.g. 'sSFR'
+	:arg function - takes the dependencies as arrays and returns the derived series
+	:arg dependencies - list of the keys passed to function
+	"""
+
+	derivedQuantities[name] = (function, tuple(dependencies))
+
+def centredDerivative(values, time):
+	"""
+	The rate of change of a series, with centred differences inside and one-sided differences at the ends.  Series
+	that begin or end with nan, as in a stack of halos tracked for different lengths of time, use one-sided
+	differences at the ends of their own data.
+
+	:arg values - array with time along the last axis
+	:arg time - the time axis
+	"""
+
+	values = np.asarray(values, dtype=float)
+	time = np.asarray(time, dtype=float)
+	derivative = np.full(values.shape, np.nan)
+	if values.shape[-1] < 2:
+		return derivative
+
+	with np.errstate(invalid='ignore'):
+		forward = (values[...,1:] - values[...,:-1]) / (time[...,1:] - time[...,:-1])
+		derivative[...,0] = forward[...,0]
+		derivative[...,-1] = forward[...,-1]
+		if values.shape[-1] > 2:
+			centred = (values[...,2:] - values[...,:-2]) / (time[...,2:] - time[...,:-2])
+			hasData = ~np.isnan(values)
+			firstPoint = hasData[...,1:-1] & ~hasData[...,:-2]
+			lastPoint = hasData[...,1:-1] & ~hasData[...,2:]
+			derivative[...,1:-1] = np.where(firstPoint, forward[...,1:], np.where(lastPoint, forward[...,:-1], centred))
+	return derivative
+
+#Gas mass change in Msun/yr.  Time is in Gyr.
+registerDerivedQuantity('dMgas_dt', lambda Mgas, time: centredDerivative(Mgas, time) / 1e9, ['Mgas', 'time'])
+registerDerivedQuantity('sSFR', lambda SFR, Mstar: SFR / Mstar, ['SFR', 'Mstar'])
+registerDerivedQuantity('sBHAR', lambda BHAR, Mbh: BHAR / Mbh, ['BHAR', 'Mbh'])
+#Scaled to be comparable with the SFR
+registerDerivedQuantity('BHAR_scaled', lambda BHAR: BHAR / 7e-4, ['BHAR'])
+
+def dependsOn(name, key):
+	"""
+	Whether a derived quantity depends on key, directly or through other derived quantities.
+	"""
+
+	if name not in derivedQuantities:
+		return False
+	dependencies = derivedQuantities[name][1]
+	return (key in dependencies) or any([dependsOn(dependency, key) for dependency in dependencies])
+
+def computeDerivedQuantity(name, getter):
+	"""
+	Compute a derived quantity from whatever getter returns for each of its dependencies.
+	"""
+
+	function, dependencies = derivedQuantities[name]
+	return function(*[getter(dependency) for dependency in dependencies])
+
+class DerivedHistoryBook(object):
+
+	def __init__(self, historyBook):
+		"""
+		A historyBook that also answers for the derived quantities.  Stored keys come from historyBook, which is not
+		copied.  Derived values are remembered along with the arrays they were computed from, and are computed again
+		if any of those arrays are replaced.  Call invalidate after changing an array in place.
+
+		:arg historyBook - a historyBook made by makeHistory
+		"""
+
+		self.historyBook = historyBook
+		self._derived = {}
+
+	def __getitem__(self, key):
+		if key in self.historyBook:
+			return self.historyBook[key]
+		if key not in derivedQuantities:
+			raise KeyError(key)
+		dependencies = derivedQuantities[key][1]
+		inputs = [self[dependency] for dependency in dependencies]
+		if key in self._derived:
+			value, cachedInputs = self._derived[key]
+			if all([current is cached for current, cached in zip(inputs, cachedInputs)]):
+				return value
+		value = derivedQuantities[key][0](*inputs)
+		self._derived[key] = (value, inputs)
+		return value
+
+	def __setitem__(self, key, value):
+		self.historyBook[key] = value
+		self.invalidate(key)
+
+	def __contains__(self, key):
+		return key in self.historyBook
+
+	def keys(self):
+		return self.historyBook.keys()
+
+	def get(self, key, default=None):
+		try:
+			return self[key]
+		except KeyError:
+			return default
+
+	def canDerive(self, key):
+		"""
+		Whether key is stored, or is a derived quantity whose dependencies are all available.
+		"""
+
+		if key in self.historyBook:
+			return True
+		if key not in derivedQuantities:
+			return False
+		return all([self.canDerive(dependency) for dependency in derivedQuantities[key][1]])
+
+	def invalidate(self, key=None):
+		"""
+		Forget the derived values that depend on key.  None forgets all of them.
+		"""
+
+		if key is None:
+			self._derived = {}
+			return
+		for name in self._derived.keys():
+			if (name == key) or dependsOn(name, key):
+				del self._derived[name]
@@ -0,0 +1,124 @@
+"""
+ARR: 10.19.26
+
+Find every close encounter between the halos of a collection at once.  The interpolated SSC tracks and R200 of all
+historyBooks are put on one time axis, each time slice gets a KD-tree of all positions, and every pair that comes
+within some multiple of R200 of each other is recorded with its pericentre.
+"""
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+encounterDtype = [('haloNumber1', int), ('haloNumber2', int), ('tStart', float), ('tEnd', float), \
+('tPericentre', float), ('pericentre', float), ('pericentreInR200', float)]
+
+def gatherTracks(historyCollection, haloNumbers=None):
+	"""
+	The SSC and R200 of many historyBooks on one time axis.
+
+	:arg historyCollection - a collection made by createHistoryCollection, or a HistoryCollectionReader
+
+	:kwarg haloNumbers - the halos to include.  Default is every halo with SSC and R200.
+
+	:returns haloNumbers - the halos included
+	:returns time - the time axis, in Gyr
+	:returns positions - array of shape (nHalos, nTimes, 3), infinite where a halo does not exist
+	:returns radii - array of shape (nHalos, nTimes), zero where a halo does not exist
+	"""
+
+	if haloNumbers is None:
+		haloNumbers = sorted([key for key in historyCollection.keys() if isinstance(key, int)])
+	tracks = []
+	for haloNumber in haloNumbers:
+		historyBook = historyCollection[haloNumber]
+		if ('SSC' not in historyBook) or ('R200' not in historyBook):
+			continue
+		tracks.append((haloNumber, historyBook['time'], historyBook['SSC'], historyBook['R200']))
+	if len(tracks) == 0:
+		return np.array([], dtype=int), np.array([]), np.zeros((0,0,3)), np.zeros((0,0))
+
+	#Books that start from the same step share a time axis.  Any others are interpolated onto the longest.
+	time = max([track[1] for track in tracks], key=len)
+	positions = np.full((len(tracks), len(time), 3), np.inf)
+	radii = np.zeros((len(tracks), len(time)))
+	for t_index, (haloNumber, bookTime, ssc, r200) in enumerate(tracks):
+		if (len(bookTime) == len(time)) and np.array_equal(bookTime, time):
+			positions[t_index] = np.transpose(ssc)
+			radii[t_index] = r200
+		else:
+			for i in range(3):
+				positions[t_index,:,i] = np.interp(time, bookTime, ssc[i], left=np.inf, right=np.inf)
+			radii[t_index] = np.interp(time, bookTime, r200, left=0, right=0)
+	return np.array([track[0] for track in tracks], dtype=int), np.asarray(time), positions, radii
+
+def findEncounters(historyCollection, factor=1.0, haloNumbers=None, stride=1):
+	"""
+	Find the pairs of halos that come within factor times R200 of each other, where R200 is the larger of the two.
+
+	:arg historyCollection - a collection made by createHistoryCollection, or a HistoryCollectionReader
+
+	:kwarg factor - the multiple of R200 that counts as an encounter
+	:kwarg haloNumbers - the halos to search.  Default is every halo with SSC and R200.
+	:kwarg stride - search every stride-th time slice
+
+	:returns encounters - structured array with encounterDtype, sorted by haloNumber1, haloNumber2 and tStart.  Each
+	row is one stretch of consecutive searched slices in which a pair is close, with haloNumber1 < haloNumber2.
+	"""
+
+	haloNumbers, time, positions, radii = gatherTracks(historyCollection, haloNumbers=haloNumbers)
+	if len(haloNumbers) < 2:
+		return np.array([], dtype=encounterDtype)
+	slices = np.arange(0, len(time), stride)
+
+	#Every close pair in every slice, found with one KD-tree per slice.
+	pairSlices = []
+	pairs = []
+	separations = []
+	for s_index, t_index in enumerate(slices):
+		present = np.where(np.all(np.isfinite(positions[:,t_index]), axis=1) & (radii[:,t_index] > 0))[0]
+		if len(present) < 2:
+			continue
+		kdTree = cKDTree(positions[present,t_index])
+		candidates = kdTree.query_pairs(factor*np.max(radii[present,t_index]), output_type='ndarray')
+		if len(candidates) == 0:
+			continue
+		first, second = present[candidates[:,0]], present[candidates[:,1]]
+		separation = np.sqrt(np.sum((positions[first,t_index] - positions[second,t_index])**2, axis=1))
+		close = separation < factor*np.maximum(radii[first,t_index], radii[second,t_index])
+		pairSlices.append(np.full(np.sum(close), s_index, dtype=int))
+		pairs.append(np.sort(np.vstack([first[close], second[close]]), axis=0).T)
+		separations.append(separation[close])
+	if len(pairs) == 0:
+		return np.array([], dtype=encounterDtype)
+	pairSlices = np.concatenate(pairSlices)
+	pairs = np.vstack(pairs)
+	separations = np.concatenate(separations)
+
+	#Sort by pair and then by slice.  An encounter ends wherever the pair changes or a slice is skipped.
+	order = np.lexsort((pairSlices, pairs[:,1], pairs[:,0]))
+	pairSlices, pairs, separations = pairSlices[order], pairs[order], separations[order]
+	newEncounter = np.ones(len(order), dtype=bool)
+	newEncounter[1:] = np.any(pairs[1:] != pairs[:-1], axis=1) | (pairSlices[1:] != pairSlices[:-1] + 1)
+	starts = np.where(newEncounter)[0]
+	ends = np.append(starts[1:], len(order)) - 1
+
+	encounters = np.zeros(len(starts), dtype=encounterDtype)
+	encounters['haloNumber1'] = haloNumbers[pairs[starts,0]]
+	encounters['haloNumber2'] = haloNumbers[pairs[starts,1]]
+	encounters['tStart'] = time[slices[pairSlices[starts]]]
+	encounters['tEnd'] = time[slices[pairSlices[ends]]]
+	for e_index, (start, end) in enumerate(zip(starts, ends)):
+		closest = start + np.argmin(separations[start:end+1])
+		t_index = slices[pairSlices[closest]]
+		encounters['tPericentre'][e_index] = time[t_index]
+		encounters['pericentre'][e_index] = separations[closest]
+		encounters['pericentreInR200'][e_index] = separations[closest] / \
+		max(radii[pairs[closest,0],t_index], radii[pairs[closest,1],t_index])
+	return np.sort(encounters, order=['haloNumber1', 'haloNumber2', 'tStart'])
+
+def encountersOf(encounters, haloNumber):
+	"""
+	The encounters of one halo, from the output of findEncounters.
+	"""
+
+	return encounters[(encounters['haloNumber1'] == haloNumber) | (encounters['haloNumber2'] == haloNumber)]
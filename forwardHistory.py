@@ -0,0 +1,146 @@
+"""
+ARR: 10.19.26
+
+Trace halos forward in time, from an early step to wherever they end up.  Descendants of every halo are followed
+together on the link arrays of a MergerTree, and properties are gathered with one query per step for the whole
+population.  The historyBooks have the same layout as those of makeHistory.
+"""
+
+import numpy as np
+import cPickle as pickle
+from tangos.live_calculation import NoResultsError
+from util import crossmatch
+from propertySchema import getPropertySchema, selectQuery
+from makeHistory import assembleHistory
+from mergerTree import MergerTree
+from haloSelection import defaultSelector, suitabilityCuts
+
+def traceDescendants(tree, nodes, followMergers=True):
+	"""
+	Follow the major descendants of some nodes forward, one step at a time for all of them at once.
+
+	:arg tree - a MergerTree
+	:arg nodes - the starting nodes
+
+	:kwarg followMergers - keep going after a node merges into a bigger one, i.e. when it is not the major progenitor
+	of its descendant.  Otherwise, the trace stops there.
+
+	:returns paths - 2d array of nodes, one row per starting node and one column per step, -1 where not traced
+	"""
+
+	nodes = np.atleast_1d(nodes).astype(int)
+	paths = np.full((len(nodes), len(tree.stepTimes)), -1, dtype=int)
+	rows = np.where(nodes >= 0)[0]
+	current = nodes[rows]
+	while len(rows) > 0:
+		paths[rows, tree.stepIndex[current]] = current
+		following = tree.descendant[current]
+		alive = following >= 0
+		if not followMergers:
+			alive[alive] = tree.progenitor[following[alive]] == current[alive]
+		rows, current = rows[alive], following[alive]
+	return paths
+
+def queryForwardHistories(tree, paths, timesteps, bhString="bh('BH_mass', 'max', 'BH_central')", keys=None, hasBH=True):
+	"""
+	The database half of makeForwardHistories.  Every step is queried once, for all of the traced halos in it.
+
+	:arg paths - the output of traceDescendants
+	:arg timesteps - the timesteps of the simulation, in the order of the tree
+
+	:kwarg hasBH - whether to include the keys that need a black hole.  Steps where a halo has no black hole are then
+	left out of its history, as stitched_reverse_property_cascade leaves out halos without every property.
+
+	:returns rawHistories - for each row of paths, the same as the output of queryHistory, or None if no step had
+	everything asked for.  Columns go back in time, as makeHistory expects.
+	"""
+
+	schema = getPropertySchema(tree.simulationName)
+	allRawProperties, usedKeys = selectQuery(schema, keys, hasBH, bhString)
+
+	import tangos as db
+	from tangos import live_calculation
+	session = db.core.get_default_session()
+	calculation = live_calculation.parser.parse_property_names(*allRawProperties)
+
+	gathered = [[] for row in range(len(paths))]
+	for s_index in range(paths.shape[1]):
+		rows = np.where(paths[:,s_index] >= 0)[0]
+		if len(rows) == 0:
+			continue
+		print "Gathering {0} halos at step {1}.".format(len(rows), timesteps[s_index].extension)
+		#Only the traced halos are fetched, not the whole step.
+		haloIds = tree.haloIds[paths[rows,s_index]]
+		halos = session.query(db.core.Halo).filter(db.core.Halo.id.in_(haloIds.tolist())).all()
+		if len(halos) == 0:
+			continue
+		try:
+			values = calculation.values(halos)
+		except NoResultsError:
+			continue
+		matchedRows, matchedResults = crossmatch(haloIds, np.array([halo.id for halo in halos]))
+		for row, r_index in zip(rows[matchedRows], matchedResults):
+			#As gather_property, halos without every property are left out.
+			if all([value is not None for value in values[:,r_index]]):
+				gathered[row].append((s_index, list(values[:,r_index])))
+
+	rawHistories = []
+	for steps in gathered:
+		if len(steps) == 0:
+			rawHistories.append(None)
+			continue
+		steps = sorted(steps, key=lambda entry: -entry[0])
+		rawColumns = dict([(expression, [values[e_index] for s_index, values in steps]) \
+		for e_index, expression in enumerate(allRawProperties)])
+		rawHistories.append((rawColumns, schema, usedKeys))
+	return rawHistories
+
+def makeForwardHistories(step, haloNumbers=None, tree=None, bhString="bh('BH_mass', 'max', 'BH_central')", keys=None, \
+	hasBH=True, followMergers=True, pickleName=None):
+	"""
+	Follow halos of an early step forward in time and make a historyBook for each.
+
+	:arg step - the timestep to start from
+
+	:kwarg haloNumbers - the halos to follow.  Default is those that pass haloSelection.suitabilityCuts.
+	:kwarg tree - a MergerTree of the simulation.  Default is MergerTree.fromSimulation.
+	:kwarg bhString - the selection of black hole to use
+	:kwarg keys - the keys of each historyBook to build, as in makeHistory
+	:kwarg hasBH - whether to include the keys that need a black hole
+	:kwarg followMergers - keep following a halo after it merges into a bigger one
+	:kwarg pickleName - if given, the collection is also pickled to this file
+
+	:returns historyCollection - historyBooks keyed by starting halo number, with 'failedHaloNumbers' and
+	'descendantHaloNumbers', which gives the step extension and halo number each halo was last traced to
+	"""
+
+	if tree is None:
+		tree = MergerTree.fromSimulation(step.simulation)
+	if haloNumbers is None:
+		haloNumbers = defaultSelector.select(step, suitabilityCuts(requireBH=hasBH))
+	haloNumbers = np.atleast_1d(haloNumbers).astype(int)
+	stepIndex = np.where(tree.stepExtensions == step.extension)[0][0]
+
+	paths = traceDescendants(tree, tree.findNodes(np.full(len(haloNumbers), stepIndex), haloNumbers), followMergers=followMergers)
+	rawHistories = queryForwardHistories(tree, paths, step.simulation.timesteps, bhString=bhString, keys=keys, hasBH=hasBH)
+
+	historyCollection = {}
+	failedHaloNumbers = []
+	descendantHaloNumbers = {}
+	for haloNumber, path, rawHistory in zip(haloNumbers, paths, rawHistories):
+		if rawHistory is None:
+			print "Halo number {0} FAILED".format(haloNumber)
+			failedHaloNumbers.append(int(haloNumber))
+			continue
+		rawColumns, schema, usedKeys = rawHistory
+		historyCollection[int(haloNumber)] = assembleHistory(rawColumns, schema, usedKeys, bhString=bhString)
+		lastNode = path[path >= 0][-1]
+		descendantHaloNumbers[int(haloNumber)] = (tree.stepExtensions[tree.stepIndex[lastNode]], int(tree.haloNumber[lastNode]))
+	historyCollection['failedHaloNumbers'] = failedHaloNumbers
+	historyCollection['descendantHaloNumbers'] = descendantHaloNumbers
+
+	if pickleName is not None:
+		with open(pickleName, 'w') as myfile:
+			pickle.dump(historyCollection, myfile)
+		print "Saved to {0}.".format(pickleName)
+	return historyCollection
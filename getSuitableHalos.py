@@ -4,37 +4,21 @@ ARR: 09.15.17
 Determines the halos which are suitable for tracking backwards in time.
 """
 
-import tangos as db
-import numpy as np
-from util import crossmatch
+from haloSelection import defaultSelector, suitabilityCuts
 
-def getSuitableHalos(step, minStellarMass=1e8, contaminationTolerance=0.05, minDarkParticles=1e4, requireBH=True):
+def getSuitableHalos(step, minStellarMass=1e8, contaminationTolerance=0.05, minDarkParticles=1e4, requireBH=True, selector=None):
         """
         Given a time step, return a list of halos.
-        """
 
-        #Making sure that we're in the zoom-in region, and not too contaminated.
-	if contaminationTolerance is None:
-		if requireBH:
-			hid, mstar, ndm, mbh = step.gather_property('halo_number()', 'Mstar', 'NDM()', "bh().BH_mass")
-			goodHalos = (mstar >= minStellarMass) & (ndm >= minDarkParticles) & (mbh > 0)
-		else:
-			hid, mstar, ndm = step.gather_property('halo_number()', 'Mstar', 'NDM()')
-			goodHalos = (mstar >= minStellarMass) & (ndm >= minDarkParticles)
-	else:
-		if requireBH:
-			hid, mstar, ndm, mbh, contamination = step.gather_property('halo_number()', 'Mstar', 'NDM()', "bh().BH_mass", 'contamination_fraction')
-			goodHalos = (contamination < contaminationTolerance) & (mstar >= minStellarMass) & (ndm >= minDarkParticles) & (mbh > 0)
-		else:
-			hid, mstar, ndm, contamination = step.gather_property('halo_number()', 'Mstar', 'NDM()', 'contamination_fraction')
-			goodHalos = (contamination < contaminationTolerance) & (mstar >= minStellarMass) & (ndm >= minDarkParticles)
+	:kwarg selector - a haloSelection.HaloSelector holding the columns gathered so far.  Default is one shared by
+	every call, so selecting again at the same step with other thresholds does not go back to the database.
+        """
 
-        goodHaloNumbers = hid[goodHalos]
-        goodHaloMasses = mstar[goodHalos]
-        order = np.flipud(np.argsort(goodHaloMasses))
-        finalHaloNumbers = goodHaloNumbers[order]
+	if selector is None:
+		selector = defaultSelector
 
-        #Because halo_number() does not always increase by 1, I must convert to indices.
-        allHaloNumbers, = step.gather_property('halo_number()')
-        finalHaloIndices = crossmatch(finalHaloNumbers, allHaloNumbers)[1]
-	return [step.halos[i] for i in finalHaloIndices]
+        #Making sure that we're in the zoom-in region, and not too contaminated.
+	cuts = suitabilityCuts(minStellarMass=minStellarMass, contaminationTolerance=contaminationTolerance, \
+	minDarkParticles=minDarkParticles, requireBH=requireBH)
+	finalHaloNumbers = selector.select(step, cuts, orderBy='Mstar')
+	return selector.halos(step, finalHaloNumbers)
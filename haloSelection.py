@@ -0,0 +1,159 @@
+"""
+ARR: 10.19.26
+
+Select halos at many timesteps with arbitrary cuts on their properties.  The properties of each step are gathered
+from the database once, aligned by halo number, and kept, so trying other thresholds costs no more queries.
+"""
+
+import numpy as np
+from util import crossmatch
+from util.cache import cachePath, loadCache, saveCache
+
+#Cuts are (expression, predicate) pairs.  The predicate takes the column of the expression and returns a boolean mask.
+#Halos for which tangos has no value of an expression get nan, which fails every comparison below.
+def atLeast(value):
+	return lambda column: column >= value
+
+def greaterThan(value):
+	return lambda column: column > value
+
+def lessThan(value):
+	return lambda column: column < value
+
+def between(lower, upper):
+	return lambda column: (column >= lower) & (column < upper)
+
+def suitabilityCuts(minStellarMass=1e8, contaminationTolerance=0.05, minDarkParticles=1e4, requireBH=True):
+	"""
+	The cuts of getSuitableHalos.
+
+	:returns cuts - list of (expression, predicate)
+	"""
+
+	cuts = [('Mstar', atLeast(minStellarMass)), ('NDM()', atLeast(minDarkParticles))]
+	if requireBH:
+		cuts.append(('bh().BH_mass', greaterThan(0)))
+	if contaminationTolerance is not None:
+		cuts.append(('contamination_fraction', lessThan(contaminationTolerance)))
+	return cuts
+
+class HaloSelector(object):
+	"""
+	Columns of halo properties for any number of timesteps, each aligned with the halo numbers of its step.  Columns
+	are kept until forget is called, so properties written to the database after they were gathered are not seen.
+	"""
+
+	def __init__(self, useCache=False, cacheDirectory=None):
+		"""
+		:kwarg useCache - also keep the columns on disk with util.cache, so that other jobs can use them
+		:kwarg cacheDirectory - where cache files go.  Default is util.cache.defaultCacheDirectory.
+		"""
+
+		self.useCache = useCache
+		self.cacheDirectory = cacheDirectory
+		self.stepColumns = {}
+
+	def _stepKey(self, step):
+		return (step.simulation.basename, step.extension)
+
+	def _cacheFile(self, step):
+		return cachePath('haloColumns', step.simulation.basename, stepName=step.extension, cacheDirectory=self.cacheDirectory)
+
+	def columns(self, step, expressions):
+		"""
+		The columns of some expressions at a step.  Only those not already known are gathered.
+
+		:arg step - a timestep of type tangos.core.TimeStep
+		:arg expressions - list of strings that gather_property understands
+
+		:returns columns - dictionary of arrays, including 'halo_number()', in the order of step.halos
+		"""
+
+		key = self._stepKey(step)
+		if key not in self.stepColumns:
+			stored = loadCache(self._cacheFile(step)) if self.useCache else None
+			if stored is None:
+				haloNumbers, = step.gather_property('halo_number()')
+				stored = {'halo_number()': np.array(haloNumbers)}
+			self.stepColumns[key] = stored
+		stored = self.stepColumns[key]
+
+		missing = [expression for expression in expressions if expression not in stored]
+		for expression in missing:
+			#Gather each expression on its own, so that a halo lacking one property does not drop out of the others.
+			haloNumbers, values = step.gather_property('halo_number()', expression)
+			values = np.array(values, dtype=float)
+			#Vectors, like shrink_center, get one row per halo.
+			column = np.full((len(stored['halo_number()']),) + values.shape[1:], np.nan)
+			if len(haloNumbers) > 0:
+				matchedHere, matchedAll = crossmatch(np.array(haloNumbers), stored['halo_number()'])
+				column[matchedAll] = values[matchedHere]
+			stored[expression] = column
+		if (len(missing) > 0) and self.useCache:
+			saveCache(self._cacheFile(step), stored)
+
+		return dict([(expression, stored[expression]) for expression in ['halo_number()'] + list(expressions)])
+
+	def select(self, step, cuts, orderBy='Mstar', descending=True):
+		"""
+		The halo numbers at a step that pass every cut.
+
+		:arg cuts - list of (expression, predicate)
+
+		:kwarg orderBy - expression to sort the selection by, or None to keep the order of step.halos
+		:kwarg descending - sort from largest to smallest
+
+		:returns haloNumbers
+		"""
+
+		expressions = [expression for expression, predicate in cuts]
+		if (orderBy is not None) and (orderBy not in expressions):
+			expressions.append(orderBy)
+		columns = self.columns(step, expressions)
+
+		passing = np.ones(len(columns['halo_number()']), dtype=bool)
+		with np.errstate(invalid='ignore'):
+			for expression, predicate in cuts:
+				passing &= predicate(columns[expression])
+		selected = np.where(passing)[0]
+
+		if orderBy is not None:
+			order = np.argsort(columns[orderBy][selected], kind='mergesort')
+			if descending:
+				order = np.flipud(order)
+			selected = selected[order]
+		return columns['halo_number()'][selected]
+
+	def selectMany(self, steps, cuts, orderBy='Mstar', descending=True):
+		"""
+		select at each of several steps.
+
+		:returns selections - dictionary of halo numbers, keyed by step extension
+		"""
+
+		return dict([(step.extension, self.select(step, cuts, orderBy=orderBy, descending=descending)) for step in steps])
+
+	def halos(self, step, haloNumbers):
+		"""
+		The halos of a step with some halo numbers.  crossmatch returns them in order of halo number.
+		"""
+
+		#Because halo_number() does not always increase by 1, I must convert to indices.
+		allHaloNumbers = self.columns(step, [])['halo_number()']
+		haloIndices = crossmatch(np.array(haloNumbers), allHaloNumbers)[1]
+		return [step.halos[i] for i in haloIndices]
+
+	def forget(self, step=None):
+		"""
+		Drop the columns of one step, or of all of them, so that they are gathered again the next time they are needed.
+		Call this after writing new properties to the database.  Columns cached on disk with useCache are kept.
+		"""
+
+		if step is None:
+			self.stepColumns = {}
+		else:
+			self.stepColumns.pop(self._stepKey(step), None)
+
+#Shared by calls to getSuitableHalos that do not bring their own.  createHistoryCollection forgets it at the start of
+#every job.
+defaultSelector = HaloSelector()
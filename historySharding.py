@@ -0,0 +1,188 @@
+"""
+ARR: 10.19.26
+
+Split one build of createHistoryCollection over independent jobs.  Halos are assigned to shards by a stable hash of
+their halo numbers, so every job agrees on the assignment without talking to the others.  Each shard writes its own
+collection and a JSON manifest when it is done, and mergeHistoryShards checks the manifests, combines the shards and
+runs the cluster environment stage once.
+"""
+
+import os
+import json
+import zlib
+import numpy as np
+from historyStorage import HistoryCollectionWriter, loadHistoryCollection
+from mergerCatalogue import buildMergerCatalogue
+
+def shardOf(haloNumber, nShards):
+	"""
+	The shard of a halo number.  crc32 is the same on every machine and every run, unlike hash.
+	"""
+
+	return (zlib.crc32(str(int(haloNumber))) & 0xffffffff) % nShards
+
+def shardFileName(pickleName, shardIndex, nShards):
+	return '{0}.shard{1}of{2}'.format(pickleName, shardIndex, nShards)
+
+def manifestFileName(pickleName, shardIndex, nShards):
+	return shardFileName(pickleName, shardIndex, nShards) + '.manifest.json'
+
+def writeManifest(fileName, manifest):
+	"""
+	Write a manifest under a temporary name first, so that a manifest only exists once its shard is complete.
+	"""
+
+	temporaryName = fileName + '.tmp{0}'.format(os.getpid())
+	with open(temporaryName, 'w') as myfile:
+		json.dump(manifest, myfile, indent=1, sort_keys=True)
+	os.rename(temporaryName, fileName)
+
+def readManifest(fileName):
+	"""
+	Read a manifest.  Returns None if it does not exist.
+	"""
+
+	if not os.path.exists(fileName):
+		return None
+	with open(fileName, 'r') as myfile:
+		return json.load(myfile)
+
+def checkShards(pickleName, nShards):
+	"""
+	Read the manifests of every shard and make sure that together they cover one build.
+
+	:returns manifests - one per shard
+	"""
+
+	manifests = [readManifest(manifestFileName(pickleName, s_index, nShards)) for s_index in range(nShards)]
+	missing = [s_index for s_index, manifest in enumerate(manifests) if manifest is None]
+	if len(missing) > 0:
+		raise IOError("Shards {0} of {1} have no manifest.  They are still running or did not finish.".format(missing, nShards))
+
+	#Every shard must come from the same build, with the same selection and stitching.
+	for field in ['simulation', 'step', 'nShards', 'keys', 'computeMergers', 'minStellarMass', 'contaminationTolerance', \
+		'minDarkParticles', 'requireBH', 'maximumSkips', 'cutoffDistance', 'bhString']:
+		values = set([json.dumps(manifest.get(field)) for manifest in manifests])
+		if len(values) > 1:
+			raise ValueError("The shards of {0} disagree on {1}: {2}".format(pickleName, field, sorted(values)))
+
+	seen = set()
+	for s_index, manifest in enumerate(manifests):
+		if manifest['shardIndex'] != s_index:
+			raise ValueError("The manifest of shard {0} says it is shard {1}.".format(s_index, manifest['shardIndex']))
+		selected = set(manifest['selectedHaloNumbers'])
+		finished = set(manifest['writtenHaloNumbers']) | set(manifest['failedHaloNumbers'])
+		if finished != selected:
+			raise ValueError("Shard {0} did not finish halo numbers {1}.".format(s_index, sorted(selected - finished)))
+		strays = [haloNumber for haloNumber in selected if shardOf(haloNumber, nShards) != s_index]
+		if len(strays) > 0:
+			raise ValueError("Shard {0} has halo numbers {1} of other shards.".format(s_index, sorted(strays)))
+		if len(seen & selected) > 0:
+			raise ValueError("Halo numbers {0} are in more than one shard.".format(sorted(seen & selected)))
+		seen |= selected
+		if not os.path.exists(manifest['output']):
+			raise IOError("The output of shard {0}, {1}, is missing.".format(s_index, manifest['output']))
+	return manifests
+
+def mergeTraceabilityReports(reports):
+	"""
+	Combine the traceability reports of the shards.  JSON turned their halo numbers into strings.
+	"""
+
+	from traceability import TRACEABLE, PARTIAL, UNTRACEABLE
+
+	merged = {TRACEABLE: [], PARTIAL: [], UNTRACEABLE: [], 'truncationTimes': {}, 'truncationSteps': {}}
+	for report in reports:
+		for status in [TRACEABLE, PARTIAL, UNTRACEABLE]:
+			merged[status].extend(report[status])
+		for field in ['truncationTimes', 'truncationSteps']:
+			merged[field].update(dict([(int(haloNumber), value) for haloNumber, value in report[field].items()]))
+	return merged
+
+def mergeHistoryShards(pickleName, nShards, step=None, computeRamPressure=None, compact=None, compactDtype=np.float32, \
+	removeShards=False, pyramids=False, hostHaloNumbers=None):
+	"""
+	Combine the shards of a build into one collection, written with HistoryCollectionWriter, and add the distance from
+	the cluster and the ram pressure to every historyBook.  Historybooks are read and written one at a time.
+
+	:arg pickleName - the pickleName given to createHistoryCollection
+	:arg nShards - the number of shards
+
+	:kwarg step - the timestep the collection starts from, for the ClusterProfiler.  Default is looked up with the
+	simulation and step in the manifests.
+	:kwarg computeRamPressure - default is what the shards were asked for
+	:kwarg compact - save compact historyBooks.  Default is what the shards were asked for.
+	:kwarg compactDtype - the dtype for rates and positions in compact output
+	:kwarg removeShards - delete the shards and their manifests once the merge is written
+	:kwarg pyramids - also store decimation pyramids of every historyBook, for HistoryCollectionReader.slice
+	:kwarg hostHaloNumbers - the hosts of hostEnvironment.HostEnvironment.  Default is what the shards were asked for.
+
+	:returns manifests - one per shard
+	"""
+
+	manifests = checkShards(pickleName, nShards)
+	if computeRamPressure is None:
+		computeRamPressure = any([manifest['computeRamPressure'] for manifest in manifests])
+	if compact is None:
+		compact = any([manifest['compact'] for manifest in manifests])
+
+	if hostHaloNumbers is None:
+		hostHaloNumbers = manifests[0].get('hostHaloNumbers')
+	clusterShards = [manifest for manifest in manifests if manifest['hasCluster'] and (1 in manifest['writtenHaloNumbers'])]
+	if (step is None) and ((len(clusterShards) > 0) or (hostHaloNumbers is not None)):
+		import tangos as db
+		step = db.get_timestep('{0}/{1}'.format(manifests[0]['simulation'], manifests[0]['step']))
+
+	#The environment stages are the ones that need halos of more than one shard.
+	environment = None
+	if len(clusterShards) > 0:
+		from makeHistoryCollection import ClusterEnvironment
+		print "Computing cluster distances."
+		shardCollection = loadHistoryCollection(clusterShards[0]['output'], lazy=True)
+		environment = ClusterEnvironment(shardCollection[1], step, computeRamPressure=computeRamPressure)
+	hosts = None
+	if hostHaloNumbers is not None:
+		from hostEnvironment import HostEnvironment
+		hostBooks = {}
+		for manifest in manifests:
+			shardHosts = [haloNumber for haloNumber in hostHaloNumbers if haloNumber in manifest['writtenHaloNumbers']]
+			if len(shardHosts) > 0:
+				shardCollection = loadHistoryCollection(manifest['output'], lazy=True)
+				hostBooks.update([(haloNumber, shardCollection[haloNumber]) for haloNumber in shardHosts])
+		print "Computing the environment among {0} hosts.".format(len(hostBooks))
+		hosts = HostEnvironment(hostBooks, step, computeRamPressure=computeRamPressure)
+
+	mergerSummaries = {}
+	failedHaloNumbers = []
+	with HistoryCollectionWriter(pickleName, compact=compact, compactDtype=compactDtype, pyramids=pyramids) as writer:
+		for manifest in manifests:
+			print "Merging shard {0} of {1}.".format(manifest['shardIndex'], nShards)
+			shardCollection = loadHistoryCollection(manifest['output'], lazy=True)
+			for haloNumber in manifest['writtenHaloNumbers']:
+				historyBook = shardCollection[haloNumber]
+				if (environment is not None) and (haloNumber != 1):
+					environment.addTo(historyBook)
+				if hosts is not None:
+					hosts.addTo(historyBook, haloNumber)
+				writer.write(haloNumber, historyBook)
+				if 'mergerTimes' in historyBook:
+					mergerSummaries[haloNumber] = {'mergerTimes': historyBook['mergerTimes'], \
+					'mergerRatios': historyBook['mergerRatios'], 'mergerProgenitors': historyBook['mergerProgenitors']}
+			failedHaloNumbers.extend(manifest['failedHaloNumbers'])
+			if hasattr(shardCollection, 'close'):
+				shardCollection.close()
+		writer.write('failedHaloNumbers', sorted(failedHaloNumbers))
+		reports = [manifest['traceability'] for manifest in manifests if manifest.get('traceability') is not None]
+		if len(reports) > 0:
+			writer.write('traceability', mergeTraceabilityReports(reports))
+		if manifests[0]['computeMergers']:
+			writer.write('mergerCatalogue', buildMergerCatalogue(mergerSummaries))
+
+	print "Merged {0} halos from {1} shards into {2}.".format(sum([len(manifest['writtenHaloNumbers']) \
+	for manifest in manifests]), nShards, pickleName)
+
+	if removeShards:
+		for manifest in manifests:
+			os.remove(manifest['output'])
+			os.remove(manifestFileName(pickleName, manifest['shardIndex'], nShards))
+	return manifests
@@ -0,0 +1,396 @@
+"""
+ARR: 10.19.26
+
+Stacked statistics of the histories in a collection made by createHistoryCollection.  Histories of
+one collection share the same time axis, so every statistic is computed for all time bins and all
+selections of halos at once.
+"""
+
+import numpy as np
+from historyStorage import loadHistoryCollection, expandHistory
+from derivedQuantities import derivedQuantities, computeDerivedQuantity, DerivedHistoryBook
+
+#The number of bootstrap resamplings whose weighted percentiles are computed together.  Each needs arrays the size of
+#the whole collection, so this bounds the memory of a bootstrap.
+bootstrapChunkSize = 16
+
+class HistoryStatistics(object):
+
+	def __init__(self, historyCollection, onlyWhileTracked=True):
+		"""
+		:arg historyCollection - a collection made by createHistoryCollection, or the name of its file
+
+		:kwarg onlyWhileTracked - ignore the bins before the earliest step along each halo's main branch.  Otherwise
+		the zeros and infinities that fill those bins are included.
+		"""
+
+		if isinstance(historyCollection, str):
+			historyCollection = loadHistoryCollection(historyCollection)
+		self.historyCollection = historyCollection
+		self.haloNumbers = np.array(sorted([key for key in historyCollection.keys() if isinstance(key, int)]))
+		self.onlyWhileTracked = onlyWhileTracked
+		self._stacks = {}
+		self._cache = {}
+
+	def clearCache(self):
+		"""
+		Forget stacked arrays and results, e.g. after the collection has been changed.
+		"""
+
+		self._stacks = {}
+		self._cache = {}
+
+	def select(self, key='Mstar', minimum=-np.inf, maximum=np.inf, index=-1):
+		"""
+		Select halos by the value of a key in one time bin.  The default is by final stellar mass.
+
+		:returns haloNumbers - the halos with minimum <= value < maximum
+		"""
+
+		time, values = self.stack(key)
+		chosen = (values[:,index] >= minimum) & (values[:,index] < maximum)
+		return self.haloNumbers[chosen]
+
+	def stack(self, key, haloNumbers=None):
+		"""
+		Stack a key of many historyBooks into one array.
+
+		:arg key - a key of the historyBooks, a derived quantity, or a function that takes a historyBook and returns a
+		series on its time axis.  Derived quantities are computed once from the stacks of their dependencies.
+
+		:kwarg haloNumbers - the halos to stack.  None means all of them.
+
+		:returns time - the shared time axis
+		:returns values - array of shape (number of halos, number of time bins), with nan where there is no data
+		"""
+
+		if key not in self._stacks:
+			if self._isDerived(key):
+				time = self.stack('time')[0]
+				values = computeDerivedQuantity(key, lambda dependency: time if dependency == 'time' else self.stack(dependency)[1])
+				self._stacks[key] = (time, values)
+			else:
+				self._stacks[key] = _stackCollection(self.historyCollection, self.haloNumbers, key, self.onlyWhileTracked)
+		time, values = self._stacks[key]
+		if haloNumbers is None:
+			return time, values
+		return time, values[np.searchsorted(self.haloNumbers, np.atleast_1d(haloNumbers))]
+
+	def _isDerived(self, key):
+		"""
+		Whether key is a derived quantity that is not stored in the historyBooks.
+		"""
+
+		if (not isinstance(key, str)) or (key not in derivedQuantities) or (len(self.haloNumbers) == 0):
+			return False
+		return key not in self.historyCollection[self.haloNumbers[0]]
+
+	def percentiles(self, key, percentiles=[16,50,84], selections=None, weights=None):
+		"""
+		Weighted percentiles of a key in every time bin.
+
+		:arg key - as in stack
+		:kwarg percentiles - the percentiles to compute, from 0 to 100
+		:kwarg selections - a list of halo number lists, each of which gets its own statistics.  None means all halos.
+		:kwarg weights - a key whose final value weighs each halo, or an array of weights for all halos.  None weighs
+		halos equally.
+
+		:returns time - the shared time axis
+		:returns output - array of shape (selections, percentiles, time bins).  If selections is None, the first axis is dropped.
+		"""
+
+		return self._cachedStatistic('percentiles', key, tuple(np.atleast_1d(percentiles)), selections, weights)
+
+	def median(self, key, selections=None, weights=None):
+		"""
+		Weighted median of a key in every time bin.  Arguments are as in percentiles.
+		"""
+
+		time, output = self.percentiles(key, percentiles=[50], selections=selections, weights=weights)
+		return time, output[...,0,:]
+
+	def mean(self, key, selections=None, weights=None):
+		"""
+		Weighted mean of a key in every time bin.  Arguments are as in percentiles.
+		"""
+
+		return self._cachedStatistic('mean', key, (), selections, weights)
+
+	def bootstrapError(self, key, statistic='median', selections=None, weights=None, nBootstrap=200, seed=0):
+		"""
+		Standard deviation of a statistic over bootstrap resamplings of the halos.  All resamplings are done in the
+		same vectorized pass, as multinomial weights.
+
+		:kwarg statistic - 'median', 'mean', or a number between 0 and 100 for that percentile
+		:kwarg nBootstrap - the number of resamplings
+		:kwarg seed - seed for the random number generator, so results can be cached
+
+		:returns time - the shared time axis
+		:returns error - array of shape (selections, time bins).  If selections is None, the first axis is dropped.
+		"""
+
+		return self._cachedStatistic('bootstrap', key, (statistic, nBootstrap, seed), selections, weights)
+
+	def binnedBy(self, key, binKey='Mstar', binEdges=10**np.arange(8,13.5,0.5), statistic='median', index=-1, weights=None):
+		"""
+		A statistic of key, for halos binned by the value of binKey in one time bin (by default, the final stellar mass).
+
+		:returns time - the shared time axis
+		:returns binEdges - the edges of the bins
+		:returns output - array with the statistic for each bin along the first axis
+		"""
+
+		selections = [self.select(binKey, binEdges[i], binEdges[i+1], index=index) for i in range(len(binEdges)-1)]
+		if statistic == 'mean':
+			time, output = self.mean(key, selections=selections, weights=weights)
+		elif statistic == 'median':
+			time, output = self.median(key, selections=selections, weights=weights)
+		else:
+			time, output = self.percentiles(key, percentiles=statistic, selections=selections, weights=weights)
+		return time, binEdges, output
+
+	def _cachedStatistic(self, name, key, arguments, selections, weights):
+		"""
+		Compute a statistic, or return it from the cache if this key, selection and weighting have been done before.
+		"""
+
+		cacheable = isinstance(key, str) and ((weights is None) or isinstance(weights, str))
+		if selections is None:
+			selectionKey = None
+		else:
+			selectionKey = tuple([tuple(sorted(np.atleast_1d(selection).tolist())) for selection in selections])
+		cacheKey = (name, key, arguments, selectionKey, weights)
+		if cacheable and (cacheKey in self._cache):
+			return self._cache[cacheKey]
+
+		time, values = self.stack(key)
+		selectionWeights = self._selectionWeights(selections, weights)
+		if name == 'percentiles':
+			output = weightedPercentiles(values, selectionWeights, arguments)
+		elif name == 'mean':
+			output = weightedMean(values, selectionWeights)
+		elif name == 'bootstrap':
+			output = self._bootstrap(values, selectionWeights, *arguments)
+		if selections is None:
+			output = output[0]
+
+		if cacheable:
+			self._cache[cacheKey] = (time, output)
+		return time, output
+
+	def _selectionWeights(self, selections, weights):
+		"""
+		Turn selections and weights into one array of shape (selections, halos).
+		"""
+
+		if weights is None:
+			haloWeights = np.ones(len(self.haloNumbers))
+		elif isinstance(weights, str):
+			haloWeights = self.stack(weights)[1][:,-1]
+		else:
+			haloWeights = np.asarray(weights, dtype=float)
+
+		if selections is None:
+			return haloWeights[np.newaxis,:]
+		output = np.zeros((len(selections), len(self.haloNumbers)))
+		for s_index, selection in enumerate(selections):
+			chosen = np.in1d(self.haloNumbers, selection)
+			output[s_index,chosen] = haloWeights[chosen]
+		return output
+
+	def _bootstrap(self, values, selectionWeights, statistic, nBootstrap, seed):
+		random = np.random.RandomState(seed)
+		output = np.zeros((selectionWeights.shape[0], values.shape[1]))
+		for s_index in range(selectionWeights.shape[0]):
+			members = np.where(selectionWeights[s_index] > 0)[0]
+			if len(members) == 0:
+				output[s_index] = np.nan
+				continue
+
+			#Each resampling is a set of multinomial counts over the members of the selection.
+			counts = np.zeros((nBootstrap, len(self.haloNumbers)))
+			counts[:,members] = random.multinomial(len(members), np.ones(len(members))/len(members), size=nBootstrap)
+			resampledWeights = counts * selectionWeights[s_index]
+			resampled = np.zeros((nBootstrap, values.shape[1]))
+			for c_index in range(0, nBootstrap, bootstrapChunkSize):
+				chunk = resampledWeights[c_index:c_index+bootstrapChunkSize]
+				if statistic == 'mean':
+					resampled[c_index:c_index+bootstrapChunkSize] = weightedMean(values, chunk)
+				else:
+					q = 50 if statistic == 'median' else statistic
+					resampled[c_index:c_index+bootstrapChunkSize] = weightedPercentiles(values, chunk, [q])[:,0,:]
+			output[s_index] = np.nanstd(resampled, axis=0)
+		return output
+
+class StreamingHistoryStatistics(object):
+
+	def __init__(self, key, valueEdges=np.logspace(-15,15,601), nTimeBins=None):
+		"""
+		Statistics of one key accumulated a historyBook at a time, for collections too large for memory.  Means are
+		exact.  Percentiles are interpolated within a fixed set of value bins, so their accuracy is set by valueEdges.
+
+		:arg key - a key of the historyBooks, a derived quantity, or a function that takes a historyBook and returns a
+		series
+
+		:kwarg valueEdges - the edges of the value bins used for percentiles.  Values outside are counted in the first
+		or last bin.
+		:kwarg nTimeBins - the length of the time axis.  None takes it from the first book added.
+		"""
+
+		self.key = key
+		self.valueEdges = np.asarray(valueEdges, dtype=float)
+		self.time = None
+		self._nTimeBins = nTimeBins
+		self._weightSum = None
+		self._valueSum = None
+		self._histogram = None
+
+	def add(self, historyBook, weight=1.0, onlyWhileTracked=True):
+		"""
+		Add one historyBook to the running totals.
+		"""
+
+		historyBook = expandHistory(historyBook)
+		values = _seriesWhileTracked(historyBook, self.key, onlyWhileTracked)
+		if self._weightSum is None:
+			nTimeBins = self._nTimeBins if self._nTimeBins is not None else len(values)
+			self.time = np.array(historyBook['time'][-nTimeBins:])
+			self._weightSum = np.zeros(nTimeBins)
+			self._valueSum = np.zeros(nTimeBins)
+			self._histogram = np.zeros((len(self.valueEdges)-1, nTimeBins))
+
+		#Align the ends of the time axes.
+		values = _alignEnd(values, len(self._weightSum))
+		valid = np.isfinite(values)
+		timeIndices = np.where(valid)[0]
+		self._weightSum[valid] += weight
+		self._valueSum[valid] += weight * values[valid]
+		valueIndices = np.clip(np.searchsorted(self.valueEdges, values[valid], side='right')-1, 0, len(self.valueEdges)-2)
+		np.add.at(self._histogram, (valueIndices, timeIndices), weight)
+
+	def addAll(self, historyBooks, weights=None, onlyWhileTracked=True):
+		"""
+		Add every historyBook of an iterable, e.g. one that reads them from disk one at a time.
+		"""
+
+		for b_index, historyBook in enumerate(historyBooks):
+			self.add(historyBook, weight=1.0 if weights is None else weights[b_index], onlyWhileTracked=onlyWhileTracked)
+
+	def mean(self):
+		"""
+		:returns time, mean - the weighted mean in each time bin
+		"""
+
+		with np.errstate(invalid='ignore', divide='ignore'):
+			return self.time, self._valueSum / self._weightSum
+
+	def percentiles(self, percentiles=[16,50,84]):
+		"""
+		:returns time, output - array of shape (percentiles, time bins)
+		"""
+
+		cumulative = np.cumsum(self._histogram, axis=0)
+		output = np.full((len(np.atleast_1d(percentiles)), len(self.time)), np.nan)
+		for q_index, q in enumerate(np.atleast_1d(percentiles)):
+			target = q / 100.0 * self._weightSum
+			binIndex = np.argmax(cumulative >= target[np.newaxis,:] - 1e-12*self._weightSum[np.newaxis,:], axis=0)
+			columns = np.arange(len(self.time))
+			below = np.where(binIndex > 0, cumulative[binIndex-1,columns], 0.0)
+			inBin = self._histogram[binIndex,columns]
+			with np.errstate(invalid='ignore', divide='ignore'):
+				fraction = np.clip(np.where(inBin > 0, (target - below) / inBin, 0.0), 0, 1)
+			low = self.valueEdges[binIndex]
+			high = self.valueEdges[binIndex+1]
+			output[q_index] = np.where(self._weightSum > 0, low + fraction*(high - low), np.nan)
+		return self.time, output
+
+def weightedPercentiles(values, weights, percentiles):
+	"""
+	Weighted percentiles along the first axis of values, for several sets of weights at once.
+
+	:arg values - array of shape (halos, time bins).  nan entries are ignored.
+	:arg weights - array of shape (sets, halos)
+	:arg percentiles - the percentiles, from 0 to 100
+
+	:returns output - array of shape (sets, percentiles, time bins)
+	"""
+
+	values = np.asarray(values, dtype=float)
+	weights = np.atleast_2d(weights)
+
+	#nan sorts to the end and gets no weight.
+	order = np.argsort(values, axis=0)
+	sortedValues = np.take_along_axis(values, order, axis=0)
+	sortedWeights = weights[:,order] * np.isfinite(sortedValues)[np.newaxis,:,:]
+	cumulative = np.cumsum(sortedWeights, axis=1)
+	total = cumulative[:,-1,:]
+
+	columns = np.arange(values.shape[1])
+	output = np.full((weights.shape[0], len(percentiles), values.shape[1]), np.nan)
+	for q_index, q in enumerate(percentiles):
+		target = q / 100.0 * total
+		index = np.argmax(cumulative >= target[:,np.newaxis,:] - 1e-12*total[:,np.newaxis,:], axis=1)
+		output[:,q_index,:] = np.where(total > 0, sortedValues[index,columns[np.newaxis,:]], np.nan)
+	return output
+
+def weightedMean(values, weights):
+	"""
+	Weighted mean along the first axis of values, for several sets of weights at once.  Arguments are as in
+	weightedPercentiles.
+
+	:returns output - array of shape (sets, time bins)
+	"""
+
+	values = np.asarray(values, dtype=float)
+	weights = np.atleast_2d(weights)
+	valid = np.isfinite(values)
+	weightSum = np.dot(weights, valid)
+	with np.errstate(invalid='ignore', divide='ignore'):
+		return np.dot(weights, np.where(valid, values, 0.0)) / weightSum
+
+def _stackCollection(historyCollection, haloNumbers, key, onlyWhileTracked):
+	"""
+	Stack a key of the historyBooks of a collection into an array, aligning the ends of their time axes.
+	"""
+
+	series = []
+	time = None
+	for haloNumber in haloNumbers:
+		historyBook = historyCollection[haloNumber]
+		values = _seriesWhileTracked(historyBook, key, onlyWhileTracked)
+		if (time is None) or (len(historyBook['time']) > len(time)):
+			time = np.array(historyBook['time'])
+		series.append(values)
+
+	if time is None:
+		return np.array([]), np.zeros((0,0))
+	output = np.full((len(series), len(time)), np.nan)
+	for s_index, values in enumerate(series):
+		output[s_index] = _alignEnd(values, len(time))
+	return time, output
+
+def _seriesWhileTracked(historyBook, key, onlyWhileTracked):
+	"""
+	A series of a historyBook as floats, with nan before the earliest step of the main branch if requested.
+	"""
+
+	if callable(key):
+		values = np.array(key(historyBook), dtype=float)
+	elif (key not in historyBook) and (key in derivedQuantities):
+		values = np.array(DerivedHistoryBook(historyBook)[key], dtype=float)
+	else:
+		values = np.array(historyBook[key], dtype=float)
+	if values.ndim != 1:
+		raise ValueError("Statistics need a series with one value per time bin.")
+	if onlyWhileTracked and ('t_slice' in historyBook) and (len(historyBook['t_slice']) > 0):
+		values[np.asarray(historyBook['time']) < np.min(historyBook['t_slice'])] = np.nan
+	return values
+
+def _alignEnd(values, length):
+	"""
+	Pad or cut the beginning of a series so that it has the given length.
+	"""
+
+	if len(values) >= length:
+		return values[len(values)-length:]
+	return np.concatenate((np.full(length-len(values), np.nan), values))
@@ -0,0 +1,440 @@
+"""
+ARR: 10.19.26
+
+Compact storage of historyBooks.  Each series on the histogram time axis is trimmed of the constant fill
+(zero or infinity) it has before the halo exists, and rates and positions are stored at reduced precision.
+Compact books are expanded back to the dense layout when they are used.
+
+Collections can also be written one historyBook at a time with HistoryCollectionWriter, so that a
+collection never has to be held in memory, and read back one book at a time with HistoryCollectionReader.
+The writer can also keep min/max/mean decimation pyramids of every series, so that a time window can be read at
+the resolution it will be shown at without reading the historyBook.
+"""
+
+import os
+import struct
+import numpy as np
+import cPickle as pickle
+
+#The last bytes of a file written by HistoryCollectionWriter:  the offset of its index, then this marker.
+_streamMarker = 'HMSTREAM'
+_trailerFormat = '<Q8s'
+
+#These series are stored with the reduced precision dtype by default.
+reducedPrecisionKeys = ['SFR', 'BHAR', 'SSC', 'Vcom']
+
+#Keys that are never trimmed, since everything else is measured against them.
+_untrimmedKeys = ['time']
+
+#Pyramid levels are this many times coarser than the one before, and stop before they have fewer bins than this.
+pyramidFactor = 4
+pyramidMinimumLength = 8
+
+def isCompact(historyBook):
+	"""
+	Whether a historyBook was made by compactHistory.
+	"""
+
+	return isinstance(historyBook, dict) and historyBook.get('_compact', False)
+
+def compactHistory(historyBook, dtype=np.float32, reducedPrecisionKeys=reducedPrecisionKeys):
+	"""
+	Make a compact copy of a historyBook.
+
+	:arg historyBook - a dictionary made by makeHistory
+
+	:kwarg dtype - the dtype used for the keys in reducedPrecisionKeys
+	:kwarg reducedPrecisionKeys - the keys to store with dtype.  Everything else keeps its dtype.
+
+	:returns compactBook - a dictionary with the same keys, where series on the time axis start at their first valid bin.
+	The offsets and fill values needed to expand them are stored in '_offsets' and '_fills'.
+	"""
+
+	if isCompact(historyBook):
+		return historyBook
+
+	length = len(historyBook['time'])
+	compactBook = {'_compact': True, '_length': length, '_offsets': {}, '_fills': {}}
+	for key, value in historyBook.items():
+		if (key in _untrimmedKeys) or (not _isSeries(value, length)):
+			compactBook[key] = value
+			continue
+
+		#The fill is whatever is in the first bin, if it is one of the values used before a halo exists.
+		firstValues = np.atleast_1d(value[...,0])
+		if np.all(firstValues == 0):
+			fill = 0.0
+		elif np.all(np.isinf(firstValues)):
+			fill = firstValues.flat[0]
+		else:
+			fill = None
+
+		if fill is None:
+			offset = 0
+		else:
+			isValid = np.atleast_2d(value != fill).any(axis=0)
+			offset = np.argmax(isValid) if np.any(isValid) else length
+
+		if key in reducedPrecisionKeys:
+			storedType = dtype
+		else:
+			storedType = value.dtype
+		compactBook[key] = np.array(value[...,offset:], dtype=storedType)
+		compactBook['_offsets'][key] = offset
+		compactBook['_fills'][key] = fill
+	return compactBook
+
+def expandHistory(compactBook, dtype=np.float64):
+	"""
+	Restore the dense layout of a compact historyBook.  Dense historyBooks are returned unchanged.
+
+	:arg compactBook - a dictionary made by compactHistory
+
+	:kwarg dtype - the dtype of the expanded series
+
+	:returns historyBook - a dictionary in the layout made by makeHistory
+	"""
+
+	if not isCompact(compactBook):
+		return compactBook
+
+	length = compactBook['_length']
+	historyBook = {}
+	for key, value in compactBook.items():
+		if key in ['_compact', '_length', '_offsets', '_fills']:
+			continue
+		if key not in compactBook['_offsets']:
+			historyBook[key] = value
+			continue
+		offset = compactBook['_offsets'][key]
+		fill = compactBook['_fills'][key]
+		expanded = np.full(value.shape[:-1] + (length,), 0.0 if fill is None else fill, dtype=dtype)
+		expanded[...,offset:] = value
+		historyBook[key] = expanded
+	return historyBook
+
+def compactCollection(historyCollection, dtype=np.float32, reducedPrecisionKeys=reducedPrecisionKeys):
+	"""
+	compactHistory for every historyBook of a collection.  Other keys are kept as they are.
+	"""
+
+	return dict([(key, compactHistory(value, dtype=dtype, reducedPrecisionKeys=reducedPrecisionKeys)) \
+	if isinstance(key, int) else (key, value) for key, value in historyCollection.items()])
+
+def expandCollection(historyCollection, dtype=np.float64):
+	"""
+	expandHistory for every historyBook of a collection.
+	"""
+
+	return dict([(key, expandHistory(value, dtype=dtype)) if isinstance(key, int) else (key, value) \
+	for key, value in historyCollection.items()])
+
+def buildPyramids(historyBook, factor=pyramidFactor, minimumLength=pyramidMinimumLength):
+	"""
+	Decimation pyramids of every series of a historyBook on the histogram time axis.
+
+	:arg historyBook - a dictionary made by makeHistory
+
+	:kwarg factor - the number of bins of each level that make one bin of the next
+	:kwarg minimumLength - the fewest bins a level may have
+
+	:returns pyramids - dictionary with the full 'time' axis, 'levels', a list of (blockSize, tStart, tEnd, time) from
+	fine to coarse, and for each series, a list of (minimum, maximum, mean) with one entry per level
+	"""
+
+	historyBook = expandHistory(historyBook)
+	time = np.asarray(historyBook['time'], dtype=float)
+	length = len(time)
+	levels = []
+	blockSize = factor
+	while (length + blockSize - 1) // blockSize >= minimumLength:
+		starts = np.arange(0, length, blockSize)
+		counts = np.diff(np.append(starts, length))
+		levels.append((blockSize, starts, counts))
+		blockSize *= factor
+
+	pyramids = {'time': time, 'levels': [(blockSize, time[starts], time[starts+counts-1], np.add.reduceat(time, starts)/counts) \
+	for blockSize, starts, counts in levels]}
+	with np.errstate(invalid='ignore'):
+		for key, value in historyBook.items():
+			if (key in _untrimmedKeys) or (not _isSeries(value, length)):
+				continue
+			pyramids[key] = [(np.minimum.reduceat(value, starts, axis=-1), np.maximum.reduceat(value, starts, axis=-1), \
+			np.add.reduceat(value, starts, axis=-1)/counts) for blockSize, starts, counts in levels]
+	return pyramids
+
+def chooseLevel(pyramids, t0=None, t1=None, maxPoints=None):
+	"""
+	The finest resolution with at most maxPoints bins between t0 and t1:  None for the full resolution, or the index
+	of a level of the pyramids.  If even the coarsest level has too many, it is chosen.
+	"""
+
+	if maxPoints is None:
+		return None
+	t0 = -np.inf if t0 is None else t0
+	t1 = np.inf if t1 is None else t1
+	time = pyramids['time']
+	if np.searchsorted(time, t1, side='right') - np.searchsorted(time, t0, side='left') <= maxPoints:
+		return None
+	chosen = None
+	for l_index, (blockSize, tStart, tEnd, levelTime) in enumerate(pyramids['levels']):
+		chosen = l_index
+		if np.searchsorted(tStart, t1, side='right') - np.searchsorted(tEnd, t0, side='left') <= maxPoints:
+			break
+	return chosen
+
+def sliceSeries(historyBook, pyramids, key, t0=None, t1=None, maxPoints=None):
+	"""
+	A series between two times, at the finest resolution that has at most maxPoints bins in the window.
+
+	:arg historyBook - the full historyBook, or None if a pyramid level is known to be enough
+	:arg pyramids - made by buildPyramids
+	:arg key - the key of the series
+
+	:kwarg t0, t1 - the window, in Gyr.  Default is all of the series.
+	:kwarg maxPoints - the most bins wanted.  None means full resolution.
+
+	:returns time, minimum, maximum, mean - at full resolution, minimum, maximum and mean are all the series itself
+	:returns blockSize - the number of full resolution bins in each returned bin
+	"""
+
+	t0 = -np.inf if t0 is None else t0
+	t1 = np.inf if t1 is None else t1
+	level = chooseLevel(pyramids, t0, t1, maxPoints) if key in pyramids else None
+
+	if level is None:
+		if historyBook is None:
+			raise ValueError("The full resolution of {0} is needed, so the historyBook must be given.".format(key))
+		time = historyBook['time']
+		first, last = np.searchsorted(time, t0, side='left'), np.searchsorted(time, t1, side='right')
+		window = historyBook[key][...,first:last]
+		return time[first:last], window, window, window, 1
+
+	blockSize, tStart, tEnd, levelTime = pyramids['levels'][level]
+	minimum, maximum, mean = pyramids[key][level]
+	first, last = np.searchsorted(tEnd, t0, side='left'), np.searchsorted(tStart, t1, side='right')
+	return levelTime[first:last], minimum[...,first:last], maximum[...,first:last], mean[...,first:last], blockSize
+
+class ExpandingCollection(dict):
+	"""
+	A history collection that keeps its historyBooks compact in memory until they are accessed.  A book is expanded
+	the first time it is accessed and stored expanded from then on, so that changes made to it are kept.
+	"""
+
+	def __getitem__(self, key):
+		value = dict.__getitem__(self, key)
+		if isCompact(value):
+			value = expandHistory(value)
+			dict.__setitem__(self, key, value)
+		return value
+
+	def get(self, key, default=None):
+		if key in self:
+			return self[key]
+		return default
+
+	#Values are expanded as they are reached, just as with indexing.
+	def itervalues(self):
+		for key in self.iterkeys():
+			yield self[key]
+
+	def iteritems(self):
+		for key in self.iterkeys():
+			yield key, self[key]
+
+	def values(self):
+		return list(self.itervalues())
+
+	def items(self):
+		return list(self.iteritems())
+
+class HistoryCollectionWriter(object):
+
+	def __init__(self, fileName, compact=False, compactDtype=np.float32, pyramids=False):
+		"""
+		Write a collection one entry at a time.  Each entry is pickled as soon as it is written, and an index of where
+		each one starts is added when the writer is closed.
+
+		:arg fileName - the name of the output file
+
+		:kwarg compact - store historyBooks with compactHistory
+		:kwarg compactDtype - the dtype for rates and positions in compact historyBooks
+		:kwarg pyramids - also store the buildPyramids of every historyBook, as a separate entry that
+		HistoryCollectionReader.slice can read on its own
+		"""
+
+		self.fileName = fileName
+		self.compact = compact
+		self.compactDtype = compactDtype
+		self.pyramids = pyramids
+		self._file = open(fileName, 'wb')
+		self._index = {}
+
+	def write(self, key, value):
+		"""
+		Write one entry of the collection, e.g. a halo number and its historyBook, or 'failedHaloNumbers'.
+		"""
+
+		if self.pyramids and isinstance(key, int):
+			self._write(_pyramidKey(key), buildPyramids(value))
+		if self.compact and isinstance(key, int):
+			value = compactHistory(value, dtype=self.compactDtype)
+		self._write(key, value)
+
+	def _write(self, key, value):
+		self._index[key] = self._file.tell()
+		pickle.dump((key, value), self._file, protocol=pickle.HIGHEST_PROTOCOL)
+
+	def keys(self):
+		return [key for key in self._index.keys() if not _isPyramidKey(key)]
+
+	def close(self):
+		"""
+		Write the index and close the file.
+		"""
+
+		if self._file.closed:
+			return
+		indexOffset = self._file.tell()
+		pickle.dump(self._index, self._file, protocol=pickle.HIGHEST_PROTOCOL)
+		self._file.write(struct.pack(_trailerFormat, indexOffset, _streamMarker))
+		self._file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+class HistoryCollectionReader(object):
+
+	def __init__(self, fileName, expand=True):
+		"""
+		Read a file made by HistoryCollectionWriter one entry at a time.  Only the index is read up front.
+
+		:arg fileName - the name of the file
+
+		:kwarg expand - expand compact historyBooks when they are read
+		"""
+
+		self.fileName = fileName
+		self.expand = expand
+		self._file = open(fileName, 'rb')
+		indexOffset = _streamIndexOffset(self._file)
+		if indexOffset is None:
+			raise IOError("{0} was not written by HistoryCollectionWriter.".format(fileName))
+		self._file.seek(indexOffset)
+		self._index = pickle.load(self._file)
+
+	def keys(self):
+		return [key for key in self._index.keys() if not _isPyramidKey(key)]
+
+	def haloNumbers(self):
+		return sorted([key for key in self._index.keys() if isinstance(key, int)])
+
+	def __contains__(self, key):
+		return key in self._index
+
+	def __len__(self):
+		return len(self.keys())
+
+	def __getitem__(self, key):
+		self._file.seek(self._index[key])
+		storedKey, value = pickle.load(self._file)
+		if self.expand and isinstance(key, int):
+			value = expandHistory(value)
+		return value
+
+	def get(self, key, default=None):
+		if key in self._index:
+			return self[key]
+		return default
+
+	def pyramids(self, haloNumber):
+		"""
+		The buildPyramids of a historyBook, or None if they were not written.
+		"""
+
+		if _pyramidKey(haloNumber) not in self._index:
+			return None
+		self._file.seek(self._index[_pyramidKey(haloNumber)])
+		return pickle.load(self._file)[1]
+
+	def slice(self, haloNumber, key, t0=None, t1=None, maxPoints=None):
+		"""
+		One series of a historyBook between two times, with sliceSeries.  If a pyramid level is fine enough, only the
+		pyramids are read, not the historyBook.
+		"""
+
+		pyramids = self.pyramids(haloNumber)
+		if pyramids is None:
+			historyBook = expandHistory(self[haloNumber])
+			pyramids = {'time': historyBook['time'], 'levels': []}
+		elif (key not in pyramids) or (chooseLevel(pyramids, t0, t1, maxPoints) is None):
+			historyBook = expandHistory(self[haloNumber])
+		else:
+			historyBook = None
+		return sliceSeries(historyBook, pyramids, key, t0=t0, t1=t1, maxPoints=maxPoints)
+
+	def iterHistories(self):
+		"""
+		Generator of (haloNumber, historyBook), reading one book at a time.
+		"""
+
+		for haloNumber in self.haloNumbers():
+			yield haloNumber, self[haloNumber]
+
+	def close(self):
+		self._file.close()
+
+def loadHistoryCollection(pickleName, lazy=False):
+	"""
+	Read the output of createHistoryCollection, written either all at once or by HistoryCollectionWriter.
+
+	:kwarg lazy - for files written by HistoryCollectionWriter, return a HistoryCollectionReader instead of reading everything
+
+	:returns historyCollection - a dictionary, or an ExpandingCollection if the historyBooks are compact.  Books of an
+	ExpandingCollection are expanded and kept once they are read, so that keys added to them stay.
+	"""
+
+	with open(pickleName, 'rb') as myfile:
+		isStream = _streamIndexOffset(myfile) is not None
+		if not isStream:
+			myfile.seek(0)
+			historyCollection = pickle.load(myfile)
+	if isStream:
+		reader = HistoryCollectionReader(pickleName, expand=False)
+		if lazy:
+			reader.expand = True
+			return reader
+		historyCollection = dict([(key, reader[key]) for key in reader.keys()])
+		reader.close()
+
+	if any([isCompact(value) for value in historyCollection.values()]):
+		return ExpandingCollection(historyCollection)
+	return historyCollection
+
+def _pyramidKey(haloNumber):
+	return ('pyramids', haloNumber)
+
+def _isPyramidKey(key):
+	return isinstance(key, tuple) and (len(key) == 2) and (key[0] == 'pyramids')
+
+def _streamIndexOffset(myfile):
+	"""
+	The offset of the index of a file written by HistoryCollectionWriter, or None for any other file.
+	"""
+
+	trailerSize = struct.calcsize(_trailerFormat)
+	myfile.seek(0, os.SEEK_END)
+	if myfile.tell() < trailerSize:
+		return None
+	myfile.seek(-trailerSize, os.SEEK_END)
+	indexOffset, marker = struct.unpack(_trailerFormat, myfile.read(trailerSize))
+	if marker != _streamMarker:
+		return None
+	return indexOffset
+
+def _isSeries(value, length):
+	return isinstance(value, np.ndarray) and (value.ndim > 0) and (value.shape[-1] == length) and \
+	np.issubdtype(value.dtype, np.floating)
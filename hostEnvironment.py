@@ -0,0 +1,249 @@
+"""
+ARR: 10.19.26
+
+The environment of every halo in a collection with respect to a set of hosts, such as groups and clusters, instead of
+only halo 1.  For each halo and time bin, the nearest host is the one the halo is deepest inside of, in units of that
+host's R200, and the ram pressure comes from that host's gas density profile.  Distances to all hosts are computed at
+once for many halos.
+"""
+
+import numpy as np
+import constants
+
+#The most elements nearestHosts broadcasts at once, as an array of shape (nHalos, nHosts, 3, nTimes), for
+#addHostEnvironment to size its chunks by.
+maximumBroadcastSize = 2**24
+
+def _hostTracks(hostBooks, time, key, left):
+	"""
+	One 3-vector key of every host on a time axis, as an array of shape (nHosts, 3, nTimes).
+	"""
+
+	tracks = np.full((len(hostBooks), 3, len(time)), left, dtype=float)
+	for h_index, hostBook in enumerate(hostBooks):
+		if np.array_equal(hostBook['time'], time):
+			tracks[h_index] = hostBook[key]
+		else:
+			for i in range(3):
+				tracks[h_index,i] = np.interp(time, hostBook['time'], hostBook[key][i], left=left, right=left)
+	return tracks
+
+class HostEnvironment(object):
+
+	def __init__(self, hostBooks, step=None, computeRamPressure=True, profilers=None):
+		"""
+		Keep what is needed from the historyBooks of the hosts to place any other halo among them.
+
+		:arg hostBooks - dictionary of halo number: historyBook of each host.  Hosts without SSC and R200 are left out.
+
+		:kwarg step - the timestep the collection starts from, for the ClusterProfiler of each host
+		:kwarg computeRamPressure - whether to add hostRamPressure as well as hostDistance and hostNumber
+		:kwarg profilers - dictionary of halo number: a profiler with computeGasDensity, for hosts whose profiles are
+		already known.  The others are made with ClusterProfiler(step, haloNumber=haloNumber).
+		"""
+
+		self.hostNumbers = np.array(sorted([haloNumber for haloNumber, hostBook in hostBooks.items() \
+		if ('SSC' in hostBook) and ('R200' in hostBook)]), dtype=int)
+		books = [hostBooks[haloNumber] for haloNumber in self.hostNumbers]
+		self.time = np.asarray(max([hostBook['time'] for hostBook in books], key=len)) if len(books) > 0 else np.array([])
+		self.positions = _hostTracks(books, self.time, 'SSC', np.inf)
+		self.radii = np.zeros((len(books), len(self.time)))
+		for h_index, hostBook in enumerate(books):
+			self.radii[h_index] = np.interp(self.time, hostBook['time'], hostBook['R200'], left=0, right=0)
+
+		#Ram pressures need the velocity and the profile of every host.
+		self.velocities = None
+		self.profilers = None
+		if computeRamPressure & (len(books) > 0) & all(['Vcom' in hostBook for hostBook in books]):
+			self.velocities = _hostTracks(books, self.time, 'Vcom', 0)
+			if profilers is None:
+				profilers = {}
+			if (step is not None) or all([haloNumber in profilers for haloNumber in self.hostNumbers]):
+				#Only cluster simulations need scipy.
+				from clusterProfiler_powerlaw import ClusterProfiler
+				self.profilers = [profilers[haloNumber] if haloNumber in profilers else \
+				ClusterProfiler(step, haloNumber=haloNumber) for haloNumber in self.hostNumbers]
+
+	def _onTime(self, time):
+		"""
+		The positions, radii and velocities of the hosts on another time axis.
+		"""
+
+		if np.array_equal(time, self.time):
+			return self.positions, self.radii, self.velocities
+		positions = np.full((len(self.hostNumbers), 3, len(time)), np.inf)
+		radii = np.zeros((len(self.hostNumbers), len(time)))
+		velocities = None if self.velocities is None else np.zeros((len(self.hostNumbers), 3, len(time)))
+		for h_index in range(len(self.hostNumbers)):
+			radii[h_index] = np.interp(time, self.time, self.radii[h_index], left=0, right=0)
+			for i in range(3):
+				positions[h_index,i] = np.interp(time, self.time, self.positions[h_index,i], left=np.inf, right=np.inf)
+				if velocities is not None:
+					velocities[h_index,i] = np.interp(time, self.time, self.velocities[h_index,i], left=0, right=0)
+		return positions, radii, velocities
+
+	def nearestHosts(self, time, positions, haloNumbers=None):
+		"""
+		The nearest host of many halos that share a time axis.
+
+		:arg time - the time axis
+		:arg positions - array of shape (nHalos, 3, nTimes)
+
+		:kwarg haloNumbers - the halo number of each halo, so that no host is its own nearest host
+
+		:returns distances - array of shape (nHalos, nTimes), the distance to the nearest host in its R200.  Infinite
+		where no host exists.
+		:returns hostIndices - the index in hostNumbers of the nearest host, or -1
+		"""
+
+		if len(self.hostNumbers) == 0:
+			return np.full((len(positions), len(time)), np.inf), np.full((len(positions), len(time)), -1, dtype=int)
+		hostPositions, hostRadii = self._onTime(time)[:2]
+		with np.errstate(invalid='ignore', divide='ignore'):
+			separations = np.sqrt(np.sum((positions[:,np.newaxis] - hostPositions[np.newaxis])**2, axis=2))
+			scaled = np.where(hostRadii[np.newaxis] > 0, separations / hostRadii[np.newaxis], np.inf)
+		scaled[np.isnan(scaled)] = np.inf
+		if haloNumbers is not None:
+			scaled[np.asarray(haloNumbers)[:,np.newaxis] == self.hostNumbers[np.newaxis,:]] = np.inf
+
+		hostIndices = np.argmin(scaled, axis=1)
+		distances = np.min(scaled, axis=1)
+		hostIndices[~np.isfinite(distances)] = -1
+		return distances, hostIndices
+
+	def addToMany(self, historyBooks, haloNumbers):
+		"""
+		Add hostDistance, hostNumber and, if possible, hostRamPressure to historyBooks that share a time axis.
+		"""
+
+		if len(historyBooks) == 0:
+			return
+		time = historyBooks[0]['time']
+		positions = np.array([historyBook['SSC'] for historyBook in historyBooks], dtype=float)
+		distances, hostIndices = self.nearestHosts(time, positions, haloNumbers=haloNumbers)
+		hostNumbers = np.full(hostIndices.shape, -1, dtype=int)
+		hostNumbers[hostIndices >= 0] = self.hostNumbers[hostIndices[hostIndices >= 0]]
+		for b_index, historyBook in enumerate(historyBooks):
+			historyBook['hostDistance'] = distances[b_index]
+			historyBook['hostNumber'] = hostNumbers[b_index]
+
+		if (self.profilers is None) | any(['Vcom' not in historyBook for historyBook in historyBooks]):
+			return
+		hostVelocities = self._onTime(time)[2]
+		velocities = np.array([historyBook['Vcom'] for historyBook in historyBooks], dtype=float)
+		ramPressures = np.zeros(distances.shape)
+		times = np.broadcast_to(time, distances.shape)
+		for h_index, profiler in enumerate(self.profilers):
+			inside = hostIndices == h_index
+			if not np.any(inside):
+				continue
+			haloRows, timeColumns = np.where(inside)
+			relativeSpeedSquared = np.sum((velocities[haloRows,:,timeColumns] - hostVelocities[h_index,:,timeColumns])**2, axis=1)
+			hostDensity = profiler.computeGasDensity(distances[inside], times[inside])
+			ramPressures[inside] = hostDensity * relativeSpeedSquared * constants.M_sun / (constants.pc * 1e3)**3 * 1e6
+		for b_index, historyBook in enumerate(historyBooks):
+			historyBook['hostRamPressure'] = ramPressures[b_index]
+
+	def addTo(self, historyBook, haloNumber=None):
+		"""
+		Add hostDistance, hostNumber and, if possible, hostRamPressure to one historyBook.
+		"""
+
+		if 'SSC' not in historyBook:
+			return
+		self.addToMany([historyBook], [haloNumber])
+
+def addHostEnvironment(historyCollection, hostHaloNumbers, step, computeRamPressure=True, chunkSize=None):
+	"""
+	Add the environment of every historyBook of a collection with respect to a set of hosts.  Books that share a time
+	axis are done chunkSize at a time.
+
+	:arg hostHaloNumbers - the halo numbers of the hosts.  Hosts that are not in the collection are left out.
+	:arg step - the timestep the collection starts from, for the ClusterProfiler of each host
+
+	:kwarg chunkSize - the number of books done at a time.  Default is as many as fit in maximumBroadcastSize, so
+	fewer when there are more hosts or longer histories.
+	"""
+
+	haloNumbers = [key for key in historyCollection.keys() if isinstance(key, int)]
+	hostBooks = dict([(haloNumber, historyCollection[haloNumber]) for haloNumber in hostHaloNumbers if haloNumber in haloNumbers])
+	print "Computing the environment of {0} halos among {1} hosts.".format(len(haloNumbers), len(hostBooks))
+	environment = HostEnvironment(hostBooks, step, computeRamPressure=computeRamPressure)
+
+	groups = {}
+	for haloNumber in haloNumbers:
+		historyBook = historyCollection[haloNumber]
+		if 'SSC' in historyBook:
+			groups.setdefault((len(historyBook['time']), historyBook['time'][0]), []).append((haloNumber, historyBook))
+	for members in groups.values():
+		groupChunkSize = chunkSize
+		if groupChunkSize is None:
+			nTimes = len(members[0][1]['time'])
+			groupChunkSize = max(maximumBroadcastSize // max(len(environment.hostNumbers)*3*nTimes, 1), 1)
+		for c_index in range(0, len(members), groupChunkSize):
+			chunk = members[c_index:c_index+groupChunkSize]
+			environment.addToMany([historyBook for haloNumber, historyBook in chunk], [haloNumber for haloNumber, historyBook in chunk])
+	return environment
+
+class HostStream(object):
+	"""
+	The host environment for a HistoryCollectionWriter.  Books are held back until every host has been made, and then
+	released with their environment added, so the hosts should come first.
+	"""
+
+	def __init__(self, hostHaloNumbers, step, computeRamPressure=True, profilers=None):
+		"""
+		:kwarg profilers - as in HostEnvironment
+		"""
+
+		self.waiting = set(hostHaloNumbers)
+		self.step = step
+		self.computeRamPressure = computeRamPressure
+		self.profilers = profilers
+		self.hostBooks = {}
+		self.held = []
+		self.environment = None
+		if len(self.waiting) == 0:
+			self.environment = HostEnvironment({}, step, computeRamPressure=computeRamPressure, profilers=profilers)
+
+	def add(self, haloNumber, historyBook):
+		"""
+		Add a finished historyBook.
+
+		:returns released - list of (haloNumber, historyBook) ready to be written
+		"""
+
+		if self.environment is not None:
+			self.environment.addTo(historyBook, haloNumber)
+			return [(haloNumber, historyBook)]
+		self.held.append((haloNumber, historyBook))
+		if haloNumber in self.waiting:
+			self.hostBooks[haloNumber] = historyBook
+		return self.fail(haloNumber)
+
+	def fail(self, haloNumber):
+		"""
+		Record a halo that failed, in case it is a host.
+
+		:returns released - list of (haloNumber, historyBook) ready to be written
+		"""
+
+		self.waiting.discard(haloNumber)
+		if (self.environment is not None) or (len(self.waiting) > 0):
+			return []
+		self.environment = HostEnvironment(self.hostBooks, self.step, computeRamPressure=self.computeRamPressure, \
+		profilers=self.profilers)
+		released = self.held
+		for heldNumber, historyBook in released:
+			self.environment.addTo(historyBook, heldNumber)
+		self.held = []
+		self.hostBooks = {}
+		return released
+
+	def finish(self):
+		"""
+		Release whatever is still held, if some hosts never came.
+		"""
+
+		self.waiting = set()
+		return self.fail(None)
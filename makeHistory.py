@@ -1,6 +1,9 @@
 import numpy as np
 import tangos as db
+from tangos.live_calculation import NoResultsError
 from stitched_reverse_property_cascade import *
+from propertySchema import getPropertySchema, selectQuery, fullExpressions
+import compiledKernels
 
 nbins = 2000
 tmax_Gyr = 20.0
@@ -16,7 +19,7 @@ def bin_index(time):
         return index
 
 def makeHistory(halo, bhString="bh('BH_central_distance', 'min', 'BH_central')", \
-	maximumSkips=5, cutoffDistance=2):
+	maximumSkips=5, cutoffDistance=2, keys=None, spatialMatcher=None):
 	"""
 	Track this halo as far back in time as possible.  Make arrays with the same resolution as
 	mdot histograms.
@@ -26,113 +29,165 @@ def makeHistory(halo, bhString="bh('BH_central_distance', 'min', 'BH_central')",
 	:kwarg bhString - the selection of black hole to use for this reconstruction
 	:kwarg maximumSkips - the maximum number of skips allowed when trying to reconstruct a history based on
         tracking the central black hole backwards in time
-        :kwarg cutoffDistance - the maximum number of kpc that the central black hole is allowed to be from the 
+        :kwarg cutoffDistance - the maximum number of kpc that the central black hole is allowed to be from the
         center of its host halo for tracking
+	:kwarg keys - the keys of the historyBook to build.  Only the properties they need are queried.  None means
+	every key in the property schema of this simulation.  "time" and "t_slice" are always included.
+	:kwarg spatialMatcher - a spatialStitching.SpatialMatcher, to stitch gaps by position, velocity and mass where
+	the central black hole cannot be followed
 
 	:returns historyBook - a dictionary of various pre-determined arrays
 	"""
 
+	rawColumns, schema, usedKeys = queryHistory(halo, bhString=bhString, maximumSkips=maximumSkips, \
+	cutoffDistance=cutoffDistance, keys=keys, spatialMatcher=spatialMatcher)
+
+	return assembleHistory(rawColumns, schema, usedKeys, bhString=bhString)
+
+def queryHistory(halo, bhString="bh('BH_central_distance', 'min', 'BH_central')", \
+	maximumSkips=5, cutoffDistance=2, keys=None, spatialMatcher=None):
+	"""
+	The database half of makeHistory.  Arguments are the same.
+
+	:returns rawColumns - dictionary of tangos expression: list of values going back in time
+	:returns schema - the property schema of this simulation
+	:returns usedKeys - the keys that can be built from rawColumns
+	"""
+
 	#The existence of a black hole will add keys.
 	hasBH = 'BH_central' in halo.keys()
 
 	#These are the properties we will trace backwards in time.
-	if halo.timestep.simulation.basename == 'cosmo25':
-		rawProperties = ["t()", "halo_number()", "Mstar", "raw(SFR_histogram)", "Mvir", "radius(200)", "Mgas", "Mcold", "shrink_center"]
-		if hasBH:
-			rawBlackHoleProperties = ['BH_mass', 'raw(BH_mdot_histogram)', 'BH_central_distance']
-			allRawProperties = rawProperties + [bhString+'.'+rawBHProp for rawBHProp in rawBlackHoleProperties]
-			dictionaryNames = ["Time", "haloNumber", "Mstar", "SFR", "Mvir", "R200", "Mgas", "Mcold", "SSC", \
-			"Mbh", "BHAR", "Dbh"]
-		else:
-			allRawProperties = rawProperties
-			dictionaryNames = ["Time", "haloNumber", "Mstar", "SFR", "Mvir", "R200", "Mgas", "Mcold", "SSC"]
-	elif halo.timestep.simulation.basename == 'h1.cosmo50':
-		rawProperties = ["t()", "halo_number()", "Mstar", "raw(SFR_histogram)", "Mvir", "radius(200)", "Mgas", "MColdGas", "shrink_center", "Vcom"]
-		if hasBH:
-			rawBlackHoleProperties = ['BH_mass', 'raw(BH_mdot_histogram)', 'BH_central_distance']
-			allRawProperties = rawProperties + [bhString+'.'+rawBHProp for rawBHProp in rawBlackHoleProperties]
-			dictionaryNames = ["Time", "haloNumber", "Mstar", "SFR", "Mvir", "R200", "Mgas", "Mcold", "SSC", "Vcom", \
-			"Mbh", "BHAR", "Dbh"]
-		else:
-			allRawProperties = rawProperties
-			dictionaryNames = ["Time", "haloNumber", "Mstar", "SFR", "Mvir", "R200", "Mgas", "Mcold", "SSC", "Vcom"]
+	schema = getPropertySchema(halo.timestep.simulation.basename)
+	allRawProperties, usedKeys = selectQuery(schema, keys, hasBH, bhString)
 
 	#Get all the properties
 	print "Querying database with a stitched_reverse_property_cascade."
-	if hasBH:
-		time, haloNumber, mstar, sfr, mvir, rvir, mgas, mcold, ssc, vel, mbh, bhar, dbh = stitched_reverse_property_cascade(halo, allRawProperties, \
-		maximumSkips=maximumSkips, cutoffDistance=cutoffDistance)
-	else:
-		time, haloNumber, mstar, sfr, mvir, rvir, mgas, mcold, ssc, vel = stitched_reverse_property_cascade(halo, allRawProperties, \
-                maximumSkips=maximumSkips, cutoffDistance=cutoffDistance)
+	cascadedProperties = stitched_reverse_property_cascade(halo, allRawProperties, \
+	maximumSkips=maximumSkips, cutoffDistance=cutoffDistance, spatialMatcher=spatialMatcher)
+	if len(cascadedProperties[0]) == 0:
+		raise NoResultsError("No halos along the main branch have all of {0}.".format(allRawProperties))
+
+	return dict(zip(allRawProperties, cascadedProperties)), schema, usedKeys
+
+def queryHistories(halos, bhString="bh('BH_central_distance', 'min', 'BH_central')", \
+	maximumSkips=5, cutoffDistance=2, keys=None, spatialMatcher=None):
+	"""
+	queryHistory for many halos at once, using batched_reverse_property_cascade.  Halos that need the same
+	properties are cascaded together.
 
-	#For the histograms, some assembly is required.
-	print "Processing histograms."	
-	combinedSFR = np.zeros(bin_index(time[0]))
+	:arg halos - a list of halos of type tangos.core.Halo
+
+	:returns rawHistories - for each halo, the output of queryHistory, or None if it lacks something asked for
+	"""
+
+	#Group halos by the properties they need.
+	groups = {}
+	for h_index, halo in enumerate(halos):
+		hasBH = 'BH_central' in halo.keys()
+		schema = getPropertySchema(halo.timestep.simulation.basename)
+		allRawProperties, usedKeys = selectQuery(schema, keys, hasBH, bhString)
+		groups.setdefault(tuple(allRawProperties), (schema, usedKeys, []))[2].append(h_index)
+
+	rawHistories = [None] * len(halos)
+	for allRawProperties, (schema, usedKeys, indices) in groups.items():
+		print "Querying database with a batched_reverse_property_cascade for {0} halos.".format(len(indices))
+		cascadedLists = batched_reverse_property_cascade([halos[i] for i in indices], list(allRawProperties), \
+		maximumSkips=maximumSkips, cutoffDistance=cutoffDistance, spatialMatcher=spatialMatcher)
+		for h_index, cascadedProperties in zip(indices, cascadedLists):
+			if len(cascadedProperties[0]) > 0:
+				rawHistories[h_index] = dict(zip(allRawProperties, cascadedProperties)), schema, usedKeys
+
+	return rawHistories
+
+def assembleHistory(rawColumns, schema, keys, bhString="bh('BH_central_distance', 'min', 'BH_central')"):
+	"""
+	The numerical half of makeHistory.  Put the output of a cascade onto the time axis of the histograms.
+
+	:arg rawColumns - dictionary of tangos expression: list of values going back in time
+	:arg schema - the property schema used to choose the expressions
+	:arg keys - the keys of the historyBook to build
+
+	:kwarg bhString - the selection of black hole used in the expressions
+
+	:returns historyBook - a dictionary of various pre-determined arrays
+	"""
+
+	time = rawColumns["t()"]
+
+	#This is a denser time axis than time, corresponding to the values in the histograms
+	nTracedBins = bin_index(time[0])
+	tracedTime = time[0] - np.arange(nTracedBins-1,-1,-1)*tmax_Gyr/nbins
+
+	historyBook = {"time": tracedTime, "t_slice": time}
+	for key in keys:
+		rule = schema[key][1]
+		columns = [rawColumns[expression] for expression in fullExpressions(schema[key], bhString)]
+		historyBook[key] = _postProcessors[rule](time, tracedTime, *columns)
+
+	return historyBook
+
+def _keepRaw(time, tracedTime, values):
+	return np.array(values)
+
+#Mstar is interpolated rather than retraced from the SFR, as Mbh is from the BHAR, due to stripping, accretion, and
+#uncertainties with halo finding.
+def _stitchSFR(time, tracedTime, sfr):
+	combinedSFR = np.zeros(len(tracedTime))
 
 	for t_i, sfr_i in zip(time, sfr):
 		#The start and end indices have overlap; don't worry.  Histograms go back a fixed time.
-                end = bin_index(t_i)
-                start = np.max((end - len(sfr_i), 0))
+		end = bin_index(t_i)
+		start = np.max((end - len(sfr_i), 0))
 
 		#Raw SFR info is in solar masses per Gyr, for some reason.
-		sfr_i = [val/1e9 for val in sfr_i]
-		combinedSFR[start:end] = sfr_i
-
-	if hasBH:
-		combinedBHAR = np.zeros(bin_index(time[0]))
-		tracedMbh = np.zeros(bin_index(time[0]))
-		for t_i, m_i, bhar_i in zip(time, mbh, bhar):
-			#The start and end indices have overlap; don't worry.  Histograms go back a fixed time.
-			end = bin_index(t_i)
-			start = np.max((end - len(bhar_i), 0))
-
-			#Contingency in case a BH is detected in one step, but not a nearby one.
-			combinedBHAR[start:end] = np.maximum(bhar_i[-(end-start):], combinedBHAR[start:end])
-
-			#Retrace black hole mass with the resolution of the histogram.  Cannot account for BH mergers.
-			cumulativeBHAR = np.cumsum(bhar_i) * tmax_Gyr * 1e9 / nbins
-			cumulativeBHAR -= cumulativeBHAR[-1]
-			tracedMbh[start:end] = cumulativeBHAR + m_i
-
-	#This is a denser time axis than time, corresponding to the values in combinedBHAR and combinedSFR
-	tracedTime = time[0] - np.arange(len(combinedSFR)-1,-1,-1)*tmax_Gyr/nbins
-
-	#Trace stars.  Not doing the same thing as I do with Mbh due to stripping, accretion, and uncertainties with halo finding.
-	tracedMstar = np.interp(tracedTime, np.flipud(time), np.flipud(mstar), left=0)
-
-	#Get everything else to the same time resolution by interpolation.
-	tracedMvir = np.interp(tracedTime, np.flipud(time), np.flipud(mvir), left=0)
-	tracedR200 = np.interp(tracedTime, np.flipud(time), np.flipud(rvir), left=0)
-	tracedMgas = np.interp(tracedTime, np.flipud(time), np.flipud(mgas), left=0)
-	tracedMcold = np.interp(tracedTime, np.flipud(time), np.flipud(mcold), left=0)
-	if hasBH:
-		tracedDbh = np.interp(tracedTime, np.flipud(time), np.flipud(dbh), left=np.inf)
+		combinedSFR[start:end] = np.array(sfr_i) / 1e9
+	return combinedSFR
 
+def _stitchBHAR(time, tracedTime, bhar):
+	if compiledKernels.useCompiled:
+		values, offsets = compiledKernels.flatten(bhar)
+		ends = np.array([bin_index(t_i) for t_i in time], dtype=np.int64)
+		return compiledKernels.stitchOverlappingMaximum(ends, values, offsets, len(tracedTime))
+
+	combinedBHAR = np.zeros(len(tracedTime))
+	for t_i, bhar_i in zip(time, bhar):
+		#The start and end indices have overlap; don't worry.  Histograms go back a fixed time.
+		end = bin_index(t_i)
+		start = np.max((end - len(bhar_i), 0))
+
+		#Contingency in case a BH is detected in one step, but not a nearby one.
+		combinedBHAR[start:end] = np.maximum(bhar_i[-(end-start):], combinedBHAR[start:end])
+	return combinedBHAR
+
+def _traceMbh(time, tracedTime, mbh, bhar):
+	tracedMbh = np.zeros(len(tracedTime))
+	for t_i, m_i, bhar_i in zip(time, mbh, bhar):
+		end = bin_index(t_i)
+		start = np.max((end - len(bhar_i), 0))
+
+		#Retrace black hole mass with the resolution of the histogram.  Cannot account for BH mergers.
+		cumulativeBHAR = np.cumsum(bhar_i) * tmax_Gyr * 1e9 / nbins
+		cumulativeBHAR -= cumulativeBHAR[-1]
+		tracedMbh[start:end] = cumulativeBHAR + m_i
+	return tracedMbh
+
+def _interpolate(time, tracedTime, values, left=0):
+	return np.interp(tracedTime, np.flipud(time), np.flipud(values), left=left)
+
+def _interpolateInf(time, tracedTime, values):
+	return _interpolate(time, tracedTime, values, left=np.inf)
+
+def _interpolateVector(time, tracedTime, values, left=np.inf):
 	#Interpolating each dimension of space separately, then combining.
-	ssc = np.array(ssc)
-	tracedx = np.interp(tracedTime, np.flipud(time), np.flipud(ssc[:,0]), left=np.inf)
-	tracedy = np.interp(tracedTime, np.flipud(time), np.flipud(ssc[:,1]), left=np.inf)
-	tracedz = np.interp(tracedTime, np.flipud(time), np.flipud(ssc[:,2]), left=np.inf)
-	tracedCoordinates = np.vstack((tracedx, tracedy, tracedz))
-
-	#The same must be done for velocities
-	vel = np.array(vel)
-        tracedvx = np.interp(tracedTime, np.flipud(time), np.flipud(vel[:,0]), left=0)
-        tracedvy = np.interp(tracedTime, np.flipud(time), np.flipud(vel[:,1]), left=0)
-        tracedvz = np.interp(tracedTime, np.flipud(time), np.flipud(vel[:,2]), left=0)
-        tracedVelocities = np.vstack((tracedvx, tracedvy, tracedvz))
-
-	#Combine everything into a dictionary
-	if hasBH:
-		historyBook = {"time": tracedTime, "haloNumber": np.array(haloNumber), "Mstar": tracedMstar, "SFR": combinedSFR, "Mvir": tracedMvir, \
-		"R200": tracedR200, "Mgas": tracedMgas, "Mcold": tracedMcold, "SSC": tracedCoordinates, "Vcom": tracedVelocities, "t_slice": time, \
-		"Mbh": tracedMbh, "BHAR": combinedBHAR, "Dbh": tracedDbh}
-	else:
-		historyBook = {"time": tracedTime, "haloNumber": np.array(haloNumber), "Mstar": tracedMstar, "SFR": combinedSFR, "Mvir": tracedMvir, \
-                "R200": tracedR200, "Mgas": tracedMgas, "Mcold": tracedMcold, "SSC": tracedCoordinates, "Vcom": tracedVelocities, "t_slice": time}
+	values = np.array(values)
+	return np.vstack([_interpolate(time, tracedTime, values[:,i], left=left) for i in range(values.shape[1])])
 
-	return historyBook
+def _interpolateVectorZero(time, tracedTime, values):
+	return _interpolateVector(time, tracedTime, values, left=0)
+
+_postProcessors = {'raw': _keepRaw, 'sfrHistogram': _stitchSFR, 'bharHistogram': _stitchBHAR, 'bhMass': _traceMbh, \
+'interpolate': _interpolate, 'interpolateInf': _interpolateInf, 'vector': _interpolateVector, 'vectorZero': _interpolateVectorZero}
 
 if __name__ == '__main__':
 	simulationName = 'h1.cosmo50'
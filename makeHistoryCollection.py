@@ -9,16 +9,26 @@ from tangos.live_calculation import NoResultsError
 from getSuitableHalos import *
 from stitched_merger_finder import *
 from makeHistory import *
-from clusterProfiler_powerlaw import *
+from historyStorage import compactCollection, HistoryCollectionWriter
+from mergerCatalogue import buildMergerCatalogue
+from historySharding import shardOf, shardFileName, manifestFileName, writeManifest
+from traceability import checkTraceability, TRACEABLE, PARTIAL, UNTRACEABLE
+from hostEnvironment import addHostEnvironment, HostStream
+from haloSelection import defaultSelector
+from timestepIndex import TimestepIndex
 import cPickle as pickle
 import time
-import smtplib
+from functools import partial
+from itertools import imap, chain
+from util.pipeline import prefetch
 import constants
-from email.mime.text import MIMEText
 
 def createHistoryCollection(step, pickleName, maximumSkips=5, cutoffDistance=2, minStellarMass=1e8, contaminationTolerance=0.05, \
 	minDarkParticles=1e4, requireBH=True, emailAddress=None, computeRamPressure=True, computeMergers=True, massForRatio='Mstar', \
-	bhString="bh('BH_mass', 'max', 'BH_central')"):
+	bhString="bh('BH_mass', 'max', 'BH_central')", keys=None, pipeline=False, prefetchDepth=4, \
+	batchSize=1, compact=False, compactDtype=np.float32, streamOutput=False, \
+	mergerTree=None, spatialMatcher=None, shard=None, pyramids=False, prevalidate=False, requireComplete=False, \
+	hostHaloNumbers=None, dryRun=False, dryRunFraction=0.05):
 	"""
 	Create a dictionary of histories.
 
@@ -32,80 +42,205 @@ def createHistoryCollection(step, pickleName, maximumSkips=5, cutoffDistance=2,
 	:kwarg minDarkParticles - The minimum number of DM particles allowed in these galaxies.
 	:kwarg requireBH - Whether or not we try to include galaxies without SMBHs.  (Not yet implemented).
 	:kwarg emailAddress - The email address for an update when this function is finished.
+	:kwarg keys - The keys of each historyBook to build, as in makeHistory.  None builds everything.  Cluster distances
+	and ram pressures need SSC, R200 and Vcom.
+	:kwarg pipeline - Fetch the database information of upcoming halos in a background thread while earlier halos
+	are assembled.  With streamOutput, the ClusterProfilers of the cluster and the hosts are made before the thread
+	starts, since the thread and the profilers would otherwise share the database session.
+	:kwarg prefetchDepth - In pipeline mode, the maximum number of fetched batches waiting to be assembled.
+	:kwarg batchSize - The number of halos whose main branches are cascaded together with batched_reverse_property_cascade.
+	:kwarg compact - Save the historyBooks with compactHistory.  Read the output with loadHistoryCollection.
+	:kwarg compactDtype - The dtype for rates and positions in compact output.
+	:kwarg streamOutput - Write each historyBook with a HistoryCollectionWriter as soon as it is made, instead of keeping
+	the whole collection in memory.  Read the output with loadHistoryCollection.
+	:kwarg mergerTree - A MergerTree of the simulation, so that mergers are found without link queries.  Use
+	MergerTree.fromSimulation to extract one, which must include massForRatio.
+	:kwarg spatialMatcher - A spatialStitching.SpatialMatcher, so that gaps in the main branches of halos without a
+	central black hole are stitched by position, velocity and mass.
+	:kwarg shard - (shardIndex, nShards) to make only the halos of one shard, chosen with historySharding.shardOf.
+	The output goes to historySharding.shardFileName, with a manifest.  Cluster distances and ram pressures are left
+	for historySharding.mergeHistoryShards.
+	:kwarg pyramids - With streamOutput, also store decimation pyramids of every historyBook, so that time windows can
+	be read at low resolution with HistoryCollectionReader.slice.
+	:kwarg prevalidate - Before any tracing, check every halo with traceability.checkTraceability.  Untraceable halos
+	are counted as failed without being traced, and the report is saved as 'traceability'.
+	:kwarg requireComplete - With prevalidate, also count halos that can only be traced part of the way as failed.
+	:kwarg hostHaloNumbers - The halo numbers of groups and clusters to use as hosts.  Every historyBook gets the
+	distance to its nearest host in R200 of that host, the halo number of that host, and the ram pressure from its gas,
+	as hostDistance, hostNumber and hostRamPressure.  With shard, this is left for historySharding.mergeHistoryShards.
+	:kwarg dryRun - Write nothing.  Instead, run a sample of the halos and return the projected cost of the job from
+	costEstimator.estimateCollectionCost.
+	:kwarg dryRunFraction - With dryRun, the fraction of the halos to run.
 	"""
 
+	#Columns and timesteps kept by earlier jobs may be out of date, or belong to a closed session.
+	defaultSelector.forget()
+	TimestepIndex.forget()
+
+	if dryRun:
+		from costEstimator import estimateCollectionCost
+		return estimateCollectionCost(step, sampleFraction=dryRunFraction, maximumSkips=maximumSkips, \
+		cutoffDistance=cutoffDistance, minStellarMass=minStellarMass, contaminationTolerance=contaminationTolerance, \
+		minDarkParticles=minDarkParticles, requireBH=requireBH, computeRamPressure=computeRamPressure, \
+		computeMergers=computeMergers, massForRatio=massForRatio, bhString=bhString, keys=keys, batchSize=batchSize, \
+		compact=compact, compactDtype=compactDtype, streamOutput=streamOutput, mergerTree=mergerTree, \
+		spatialMatcher=spatialMatcher, shard=shard, pyramids=pyramids, prevalidate=prevalidate, requireComplete=requireComplete, \
+		hostHaloNumbers=hostHaloNumbers)
+
 	#Time the calculation
 	t_start = time.time()
 
 	#Obtain halos that meet the requirements.
 	haloList = getSuitableHalos(step, requireBH=requireBH, minStellarMass=minStellarMass, contaminationTolerance=contaminationTolerance, \
 	minDarkParticles=minDarkParticles)
-	historyCollection = {}
 	failedHaloNumbers = []
+	hasCluster = step.simulation.basename == 'h1.cosmo50'
+	if shard is not None:
+		shardIndex, nShards = shard
+		haloList = [halo for halo in haloList if shardOf(halo.halo_number, nShards) == shardIndex]
+		outputName = shardFileName(pickleName, shardIndex, nShards)
+	else:
+		outputName = pickleName
+	#Shards leave the environment of each halo to the merge, since the cluster is only in one of them.
+	addEnvironment = hasCluster & (shard is None)
+	addHosts = (hostHaloNumbers is not None) & (shard is None)
+	selectedHaloNumbers = [int(halo.halo_number) for halo in haloList]
 
-	#Loop through and find histories.
-	for h_index in range(len(haloList)):
-		haloNumber = haloList[h_index].halo_number
-		print "Processing halo_number {0}, halo {1} of {2}.".format(haloNumber, h_index+1, len(haloList))
-		try:
-			historyBook = makeHistory(haloList[h_index], maximumSkips=maximumSkips, cutoffDistance=cutoffDistance, bhString=bhString)
-			historyCollection[haloNumber] = historyBook
-		except NoResultsError:
-			#The galaxy lacks one of the items asked for, probably a BH.
-			print "   FAILED"
-			failedHaloNumbers.append(haloNumber)
-			pass
-		if computeMergers:
-			mergerTimes, mergerRatios = stitched_merger_finder(haloList[h_index], maximumSkips=maximumSkips, \
-                        cutoffDistance=cutoffDistance, massForRatio=massForRatio)
-                        historyCollection[haloNumber]['mergerTimes'] = mergerTimes
-                        historyCollection[haloNumber]['mergerRatios'] = mergerRatios
+	#Find the halos that would fail before paying for their histories.
+	if prevalidate:
+		traceabilityReport = checkTraceability(haloList, bhString=bhString, keys=keys, maximumSkips=maximumSkips, \
+		cutoffDistance=cutoffDistance, spatialMatcher=spatialMatcher)
+		skippedHaloNumbers = traceabilityReport[UNTRACEABLE] + (traceabilityReport[PARTIAL] if requireComplete else [])
+		print "{0} halos are traceable, {1} partially and {2} not at all.".format(len(traceabilityReport[TRACEABLE]), \
+		len(traceabilityReport[PARTIAL]), len(traceabilityReport[UNTRACEABLE]))
+		failedHaloNumbers.extend(skippedHaloNumbers)
+		haloList = [halo for halo in haloList if halo.halo_number not in skippedHaloNumbers]
 
-	if step.simulation.basename == 'h1.cosmo50':
-		#Adding one new key:  The distance from the cluster center
-		try:
-			clusterCoordinates = historyCollection[1]['SSC']
-			clusterRadius = historyCollection[1]['R200']
-			print "Computing cluster distances."
-			for h_index in range(len(haloList)):
-				haloNumber = haloList[h_index].halo_number
-				if (haloNumber == 1) | (haloNumber in failedHaloNumbers):
-					continue
-				else:
-					displacement = historyCollection[haloNumber]['SSC'] - clusterCoordinates
-					distance = np.sqrt(np.array([np.dot(displacement[:,i],displacement[:,i]) for i in range(displacement.shape[1])]))
-					historyCollection[haloNumber]['clusterDistance'] = distance / clusterRadius
-		except KeyError:
-			#The cluster coordinates aren't in this set.
-			pass
+	#When streaming, the cluster and then the hosts go first so that the environment of every other halo can be computed
+	#right away.
+	if streamOutput:
+		if addEnvironment | addHosts:
+			hostSet = set(hostHaloNumbers) if addHosts else set()
+			haloList = sorted(haloList, key=lambda halo: (halo.halo_number != 1, halo.halo_number not in hostSet))
+		#In pipeline mode, the prefetch thread uses the database session while environments are made, so the profilers,
+		#which may query the database, are made before it starts.
+		profilers = {}
+		if pipeline & computeRamPressure & ((keys is None) or all([key in keys for key in ['SSC', 'R200', 'Vcom']])):
+			profiledNumbers = set([halo.halo_number for halo in haloList if ((halo.halo_number == 1) & addEnvironment) or \
+			(addHosts and (halo.halo_number in hostSet))])
+			if len(profiledNumbers) > 0:
+				from clusterProfiler_powerlaw import ClusterProfiler
+				for haloNumber in sorted(profiledNumbers):
+					profilers[haloNumber] = ClusterProfiler(step, haloNumber=haloNumber)
+		if addHosts:
+			hostStream = HostStream([halo.halo_number for halo in haloList if halo.halo_number in hostSet], step, \
+			computeRamPressure=computeRamPressure, profilers=profilers)
+		historyCollection = HistoryCollectionWriter(outputName, compact=compact, compactDtype=compactDtype, pyramids=pyramids)
+	else:
+		historyCollection = {}
+	mergerSummaries = {}
+	environment = None
 
-		#Adding another key:  ram pressure
-		if computeRamPressure:
-			cp = ClusterProfiler(step)
-			clusterVelocity = historyCollection[1]['Vcom']
-			for h_index in range(len(haloList)):
-				haloNumber = haloList[h_index].halo_number
-				if (haloNumber == 1) | (haloNumber in failedHaloNumbers):
-					continue
+	try:
+		#All database work for a batch of halos happens in _fetchHalos.  In pipeline mode it runs in a background thread,
+		#ahead of the assembly and merger detection below.
+		fetchHalos = partial(_fetchHalos, maximumSkips=maximumSkips, cutoffDistance=cutoffDistance, bhString=bhString, \
+		keys=keys, computeMergers=computeMergers, massForRatio=massForRatio, \
+		mergerTree=mergerTree, spatialMatcher=spatialMatcher)
+		batches = [haloList[i:i+batchSize] for i in range(0, len(haloList), batchSize)]
+		if pipeline:
+			fetchedHalos = chain.from_iterable(prefetch(fetchHalos, batches, depth=prefetchDepth))
+		else:
+			fetchedHalos = chain.from_iterable(imap(fetchHalos, batches))
+
+		#Loop through and find histories.
+		for h_index, (haloNumber, rawHistory, mergerCandidates) in enumerate(fetchedHalos):
+			print "Processing halo_number {0}, halo {1} of {2}.".format(haloNumber, h_index+1, len(haloList))
+			if rawHistory is None:
+				#The galaxy lacks one of the items asked for, probably a BH.
+				print "   FAILED"
+				failedHaloNumbers.append(haloNumber)
+				if streamOutput & addHosts:
+					for releasedNumber, releasedBook in hostStream.fail(haloNumber):
+						historyCollection.write(releasedNumber, releasedBook)
+				continue
+			rawColumns, schema, usedKeys = rawHistory
+			historyBook = assembleHistory(rawColumns, schema, usedKeys, bhString=bhString)
+			if computeMergers:
+				mergerTimes, mergerRatios, mergerProgenitors = findMergers(mergerCandidates, returnProgenitors=True)
+				historyBook['mergerTimes'] = mergerTimes
+				historyBook['mergerRatios'] = mergerRatios
+				historyBook['mergerProgenitors'] = mergerProgenitors
+				mergerSummaries[haloNumber] = {'mergerTimes': mergerTimes, 'mergerRatios': mergerRatios, \
+				'mergerProgenitors': mergerProgenitors}
+
+			if streamOutput:
+				#Only the cluster's environment state stays in memory.  Everything else is written right away.
+				if addEnvironment:
+					if haloNumber == 1:
+						environment = ClusterEnvironment(historyBook, step, computeRamPressure=computeRamPressure, \
+						profiler=profilers.get(1))
+					elif environment is not None:
+						environment.addTo(historyBook)
+				if addHosts:
+					for releasedNumber, releasedBook in hostStream.add(haloNumber, historyBook):
+						historyCollection.write(releasedNumber, releasedBook)
 				else:
-					clusterDensity = cp.computeGasDensity(historyCollection[haloNumber]['clusterDistance'], \
-					historyCollection[haloNumber]['time'])
-					relativeVelocities = historyCollection[haloNumber]['Vcom'] - clusterVelocity
-					relativeSpeedSquared = np.array([np.dot(relativeVelocities[:,i],relativeVelocities[:,i]) for i in range(relativeVelocities.shape[1])])
-					historyCollection[haloNumber]['ramPressure'] = clusterDensity * relativeSpeedSquared * constants.M_sun / (constants.pc * 1e3)**3 * 1e6
+					historyCollection.write(haloNumber, historyBook)
+			else:
+				historyCollection[haloNumber] = historyBook
+
+		if addEnvironment & (not streamOutput):
+			addClusterEnvironment(historyCollection, step, computeRamPressure=computeRamPressure)
+		if addHosts & (not streamOutput):
+			addHostEnvironment(historyCollection, hostHaloNumbers, step, computeRamPressure=computeRamPressure)
 	
-	#Pickle the output
-	historyCollection['failedHaloNumbers'] = failedHaloNumbers
-	with open(pickleName, 'w') as myfile:
-		pickle.dump(historyCollection, myfile)
+		#Pickle the output
+		if streamOutput:
+			if addHosts:
+				for releasedNumber, releasedBook in hostStream.finish():
+					historyCollection.write(releasedNumber, releasedBook)
+			if prevalidate:
+				historyCollection.write('traceability', traceabilityReport)
+			historyCollection.write('failedHaloNumbers', failedHaloNumbers)
+			if computeMergers:
+				historyCollection.write('mergerCatalogue', buildMergerCatalogue(mergerSummaries))
+	finally:
+		#The index is written even if a halo raises, so that the books already written can be read.
+		if streamOutput:
+			historyCollection.close()
+
+	if not streamOutput:
+		historyCollection['failedHaloNumbers'] = failedHaloNumbers
+		if prevalidate:
+			historyCollection['traceability'] = traceabilityReport
+		if computeMergers:
+			historyCollection['mergerCatalogue'] = buildMergerCatalogue(mergerSummaries)
+		if compact:
+			historyCollection = compactCollection(historyCollection, dtype=compactDtype)
+		with open(outputName, 'w') as myfile:
+			pickle.dump(historyCollection, myfile)
 	
 	t_end = time.time()
 
+	if shard is not None:
+		#The manifest is written last, so that it only exists if the shard is complete.
+		writeManifest(manifestFileName(pickleName, shardIndex, nShards), {'simulation': \
+		step.simulation.basename, 'step': step.extension, 'shardIndex': shardIndex, 'nShards': nShards, 'output': outputName, \
+		'selectedHaloNumbers': selectedHaloNumbers, 'writtenHaloNumbers': [haloNumber for haloNumber in selectedHaloNumbers \
+		if haloNumber not in failedHaloNumbers], 'failedHaloNumbers': [int(haloNumber) for haloNumber in failedHaloNumbers], \
+		'hasCluster': hasCluster, 'computeRamPressure': computeRamPressure, 'computeMergers': computeMergers, 'keys': keys, \
+		'compact': compact, 'hostHaloNumbers': hostHaloNumbers, 'minStellarMass': minStellarMass, 'contaminationTolerance': \
+		contaminationTolerance, 'minDarkParticles': minDarkParticles, 'requireBH': requireBH, 'maximumSkips': maximumSkips, \
+		'cutoffDistance': cutoffDistance, 'bhString': bhString, 'hours': (t_end-t_start)/60/60, 'traceability': traceabilityReport if prevalidate else None})
+
 	print "Process complete after {0:3.2f} hours.".format((t_end-t_start)/60/60)
-	print "Saved to {0}.".format(pickleName)
+	print "Saved to {0}.".format(outputName)
 
 	if emailAddress is not None:
 		#Send an optional email alert.
+		import smtplib
+		from email.mime.text import MIMEText
 		msg = MIMEText("Hey there!\n\nIt's me, your friend the HistoryMaker.  I'm just emailing to let you know that the collection you asked for is done.  It took me {0:3.2f} hours to complete.\n\nRegards,\nHM".format((t_end-t_start)/60/60))
 		msg['From'] = "HistoryMaker"
 		msg['To'] = emailAddress
@@ -114,3 +249,108 @@ def createHistoryCollection(step, pickleName, maximumSkips=5, cutoffDistance=2,
 		s = smtplib.SMTP('localhost')
 		s.sendmail("HistoryMaker", [emailAddress], msg.as_string())
 		s.quit()
+
+def _fetchHalos(halos, maximumSkips=5, cutoffDistance=2, bhString="bh('BH_mass', 'max', 'BH_central')", keys=None, \
+	computeMergers=True, massForRatio='Mstar', mergerTree=None, spatialMatcher=None):
+	"""
+	Do all of the database work for some halos of createHistoryCollection.  More than one halo are cascaded together
+	with queryHistories.
+
+	:returns fetchedHalos - for each halo, a tuple of
+		haloNumber - the halo number of halo
+		rawHistory - the output of queryHistory, or None if the halo lacks something asked for
+		mergerCandidates - the output of gatherMergerCandidates, or None
+	"""
+
+	if len(halos) == 1:
+		try:
+			rawHistories = [queryHistory(halos[0], maximumSkips=maximumSkips, cutoffDistance=cutoffDistance, bhString=bhString, \
+			keys=keys, spatialMatcher=spatialMatcher)]
+		except NoResultsError:
+			rawHistories = [None]
+	else:
+		rawHistories = queryHistories(halos, maximumSkips=maximumSkips, cutoffDistance=cutoffDistance, bhString=bhString, keys=keys, \
+		spatialMatcher=spatialMatcher)
+
+	#The merger branch goes back further than the history when the history stops with its black hole, so it gets its own
+	#cascade unless the history's branch is the same.  A MergerTree finds the branch itself.
+	branches = [historyBranch(rawHistory) if rawHistory is not None else (None, None) for rawHistory in rawHistories]
+	if computeMergers & (mergerTree is None):
+		cascadeIndices = [h_index for h_index, rawHistory in enumerate(rawHistories) \
+		if (rawHistory is not None) and (branches[h_index][0] is None)]
+		if len(cascadeIndices) > 0:
+			cascadedBranches = batched_reverse_property_cascade([halos[h_index] for h_index in cascadeIndices], \
+			["t()", "halo_number()"], maximumSkips=maximumSkips, cutoffDistance=cutoffDistance, spatialMatcher=spatialMatcher)
+			for h_index, (times, halo_numbers) in zip(cascadeIndices, cascadedBranches):
+				branches[h_index] = (times, halo_numbers)
+
+	fetchedHalos = []
+	for halo, rawHistory, (times, halo_numbers) in zip(halos, rawHistories, branches):
+		if (rawHistory is not None) & computeMergers:
+			mergerCandidates = gatherMergerCandidates(halo, maximumSkips=maximumSkips, cutoffDistance=cutoffDistance, \
+			massForRatio=massForRatio, times=times, halo_numbers=halo_numbers, tree=mergerTree, spatialMatcher=spatialMatcher)
+		else:
+			mergerCandidates = None
+		fetchedHalos.append((halo.halo_number, rawHistory, mergerCandidates))
+	return fetchedHalos
+
+class ClusterEnvironment(object):
+
+	def __init__(self, clusterBook, step, computeRamPressure=True, profiler=None):
+		"""
+		Keep what is needed from the cluster's historyBook to compute the distance from the cluster center and the ram
+		pressure of any other halo.
+
+		:arg clusterBook - the historyBook of halo 1
+		:arg step - the timestep the collection starts from, for the ClusterProfiler
+
+		:kwarg computeRamPressure - whether to add ramPressure as well as clusterDistance
+		:kwarg profiler - the ClusterProfiler of halo 1, if it is already made
+		"""
+
+		self.clusterCoordinates = clusterBook.get('SSC')
+		self.clusterRadius = clusterBook.get('R200')
+		self.clusterVelocity = clusterBook.get('Vcom')
+		if computeRamPressure & all([value is not None for value in [self.clusterCoordinates, self.clusterRadius, self.clusterVelocity]]):
+			if profiler is None:
+				#Only cluster simulations need scipy.
+				from clusterProfiler_powerlaw import ClusterProfiler
+				profiler = ClusterProfiler(step)
+			self.profiler = profiler
+		else:
+			self.profiler = None
+
+	def addTo(self, historyBook):
+		"""
+		Add clusterDistance and, if possible, ramPressure to a historyBook.
+		"""
+
+		#Adding one new key:  The distance from the cluster center
+		if (self.clusterCoordinates is None) | (self.clusterRadius is None) | ('SSC' not in historyBook):
+			return
+		displacement = historyBook['SSC'] - self.clusterCoordinates
+		distance = np.sqrt(np.sum(displacement**2, axis=0))
+		historyBook['clusterDistance'] = distance / self.clusterRadius
+
+		#Adding another key:  ram pressure
+		if (self.profiler is None) | ('Vcom' not in historyBook):
+			return
+		clusterDensity = self.profiler.computeGasDensity(historyBook['clusterDistance'], historyBook['time'])
+		relativeVelocities = historyBook['Vcom'] - self.clusterVelocity
+		relativeSpeedSquared = np.sum(relativeVelocities**2, axis=0)
+		historyBook['ramPressure'] = clusterDensity * relativeSpeedSquared * constants.M_sun / (constants.pc * 1e3)**3 * 1e6
+
+def addClusterEnvironment(historyCollection, step, computeRamPressure=True):
+	"""
+	Add the distance from the cluster center and the ram pressure to every historyBook of a collection, taking halo 1
+	as the cluster.
+	"""
+
+	if 1 not in historyCollection:
+		#The cluster coordinates aren't in this set.
+		return
+	print "Computing cluster distances."
+	environment = ClusterEnvironment(historyCollection[1], step, computeRamPressure=computeRamPressure)
+	for haloNumber in [key for key in historyCollection.keys() if isinstance(key, int)]:
+		if haloNumber != 1:
+			environment.addTo(historyCollection[haloNumber])
@@ -0,0 +1,117 @@
+"""
+ARR: 10.19.26
+
+One collection-wide table of the mergers found by stitched_merger_finder, with sorted indexes so that
+questions about all mergers in a time window or above a ratio do not have to loop over every halo.
+"""
+
+import numpy as np
+
+mergerDtype = [('haloNumber', int), ('tStart', float), ('tEnd', float), ('ratio', float), \
+('primaryProgenitor', int), ('secondaryProgenitor', int)]
+
+def buildMergerCatalogue(historyCollection):
+	"""
+	Gather the mergerTimes, mergerRatios and mergerProgenitors of every historyBook in a collection.
+
+	:arg historyCollection - a collection made by createHistoryCollection
+
+	:returns catalogue - structured array with mergerDtype, sorted by haloNumber and then tStart.  Progenitors that
+	were not recorded are -1.
+	"""
+
+	rows = []
+	for haloNumber in [key for key in historyCollection.keys() if isinstance(key, int)]:
+		#Merger information is kept as it is in compact books, so there is no need to expand them.
+		historyBook = dict.__getitem__(historyCollection, haloNumber)
+		if 'mergerTimes' not in historyBook:
+			continue
+		mergerTimes = np.array(historyBook['mergerTimes']).reshape(-1,2)
+		mergerRatios = historyBook['mergerRatios']
+		mergerProgenitors = historyBook.get('mergerProgenitors', np.full((len(mergerRatios),2), -1, dtype=int))
+		for m_index in range(len(mergerRatios)):
+			rows.append((haloNumber, mergerTimes[m_index,0], mergerTimes[m_index,1], mergerRatios[m_index], \
+			mergerProgenitors[m_index][0], mergerProgenitors[m_index][1]))
+
+	catalogue = np.array(rows, dtype=mergerDtype)
+	return np.sort(catalogue, order=['haloNumber', 'tStart'])
+
+class MergerCatalogue(object):
+
+	def __init__(self, source, haloNumbers=None):
+		"""
+		:arg source - a collection made by createHistoryCollection, or a structured array made by buildMergerCatalogue
+
+		:kwarg haloNumbers - every halo that was searched for mergers, including those without any.  Taken from the
+		collection if not given.
+		"""
+
+		if isinstance(source, dict):
+			if haloNumbers is None:
+				haloNumbers = [key for key in source.keys() if isinstance(key, int) and \
+				('mergerTimes' in dict.__getitem__(source, key))]
+			if 'mergerCatalogue' in source:
+				catalogue = source['mergerCatalogue']
+			else:
+				catalogue = buildMergerCatalogue(source)
+		else:
+			catalogue = source
+		if haloNumbers is None:
+			haloNumbers = np.unique(catalogue['haloNumber'])
+
+		self.catalogue = np.sort(np.asarray(catalogue, dtype=mergerDtype), order=['haloNumber', 'tStart'])
+		self.haloNumbers = np.unique(haloNumbers)
+
+		#Sorted indexes, so that every query is a pair of binary searches.
+		self._tEndOrder = np.argsort(self.catalogue['tEnd'], kind='mergesort')
+		self._sortedTEnd = self.catalogue['tEnd'][self._tEndOrder]
+		self._ratioOrder = np.argsort(self.catalogue['ratio'], kind='mergesort')
+		self._sortedRatio = self.catalogue['ratio'][self._ratioOrder]
+
+	def __len__(self):
+		return len(self.catalogue)
+
+	def between(self, tMin, tMax, minRatio=0, maxRatio=np.inf):
+		"""
+		Mergers that end between tMin and tMax Gyr, with minRatio <= ratio <= maxRatio.
+
+		:returns mergers - structured array with mergerDtype
+		"""
+
+		start = np.searchsorted(self._sortedTEnd, tMin, side='left')
+		stop = np.searchsorted(self._sortedTEnd, tMax, side='right')
+		mergers = self.catalogue[self._tEndOrder[start:stop]]
+		return mergers[(mergers['ratio'] >= minRatio) & (mergers['ratio'] <= maxRatio)]
+
+	def aboveRatio(self, minRatio, maxRatio=np.inf):
+		"""
+		Mergers with minRatio <= ratio <= maxRatio, at any time.
+		"""
+
+		start = np.searchsorted(self._sortedRatio, minRatio, side='left')
+		stop = np.searchsorted(self._sortedRatio, maxRatio, side='right')
+		return self.catalogue[np.sort(self._ratioOrder[start:stop])]
+
+	def mergersOf(self, haloNumber, minRatio=0, maxRatio=np.inf):
+		"""
+		Mergers along the main branch of one halo, in order of time.
+		"""
+
+		start = np.searchsorted(self.catalogue['haloNumber'], haloNumber, side='left')
+		stop = np.searchsorted(self.catalogue['haloNumber'], haloNumber, side='right')
+		mergers = self.catalogue[start:stop]
+		return mergers[(mergers['ratio'] >= minRatio) & (mergers['ratio'] <= maxRatio)]
+
+	def haloNumbersWith(self, minRatio, tMin=-np.inf, tMax=np.inf):
+		"""
+		Halos with at least one merger above minRatio ending between tMin and tMax Gyr.
+		"""
+
+		return np.unique(self.between(tMin, tMax, minRatio=minRatio)['haloNumber'])
+
+	def haloNumbersWithout(self, minRatio, tMin=-np.inf, tMax=np.inf):
+		"""
+		Halos with no merger above minRatio ending between tMin and tMax Gyr, e.g. no merger above 0.25 since z=1.
+		"""
+
+		return np.setdiff1d(self.haloNumbers, self.haloNumbersWith(minRatio, tMin=tMin, tMax=tMax))
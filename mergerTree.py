@@ -0,0 +1,396 @@
+"""
+ARR: 10.19.26
+
+The merger tree of a whole simulation, read from the tangos link tables once and kept in flat arrays.
+Links are stored CSR-style: the links of node i are linkTargets[linkOffsets[i]:linkOffsets[i+1]], sorted
+by decreasing weight.  Main branches, stitching across gaps and merger candidates are then found with
+array lookups instead of database queries.
+"""
+
+import numpy as np
+from util.cache import cachePath, loadCache, saveCache
+from timestepIndex import TimestepIndex
+
+#Properties kept for every halo and black hole.  Stitching needs BH_central_distance.
+defaultTreeProperties = ['Mstar', 'Mvir', 'Mgas', 'BH_mass', 'BH_central_distance']
+
+#Live properties that the tree can answer by itself.
+_liveProperties = ['t()', 'z()', 'halo_number()', 'dbid()']
+
+#The merger candidates skipped by mergerCandidates because a child lacks massForRatio, and those children.
+missingMassCounts = {'steps': 0, 'children': 0}
+
+class MergerTree(object):
+
+	def __init__(self, arrays):
+		"""
+		Use extractMergerTree or fromSimulation to make a tree from the database.
+
+		:arg arrays - dictionary with
+			simulationName - the basename of the simulation
+			stepTimes, stepRedshifts, stepExtensions - one entry per timestep, in order of time
+			haloIds, stepIndex, haloNumber, typeCode - one entry per node (halo or black hole), sorted by haloIds
+			linkOffsets, linkTargets, linkWeights, linkRelations - the links from each node
+			relationNames - the name of each relation code
+			properties - dictionary of float arrays with one entry per node, nan where missing
+		"""
+
+		self.arrays = arrays
+		self.simulationName = arrays['simulationName']
+		self.stepTimes = arrays['stepTimes']
+		self.stepRedshifts = arrays['stepRedshifts']
+		self.stepExtensions = arrays['stepExtensions']
+		self.haloIds = arrays['haloIds']
+		self.stepIndex = arrays['stepIndex']
+		self.haloNumber = arrays['haloNumber']
+		self.typeCode = arrays['typeCode']
+		self.linkOffsets = arrays['linkOffsets']
+		self.linkTargets = arrays['linkTargets']
+		self.linkWeights = arrays['linkWeights']
+		self.linkRelations = arrays['linkRelations']
+		self.relationNames = list(arrays['relationNames'])
+		self.properties = arrays['properties']
+
+		#The major progenitor and descendant of each node, as tangos finds them with previous and next.
+		self.progenitor = self._majorLink(-1)
+		self.descendant = self._majorLink(1)
+		self._nodeKeys = None
+		self._timestepIndex = None
+
+	@classmethod
+	def fromSimulation(cls, simulation, propertyNames=defaultTreeProperties, useCache=True, cacheDirectory=None):
+		"""
+		The tree of a simulation, from the cache if it has been extracted before.
+
+		:arg simulation - a simulation of type tangos.core.Simulation, or its name
+		"""
+
+		if isinstance(simulation, str):
+			import tangos as db
+			simulation = db.get_simulation(simulation)
+		cacheFile = cachePath('mergerTree', simulation.basename, cacheDirectory=cacheDirectory)
+		arrays = loadCache(cacheFile) if useCache else None
+		if (arrays is None) or any([name not in arrays['properties'] for name in propertyNames]):
+			arrays = extractMergerTree(simulation, propertyNames=propertyNames)
+			if useCache:
+				saveCache(cacheFile, arrays)
+		return cls(arrays)
+
+	@classmethod
+	def load(cls, fileName):
+		"""
+		Read a tree written by save.
+		"""
+
+		arrays = loadCache(fileName)
+		if arrays is None:
+			raise IOError("Could not read a merger tree from {0}.".format(fileName))
+		return cls(arrays)
+
+	def save(self, fileName):
+		saveCache(fileName, self.arrays)
+
+	def __len__(self):
+		return len(self.haloIds)
+
+	def _majorLink(self, stepChange):
+		"""
+		For every node, the most strongly linked node stepChange steps away, or -1.
+		"""
+
+		sources = np.repeat(np.arange(len(self.haloIds)), np.diff(self.linkOffsets))
+		usable = self.stepIndex[self.linkTargets] == self.stepIndex[sources] + stepChange
+		output = np.full(len(self.haloIds), -1, dtype=int)
+		#Links are sorted by decreasing weight, so the first usable link of each node is the major one.
+		linkedNodes, firstLinks = np.unique(sources[usable], return_index=True)
+		output[linkedNodes] = self.linkTargets[usable][firstLinks]
+		return output
+
+	def relationCode(self, relation):
+		"""
+		The code of a relation name, or -1 if no link has it.
+		"""
+
+		if relation in self.relationNames:
+			return self.relationNames.index(relation)
+		return -1
+
+	def links(self, node, relation=None):
+		"""
+		The nodes linked from node, in order of decreasing weight.
+
+		:kwarg relation - only links of this relation, e.g. 'ptcls_in_common'
+
+		:returns targets, weights
+		"""
+
+		start, stop = self.linkOffsets[node], self.linkOffsets[node+1]
+		targets = self.linkTargets[start:stop]
+		weights = self.linkWeights[start:stop]
+		if relation is not None:
+			chosen = self.linkRelations[start:stop] == self.relationCode(relation)
+			targets = targets[chosen]
+			weights = weights[chosen]
+		return targets, weights
+
+	def nodeOf(self, halo):
+		"""
+		The node of a halo of type tangos.core.Halo.
+		"""
+
+		node = np.searchsorted(self.haloIds, halo.id)
+		if (node >= len(self.haloIds)) or (self.haloIds[node] != halo.id):
+			raise KeyError("Halo {0} is not in the merger tree of {1}.".format(halo.id, self.simulationName))
+		return node
+
+	def stepIndexOf(self, times):
+		"""
+		The index of the timestep closest to each time, in Gyr.
+		"""
+
+		if self._timestepIndex is None:
+			self._timestepIndex = TimestepIndex(self.stepTimes, redshifts=self.stepRedshifts)
+		return self._timestepIndex.nearest(np.atleast_1d(np.asarray(times, dtype=float)))
+
+	def findNodes(self, stepIndices, haloNumbers, typeCode=0):
+		"""
+		The nodes with the given timestep indices and halo numbers, or -1 where there are none.
+		"""
+
+		stepIndices = np.atleast_1d(stepIndices).astype(np.int64)
+		haloNumbers = np.atleast_1d(haloNumbers).astype(np.int64)
+		if self._nodeKeys is None:
+			#One sorted integer key per (type, step, halo number), so that lookups are binary searches.
+			self._keyBase = max(np.max(self.haloNumber)+1, 1) if len(self.haloNumber) > 0 else 1
+			keys = (self.typeCode.astype(np.int64)*len(self.stepTimes) + self.stepIndex)*self._keyBase + self.haloNumber
+			order = np.argsort(keys, kind='mergesort')
+			self._nodeKeys = (keys[order], order)
+		sortedKeys, order = self._nodeKeys
+		if len(sortedKeys) == 0:
+			return np.full(len(stepIndices), -1, dtype=int)
+		queries = (typeCode*len(self.stepTimes) + stepIndices)*self._keyBase + haloNumbers
+		positions = np.minimum(np.searchsorted(sortedKeys, queries), len(sortedKeys)-1)
+		found = (sortedKeys[positions] == queries) & (haloNumbers >= 0) & (haloNumbers < self._keyBase)
+		return np.where(found, order[positions], -1)
+
+	def values(self, name, nodes):
+		"""
+		A property of some nodes.  Besides the extracted properties, t(), z(), halo_number() and dbid() are known.
+		"""
+
+		nodes = np.asarray(nodes, dtype=int)
+		if name == 't()':
+			return self.stepTimes[self.stepIndex[nodes]]
+		elif name == 'z()':
+			return self.stepRedshifts[self.stepIndex[nodes]]
+		elif name == 'halo_number()':
+			return self.haloNumber[nodes]
+		elif name == 'dbid()':
+			return self.haloIds[nodes]
+		elif name in self.properties:
+			return self.properties[name][nodes]
+		raise KeyError("{0} is not in the merger tree of {1}.".format(name, self.simulationName))
+
+	def mainBranch(self, node):
+		"""
+		The node and its major progenitors, going back in time.
+		"""
+
+		branch = []
+		while node >= 0:
+			branch.append(node)
+			node = self.progenitor[node]
+		return np.array(branch, dtype=int)
+
+	def stitchedBranch(self, node, propertyList=[], maximumSkips=5, cutoffDistance=2):
+		"""
+		The main progenitor branch of a node, stitched across gaps as in stitched_reverse_property_cascade.  Only
+		nodes with every property in propertyList are kept.
+		"""
+
+		expectedLength = self.stepIndex[node] + 1
+		storedProperties = [name for name in propertyList if name not in _liveProperties]
+
+		branch = []
+		while node >= 0:
+			stretch = self.mainBranch(node)
+			hasAll = np.ones(len(stretch), dtype=bool)
+			for name in storedProperties:
+				hasAll &= ~np.isnan(self.values(name, stretch))
+			withData = stretch[hasAll]
+			if len(withData) == 0:
+				#Nothing along this stretch had the properties you wanted.
+				break
+			branch.extend(withData[:expectedLength-len(branch)])
+			if len(branch) == expectedLength:
+				#You did it!
+				break
+			node = self._stitchAcrossGap(withData[-1], maximumSkips=maximumSkips, cutoffDistance=cutoffDistance)
+		return np.array(branch, dtype=int)
+
+	def reverse_property_cascade(self, node, propertyList, maximumSkips=5, cutoffDistance=2):
+		"""
+		What stitched_reverse_property_cascade returns for the halo of node, for properties in the tree.
+		"""
+
+		branch = self.stitchedBranch(node, propertyList, maximumSkips=maximumSkips, cutoffDistance=cutoffDistance)
+		return [self.values(name, branch).tolist() for name in propertyList]
+
+	def _stitchAcrossGap(self, latest, maximumSkips=5, cutoffDistance=2):
+		"""
+		The same as stitched_reverse_property_cascade._stitchAcrossGap, with nodes.  Returns -1 if stitching failed.
+		"""
+
+		#Imported here, so that a saved tree can be used without tangos.
+		from stitched_reverse_property_cascade import _firstStitch
+
+		problem = self.progenitor[latest]
+		if problem < 0:
+			return -1
+
+		#Let's find the most central black hole.
+		centralDistances = self.properties['BH_central_distance']
+		holes = self.links(latest, 'BH_central')[0]
+		holes = holes[~np.isnan(centralDistances[holes])]
+		if len(holes) == 0:
+			return -1
+		hole = holes[np.argmin(centralDistances[holes])]
+		problemHole = self.progenitor[hole]
+		if problemHole < 0:
+			return -1
+		if len(self.links(problemHole, 'host_halo')[0]) > 0:
+			#Make sure there really is a kink in the tree going forward in time.
+			related = self.links(problem, 'ptcls_in_common')[0]
+			if (np.sum(self.stepIndex[related] == self.stepIndex[latest]) == 1) & (latest in related):
+				return -1
+		if centralDistances[hole] > cutoffDistance:
+			return -1
+
+		#Retrace its steps.  Progenitors are always one step back, so position k is k steps before the hole.
+		trajectory = self.mainBranch(hole)
+		hosts = np.array([self._firstLink(node, 'host_halo') for node in trajectory], dtype=int)
+		distances = centralDistances[trajectory]
+		present = (hosts >= 0) & ~np.isnan(distances)
+		stitchOffset = _firstStitch(present, distances, maximumSkips=maximumSkips, cutoffDistance=cutoffDistance)
+		if stitchOffset is None:
+			return -1
+		return hosts[stitchOffset]
+
+	def _firstLink(self, node, relation):
+		targets = self.links(node, relation)[0]
+		return targets[0] if len(targets) > 0 else -1
+
+	def mergerCandidates(self, branch, massForRatio='Mstar'):
+		"""
+		The same as gatherMergerCandidates, for a main progenitor branch of nodes going back in time.  Where a child
+		lacks massForRatio, its ratio cannot be known, so the whole candidate is skipped and counted in missingMassCounts.
+
+		:returns candidates - list of (previousTime, currentTime, childMasses, childHaloNumbers)
+		"""
+
+		masses = self.properties[massForRatio]
+		candidates = []
+		skippedSteps = 0
+		skippedChildren = 0
+		for node in branch[:-1]:
+			step = self.stepIndex[node]
+			if step == 0:
+				continue
+			relatives = self.links(node, 'ptcls_in_common')[0]
+			relativeSteps = self.stepIndex[relatives]
+
+			#More than one parent node means that there is probably a fake merger here.
+			if np.sum(relativeSteps == step+1) > 1:
+				continue
+
+			#Children are those halos which share particles and are in the previous step
+			children = relatives[relativeSteps == step-1]
+			if len(children) < 2:
+				continue
+			missing = np.sum(np.isnan(masses[children]))
+			if missing > 0:
+				skippedSteps += 1
+				skippedChildren += missing
+				continue
+			candidates.append((self.stepTimes[step-1], self.stepTimes[step], masses[children], self.haloNumber[children]))
+
+		if skippedSteps > 0:
+			print "   Skipped {0} merger candidates with {1} children lacking {2}.".format(skippedSteps, skippedChildren, massForRatio)
+			missingMassCounts['steps'] += skippedSteps
+			missingMassCounts['children'] += int(skippedChildren)
+		return candidates
+
+def extractMergerTree(simulation, propertyNames=defaultTreeProperties):
+	"""
+	Read the halos, links and some properties of a simulation from the tangos tables, with one query per table.
+
+	:arg simulation - a simulation of type tangos.core.Simulation
+
+	:returns arrays - the dictionary expected by MergerTree
+	"""
+
+	import tangos as db
+	session = db.core.get_default_session()
+	timesteps = simulation.timesteps
+	stepIds = [step.id for step in timesteps]
+	stepPosition = dict([(stepId, s_index) for s_index, stepId in enumerate(stepIds)])
+
+	#Nodes
+	haloRows = np.array(session.query(db.core.Halo.id, db.core.Halo.timestep_id, db.core.Halo.halo_number, \
+	db.core.Halo.object_typecode).filter(db.core.Halo.timestep_id.in_(stepIds)).order_by(db.core.Halo.id).all(), dtype=int).reshape(-1,4)
+	haloIds = haloRows[:,0]
+	stepIndex = np.array([stepPosition[stepId] for stepId in haloRows[:,1]], dtype=int)
+
+	#Links, kept only if both ends are in this simulation.
+	linkRows = session.query(db.core.HaloLink.halo_from_id, db.core.HaloLink.halo_to_id, db.core.HaloLink.weight, \
+	db.core.HaloLink.relation_id).join(db.core.Halo, db.core.HaloLink.halo_from_id == db.core.Halo.id).\
+	filter(db.core.Halo.timestep_id.in_(stepIds)).all()
+	linkRows = np.array([(row[0], row[1], row[2] if row[2] is not None else 0.0, row[3]) for row in linkRows], dtype=float).reshape(-1,4)
+	sources = _nodesOfIds(haloIds, linkRows[:,0].astype(int))
+	targets = _nodesOfIds(haloIds, linkRows[:,1].astype(int))
+	inside = (sources >= 0) & (targets >= 0)
+	sources, targets, linkRows = sources[inside], targets[inside], linkRows[inside]
+
+	relationIds, linkRelations = np.unique(linkRows[:,3].astype(int), return_inverse=True)
+	relationTexts = dict(session.query(db.core.DictionaryItem.id, db.core.DictionaryItem.text).\
+	filter(db.core.DictionaryItem.id.in_(relationIds.tolist())).all())
+	relationNames = [relationTexts.get(relationId, '') for relationId in relationIds]
+
+	#CSR layout, sorted by source and then by decreasing weight.
+	order = np.lexsort((-linkRows[:,2], sources))
+	linkOffsets = np.concatenate(([0], np.cumsum(np.bincount(sources, minlength=len(haloIds)))))
+
+	#Properties, with one query each.
+	properties = {}
+	for name in propertyNames:
+		values = np.full(len(haloIds), np.nan)
+		try:
+			nameId = db.core.get_dict_id(name)
+		except KeyError:
+			properties[name] = values
+			continue
+		propertyRows = session.query(db.core.HaloProperty.halo_id, db.core.HaloProperty.data_float).\
+		join(db.core.Halo, db.core.HaloProperty.halo_id == db.core.Halo.id).filter(db.core.Halo.timestep_id.in_(stepIds)).\
+		filter(db.core.HaloProperty.name_id == nameId).filter(db.core.HaloProperty.deprecated == False).all()
+		propertyRows = [row for row in propertyRows if row[1] is not None]
+		if len(propertyRows) > 0:
+			nodes = _nodesOfIds(haloIds, np.array([row[0] for row in propertyRows], dtype=int))
+			values[nodes[nodes >= 0]] = np.array([row[1] for row in propertyRows], dtype=float)[nodes >= 0]
+		properties[name] = values
+
+	return {'simulationName': simulation.basename, 'stepTimes': np.array([step.time_gyr for step in timesteps], dtype=float), \
+	'stepRedshifts': np.array([step.redshift for step in timesteps], dtype=float), \
+	'stepExtensions': np.array([step.extension for step in timesteps]), 'haloIds': haloIds, 'stepIndex': stepIndex, \
+	'haloNumber': haloRows[:,2], 'typeCode': haloRows[:,3], 'linkOffsets': linkOffsets, 'linkTargets': targets[order], \
+	'linkWeights': linkRows[order,2], 'linkRelations': linkRelations[order], 'relationNames': relationNames, \
+	'properties': properties}
+
+def _nodesOfIds(haloIds, ids):
+	"""
+	The positions of database ids in the sorted haloIds, or -1 where they are not there.
+	"""
+
+	if len(haloIds) == 0:
+		return np.full(len(ids), -1, dtype=int)
+	positions = np.minimum(np.searchsorted(haloIds, ids), len(haloIds)-1)
+	return np.where(haloIds[positions] == ids, positions, -1)
@@ -5,10 +5,13 @@ Plot the results of makeHistoryCollection.py
 """
 
 import matplotlib.pyplot as plt
-from tangos.examples import mergers
 import numpy as np
 from util import makeGaussianSmoothingKernel, t2z
 import cPickle as pickle
+from historyStorage import loadHistoryCollection
+from mergerCatalogue import MergerCatalogue
+from derivedQuantities import DerivedHistoryBook
+import contactSheet
 
 class HistoryPlotter(object):
 
@@ -21,12 +24,14 @@ class HistoryPlotter(object):
 		"""
 
 		#Read dictionary.
-		with open(inputPickleName, 'r') as myfile:
-			self.historyBook = pickle.load(myfile)
+		self.historyBook = loadHistoryCollection(inputPickleName)
 
 		#Save halo numbers for ease of access.  Only grabbing integers, since there may be other keys.
 		self.haloNumbers = np.array([key for key in self.historyBook.keys() if isinstance(key, int)])
 
+		#All mergers in one table, so that markers don't need to filter each halo's list.
+		self.mergerCatalogue = MergerCatalogue(self.historyBook)
+
 		#These are commonly used plotting options.
 		self.showMergers = showMergers
 		self.majorMergerThreshold = majorMergerThreshold
@@ -52,6 +57,7 @@ class HistoryPlotter(object):
 		self.outputDirectory = outputDirectory
 		self._smoothingWidth = smoothingWidth
 		self._smoothingKernel = makeGaussianSmoothingKernel(smoothingWidth)
+		self._derived = None
 
 	@property
 	def smoothingWidth(self):
@@ -62,26 +68,31 @@ class HistoryPlotter(object):
 		self._smoothingWidth = value
 		self._smoothingKernel = makeGaussianSmoothingKernel(value)
 
+	def _derivedBook(self, haloNumber):
+		"""
+		The historyBook of a halo with its derived quantities.  The last one is kept, since plots go one halo at a time.
+		"""
+
+		historyBook = self.historyBook[haloNumber]
+		if (self._derived is None) or (self._derived.historyBook is not historyBook):
+			self._derived = DerivedHistoryBook(historyBook)
+		return self._derived
+
 	def _addMergerMarkers(self, ax, haloNumber):
 		"""
 		Add merger bars to the plot.
 		"""
 
-		try:
-			mergerTimes = self.historyBook[haloNumber]['mergerTimes']
-			mergerRatios = self.historyBook[haloNumber]['mergerRatios']
-		except KeyError:
+		if haloNumber not in self.mergerCatalogue.haloNumbers:
 			print "Warning: Merger information is not available for halo number {0}.".format(haloNumber)
 			return
 
-		for j in range(len(mergerTimes)):
-			if mergerRatios[j] < self.minorMergerThreshold:
-				continue
-			if mergerRatios[j] > self.majorMergerThreshold:
+		for merger in self.mergerCatalogue.mergersOf(haloNumber, minRatio=self.minorMergerThreshold):
+			if merger['ratio'] > self.majorMergerThreshold:
 				color = 'r'
 			else:
 				color = 'k'
-			ax.fill_between([mergerTimes[j][0],mergerTimes[j][1]], [-1e100,-1e100], [1e100,1e100], color=color, alpha=mergerRatios[j])
+			ax.fill_between([merger['tStart'],merger['tEnd']], [-1e100,-1e100], [1e100,1e100], color=color, alpha=merger['ratio'])
 
 	def _addDistanceAxis(self, ax, haloNumber, xlim=None, ylim=None):
 		"""
@@ -160,28 +171,24 @@ class HistoryPlotter(object):
 		haloNumbers = np.atleast_1d(haloNumberList)
 		for haloNumber in haloNumbers:
 			fig, ax = plt.subplots()
-			hasBH = 'Mbh' in self.historyBook[haloNumber].keys()
+			historyBook = self._derivedBook(haloNumber)
+			hasBH = 'Mbh' in historyBook.keys()
 
 			#Smooth data
-			smooth_sfr = np.convolve(self.historyBook[haloNumber]['SFR'], self._smoothingKernel, mode='same')
+			smooth_sfr = np.convolve(historyBook['SFR'], self._smoothingKernel, mode='same')
 			if hasBH:
-				smooth_bhar = np.convolve(self.historyBook[haloNumber]['BHAR'], self._smoothingKernel, mode='same')
-			time = self.historyBook[haloNumber]['time']
+				smooth_bhar = np.convolve(historyBook['BHAR_scaled'], self._smoothingKernel, mode='same')
+			time = historyBook['time']
 
 			#Let's also estimate the amount of gas mass depletion.
 			if showGas:
-				mgas = self.historyBook[haloNumber]['Mgas']
-				dMdt_total = np.zeros(time.shape)
-				dMdt_total[1:-1] = (mgas[2:] - mgas[:-2]) / (time[2:] - time[:-2])
-				dMdt_total[0] = (mgas[1] - mgas[0]) / (time[1] - time[0])
-				dMdt_total[-1] = (mgas[-1] - mgas[-2]) / (time[-1] - time[-2])
-				dMdt_total /= 1e9
+				dMdt_total = historyBook['dMgas_dt']
 
 			#Plot
 			if self.showSFR:
 				ax.plot(time, smooth_sfr, lw=2, color='b', ls='-', label=r"$\dot{M}_*$")
 			if (hasBH) & (self.showBHAR):
-				ax.plot(time, smooth_bhar/7e-4, lw=2, color='g', ls='-', label=r"$\dot{M}_\bullet$/7e-4")
+				ax.plot(time, smooth_bhar, lw=2, color='g', ls='-', label=r"$\dot{M}_\bullet$/7e-4")
 			if showGas:
 				ax.plot(time, -1*dMdt_total, lw=2, color='r', ls='-', label=r"$-\dot{M}_g$")
 
@@ -227,13 +234,14 @@ class HistoryPlotter(object):
 		for haloNumber in haloNumbers:
 			fig, ax = plt.subplots()
 
-			hasBH = 'Mbh' in self.historyBook[haloNumber].keys()
+			historyBook = self._derivedBook(haloNumber)
+			hasBH = 'Mbh' in historyBook.keys()
 			#Smooth data
 			if self.showSFR:
-				smooth_ssfr = np.convolve(self.historyBook[haloNumber]['SFR']/self.historyBook[haloNumber]['Mstar'], self._smoothingKernel, mode='same')
+				smooth_ssfr = np.convolve(historyBook['sSFR'], self._smoothingKernel, mode='same')
 			if (hasBH) & (self.showBHAR):
-				smooth_sbhar = np.convolve(self.historyBook[haloNumber]['BHAR']/self.historyBook[haloNumber]['Mbh'], self._smoothingKernel, mode='same')
-			time = self.historyBook[haloNumber]['time']
+				smooth_sbhar = np.convolve(historyBook['sBHAR'], self._smoothingKernel, mode='same')
+			time = historyBook['time']
 			
 			#Plot
 			ax.plot(time, smooth_ssfr, lw=2, color='b', ls='-', label=r"$\dot{M}_*/M_*$")
@@ -341,6 +349,82 @@ class HistoryPlotter(object):
 				raw_input("Please enter when finished.\n")
                         plt.close()
 
+	def _sheetCurves(self, kind, haloNumber):
+		"""
+		The curves of one halo for a contact sheet, as (x, y, color).
+		"""
+
+		historyBook = self._derivedBook(haloNumber)
+		hasBH = 'Mbh' in historyBook.keys()
+		time = historyBook['time']
+		curves = []
+		if kind == 'growth':
+			if self.showSFR:
+				curves.append((time, np.convolve(historyBook['SFR'], self._smoothingKernel, mode='same'), 'b'))
+			if (hasBH) & (self.showBHAR):
+				curves.append((time, np.convolve(historyBook['BHAR_scaled'], self._smoothingKernel, mode='same'), 'g'))
+		elif kind == 'specificGrowth':
+			if self.showSFR:
+				curves.append((time, np.convolve(historyBook['sSFR'], self._smoothingKernel, mode='same'), 'b'))
+			if (hasBH) & (self.showBHAR):
+				curves.append((time, np.convolve(historyBook['sBHAR'], self._smoothingKernel, mode='same'), 'g'))
+		elif kind == 'mass':
+			for key, color, show in [('Mvir', 'k', self.showVirialMass), ('Mstar', 'b', self.showStellarMass), \
+			('Mbh', 'g', self.showBlackHoleMass & hasBH), ('Mgas', 'brown', self.showGasMass), ('Mcold', 'indigo', self.showColdMass)]:
+				if show & (key in historyBook):
+					curves.append((time, historyBook[key], color))
+		else:
+			raise ValueError("Unknown kind of contact sheet:  {0}".format(kind))
+		return curves
+
+	def plotContactSheets(self, kind='growth', haloNumberList=None, nRows=5, nColumns=5, xlim=None, ylim=None):
+		"""
+		The plots of plotGrowth, plotSpecificGrowth or plotMass for many halos at once, as grids of small panels with
+		shared axes.  Sheets are saved as {kind}_sheet{N}.png in outputDirectory.
+
+		:kwarg kind - 'growth', 'specificGrowth' or 'mass'
+		:kwarg haloNumberList - the halos to plot.  Default is every halo.
+		:kwarg nRows, nColumns - the number of panels on each sheet
+		"""
+
+		if haloNumberList is None:
+			haloNumbers = np.sort(self.haloNumbers)
+		else:
+			haloNumbers = np.atleast_1d(haloNumberList)
+		yscale = {'growth': 'linear', 'specificGrowth': 'log', 'mass': 'log'}[kind]
+		ylabel = {'growth': 'Growth Rate [M$_\odot$ yr$^{-1}$]', 'specificGrowth': 'Specific Growth Rate [yr$^{-1}$]', \
+		'mass': r'Mass [$M_\odot$]'}[kind]
+		if xlim is None:
+			xlim = (0, np.max([self.historyBook[haloNumber]['time'][-1] for haloNumber in haloNumbers]))
+
+		for p_index, page in enumerate(contactSheet.pages(haloNumbers, nRows=nRows, nColumns=nColumns)):
+			print "Plotting {0} sheet {1}.".format(kind, p_index)
+			pageCurves = [self._sheetCurves(kind, haloNumber) for haloNumber in page]
+			if ylim is not None:
+				pageYlim = ylim
+			elif kind == 'growth':
+				pageYlim = (0, 1.3*np.nanmax([np.nanmax(y) for curves in pageCurves for x, y, color in curves] + [1e-3]))
+			elif kind == 'specificGrowth':
+				pageYlim = (1e-13, 1e-6)
+			else:
+				pageYlim = (1e6, 1e15)
+
+			fig, axes = contactSheet.makeSheet(nRows=nRows, nColumns=nColumns, xlim=xlim, ylim=pageYlim, yscale=yscale, \
+			xlabel=r'Age of the Universe [Gyr]', ylabel=ylabel)
+			for ax, haloNumber, curves in zip(axes, page, pageCurves):
+				contactSheet.addCurves(ax, curves)
+				if self.showMergers:
+					contactSheet.addMergerBands(ax, self.mergerCatalogue.mergersOf(haloNumber, minRatio=self.minorMergerThreshold), \
+					majorMergerThreshold=self.majorMergerThreshold)
+				if self.showLabel:
+					contactSheet.labelPanel(ax, "#{0}".format(haloNumber))
+
+			if self.outputDirectory is not None:
+				saveName = self.outputDirectory+'{0}_sheet{1}.png'.format(kind, p_index)
+			else:
+				saveName = None
+			contactSheet.finishSheet(fig, axes, len(page), nColumns=nColumns, saveName=saveName)
+
 	def makeAllPlots(self, haloNumberList=None):
 		"""
 		Make all of the plots for each of the halo numbers given.
@@ -1,14 +1,17 @@
 import cPickle as pickle
+from historyStorage import loadHistoryCollection
+from mergerCatalogue import MergerCatalogue
 import matplotlib.pyplot as plt
 import numpy as np
 from useProximityTable import ProximityCalculator
+import contactSheet
 
 class ProximityPlotter(object):
 
 	def __init__(self, historyFile, proximityFile, mode='threshold', massType='Mstar', ratioThreshold=0.1):
 
-		with open(historyFile, 'r') as myfile:
-			self.historyBook = pickle.load(myfile)
+		self.historyBook = loadHistoryCollection(historyFile)
+		self.mergerCatalogue = MergerCatalogue(self.historyBook)
 
 		self.proximityCalculator = ProximityCalculator(proximityFile, mode=mode, massType=massType, ratioThreshold=ratioThreshold)
 
@@ -17,21 +20,16 @@ class ProximityPlotter(object):
                 Add merger bars to the plot.
                 """
 
-                try:
-                        mergerTimes = self.historyBook[haloNumber]['mergerTimes']
-                        mergerRatios = self.historyBook[haloNumber]['mergerRatios']
-                except KeyError:
+                if haloNumber not in self.mergerCatalogue.haloNumbers:
                         print "Warning: Merger information is not available for halo number {0}.".format(haloNumber)
                         return
 
-                for j in range(len(mergerTimes)):
-                        if mergerRatios[j] < minorMergerThreshold:
-                                continue
-                        if mergerRatios[j] > majorMergerThreshold:
+                for merger in self.mergerCatalogue.mergersOf(haloNumber, minRatio=minorMergerThreshold):
+                        if merger['ratio'] > majorMergerThreshold:
                                 color = 'r'
                         else:
                                 color = 'k'
-                        ax.fill_between([mergerTimes[j][0],mergerTimes[j][1]], [-1e100,-1e100], [1e100,1e100], color=color, alpha=mergerRatios[j])
+                        ax.fill_between([merger['tStart'],merger['tEnd']], [-1e100,-1e100], [1e100,1e100], color=color, alpha=merger['ratio'])
 
 	def plotProximity(self, haloNumber, savename=None, showLabel=True, showLegend=True):
 
@@ -106,3 +104,32 @@ class ProximityPlotter(object):
 		for haloNumber in allHaloNumbers:
 			print "Halo Number = {0}".format(haloNumber)
 			self.plotProximity(haloNumber, savename=saveDirectory+'proximity_halo{0}.png'.format(haloNumber))
+
+	def plotContactSheets(self, haloNumberList=None, nRows=5, nColumns=5, saveDirectory='./proximityPlots/', \
+		minorMergerThreshold=0.1, majorMergerThreshold=0.25):
+		"""
+		The plots of plotProximity for many halos at once, as grids of small panels with shared axes.  Sheets are saved
+		as proximity_sheet{N}.png in saveDirectory.
+		"""
+
+		if haloNumberList is None:
+			haloNumbers = np.sort([key for key in self.historyBook.keys() if isinstance(key, int)])
+		else:
+			haloNumbers = np.atleast_1d(haloNumberList)
+
+		for p_index, page in enumerate(contactSheet.pages(haloNumbers, nRows=nRows, nColumns=nColumns)):
+			print "Plotting proximity sheet {0}.".format(p_index)
+			fig, axes = contactSheet.makeSheet(nRows=nRows, nColumns=nColumns, xlim=(0,14), ylim=(1e1,5e3), yscale='log', \
+			xlabel='Time [Gyr]', ylabel='Distance [kpc]')
+			for ax, haloNumber in zip(axes, page):
+				taxis = self.historyBook[haloNumber]['t_slice']
+				branchHaloNumbers = self.historyBook[haloNumber]['haloNumber']
+				proximity = self.proximityCalculator.retraceProximity(branchHaloNumbers, taxis)
+				radii = self.proximityCalculator.retraceVirialRadius(branchHaloNumbers, taxis)
+				clusterDistance = self.proximityCalculator.retraceClusterDistance(branchHaloNumbers, taxis)
+				contactSheet.addCurves(ax, [(taxis, proximity, 'forestgreen'), (taxis, clusterDistance, 'orange'), \
+				(taxis, radii, 'darkturquoise')])
+				contactSheet.addMergerBands(ax, self.mergerCatalogue.mergersOf(haloNumber, minRatio=minorMergerThreshold), \
+				majorMergerThreshold=majorMergerThreshold)
+				contactSheet.labelPanel(ax, "#{0}".format(haloNumber))
+			contactSheet.finishSheet(fig, axes, len(page), nColumns=nColumns, saveName=saveDirectory+'proximity_sheet{0}.png'.format(p_index))
@@ -0,0 +1,113 @@
+"""
+ARR: 10.19.26
+
+Registry mapping the keys of a historyBook to the tangos expressions they are built from and the
+rule used to put them on the histogram time axis.  Only the expressions needed for the requested
+keys are queried by makeHistory.
+"""
+
+import copy
+
+#Every entry is key: (expressions, rule, requiresBH).  Expressions that require a black hole are
+#prefixed with the bhString at query time.  Rules are interpreted by makeHistory:
+#	'raw' - the cascaded values, untouched
+#	'sfrHistogram' - stitch SFR histograms together
+#	'bharHistogram' - stitch BH accretion histograms together
+#	'bhMass' - retrace BH mass with the resolution of the accretion histogram
+#	'interpolate' - interpolate onto the histogram time axis, zero before the halo exists
+#	'interpolateInf' - same, but infinite before the halo exists
+#	'vector' - interpolate each dimension of a 3-vector, infinite before the halo exists
+#	'vectorZero' - same, but zero before the halo exists
+_commonSchema = {
+	"haloNumber": (["halo_number()"], 'raw', False),
+	"Mstar": (["Mstar"], 'interpolate', False),
+	"SFR": (["raw(SFR_histogram)"], 'sfrHistogram', False),
+	"Mvir": (["Mvir"], 'interpolate', False),
+	"R200": (["radius(200)"], 'interpolate', False),
+	"Mgas": (["Mgas"], 'interpolate', False),
+	"SSC": (["shrink_center"], 'vector', False),
+	"Mbh": (["BH_mass", "raw(BH_mdot_histogram)"], 'bhMass', True),
+	"BHAR": (["raw(BH_mdot_histogram)"], 'bharHistogram', True),
+	"Dbh": (["BH_central_distance"], 'interpolateInf', True)
+}
+
+_propertySchemas = {
+	'cosmo25': dict(_commonSchema, Mcold=(["Mcold"], 'interpolate', False)),
+	'h1.cosmo50': dict(_commonSchema, Mcold=(["MColdGas"], 'interpolate', False), Vcom=(["Vcom"], 'vectorZero', False))
+}
+
+#The time of each step is always needed to build the time axis.
+timeExpression = "t()"
+
+def getPropertySchema(simulationName):
+	"""
+	Return a copy of the schema for a simulation.
+
+	:arg simulationName - the basename of a tangos simulation
+
+	:returns schema - dictionary of key: (expressions, rule, requiresBH)
+	"""
+
+	try:
+		return copy.deepcopy(_propertySchemas[simulationName])
+	except KeyError:
+		raise KeyError("No property schema has been registered for simulation {0}.".format(simulationName))
+
+def registerProperty(simulationName, key, expressions, rule='interpolate', requiresBH=False):
+	"""
+	Add or replace an entry of a simulation's schema.
+
+	:arg simulationName - the basename of a tangos simulation.  A new schema is started if necessary.
+	:arg key - the name of the output in the historyBook
+	:arg expressions - a tangos expression, or list of them, that the rule needs
+
+	:kwarg rule - the post-processing rule, as listed at the top of this module
+	:kwarg requiresBH - whether the expressions belong to the black hole selected by bhString
+	"""
+
+	if isinstance(expressions, str):
+		expressions = [expressions]
+	if simulationName not in _propertySchemas:
+		_propertySchemas[simulationName] = {}
+	_propertySchemas[simulationName][key] = (list(expressions), rule, requiresBH)
+
+def selectQuery(schema, keys, hasBH, bhString):
+	"""
+	Find the minimal set of expressions to query for some keys.
+
+	:arg schema - a schema returned by getPropertySchema
+	:arg keys - the keys wanted, or None for every key available
+	:arg hasBH - whether the halo has a central black hole
+	:arg bhString - the selection of black hole to use
+
+	:returns expressions - list of unique tangos expressions, starting with the time
+	:returns usedKeys - the keys that can be built from them
+	"""
+
+	if keys is None:
+		keys = sorted(schema.keys())
+	expressions = [timeExpression]
+	usedKeys = []
+	for key in keys:
+		if key in ['time', 't_slice']:
+			continue
+		if key not in schema:
+			raise KeyError("{0} is not in the property schema.".format(key))
+		if schema[key][2] and not hasBH:
+			continue
+		for expression in fullExpressions(schema[key], bhString):
+			if expression not in expressions:
+				expressions.append(expression)
+		usedKeys.append(key)
+	return expressions, usedKeys
+
+def fullExpressions(entry, bhString):
+	"""
+	The expressions of a schema entry as they are sent to the database.
+	"""
+
+	rawExpressions, rule, requiresBH = entry
+	if requiresBH:
+		return [bhString + '.' + expression for expression in rawExpressions]
+	else:
+		return list(rawExpressions)
@@ -0,0 +1,147 @@
+"""
+ARR: 10.19.26
+
+A second way to stitch across gaps in a main progenitor branch, for halos without a central black hole.  The lost
+halo is matched by position, velocity and mass against every halo of the earlier steps, using a KD-tree per step.
+The columns of each step are gathered once, so a stitch does not hop through the database.
+"""
+
+import numpy as np
+from scipy.spatial import cKDTree
+import constants
+from haloSelection import HaloSelector
+from timestepIndex import TimestepIndex
+
+#One km/s for one Gyr, in kpc.
+kpcPerGyrPerKms = 1e9 * constants.yr / constants.pc
+
+class SpatialMatcher(object):
+	"""
+	Find the halo that a lost halo most likely was, some steps earlier.
+	"""
+
+	def __init__(self, positionTolerance=10, velocityTolerance=100, massTolerance=0.5, maximumSkips=5, \
+		positionKey='shrink_center', velocityKey='Vcom', massKey='Mvir', selector=None):
+		"""
+		:kwarg positionTolerance - the maximum distance in kpc between a candidate and where the lost halo is expected
+		to have been
+		:kwarg velocityTolerance - the maximum difference of velocity in km/s.  None ignores velocities.
+		:kwarg massTolerance - the maximum difference of log10 mass.  None ignores masses.
+		:kwarg maximumSkips - the number of earlier steps searched
+		:kwarg positionKey, velocityKey, massKey - the properties compared
+		:kwarg selector - a haloSelection.HaloSelector holding the columns of each step.  Default is a new one.
+		"""
+
+		self.positionTolerance = positionTolerance
+		self.velocityTolerance = velocityTolerance
+		self.massTolerance = massTolerance
+		self.maximumSkips = maximumSkips
+		self.positionKey = positionKey
+		self.velocityKey = velocityKey
+		self.massKey = massKey
+		self.selector = HaloSelector() if selector is None else selector
+		self.kdTrees = {}
+
+	def _expressions(self):
+		expressions = [self.positionKey]
+		if self.velocityTolerance is not None:
+			expressions.append(self.velocityKey)
+		if self.massTolerance is not None:
+			expressions.append(self.massKey)
+		return expressions
+
+	def stepColumns(self, step):
+		"""
+		The columns of a step, and a KD-tree of the halos with a position.
+
+		:returns columns - as returned by HaloSelector.columns
+		:returns kdTree - a cKDTree, or None if no halo has a position
+		:returns treeRows - the row of columns of each point of kdTree
+		"""
+
+		columns = self.selector.columns(step, self._expressions())
+		key = (step.simulation.basename, step.extension)
+		if key not in self.kdTrees:
+			positions = columns[self.positionKey]
+			if positions.ndim == 2:
+				treeRows = np.where(np.all(np.isfinite(positions), axis=1))[0]
+			else:
+				treeRows = np.array([], dtype=int)
+			kdTree = cKDTree(positions[treeRows]) if len(treeRows) > 0 else None
+			self.kdTrees[key] = (kdTree, treeRows)
+		kdTree, treeRows = self.kdTrees[key]
+		return columns, kdTree, treeRows
+
+	def match(self, step, haloNumber, candidateSteps, exclude=[]):
+		"""
+		Compare a halo with the halos of some earlier steps, and return the best match of the first step with one.
+
+		:arg step - the timestep of the lost halo
+		:arg haloNumber - its halo number
+		:arg candidateSteps - earlier timesteps, in the order they should be tried
+
+		:kwarg exclude - (step extension, halo number) pairs that may not be matched
+
+		:returns candidateStep, candidateHaloNumber - or None, None if nothing is within tolerance
+		"""
+
+		columns = self.stepColumns(step)[0]
+		row = np.where(columns['halo_number()'] == haloNumber)[0]
+		if (len(row) == 0) or (columns[self.positionKey].ndim != 2):
+			return None, None
+		row = row[0]
+		position = columns[self.positionKey][row]
+		if not np.all(np.isfinite(position)):
+			return None, None
+		velocity = columns[self.velocityKey][row] if self.velocityTolerance is not None else None
+		mass = columns[self.massKey][row] if self.massTolerance is not None else None
+
+		for candidateStep in candidateSteps:
+			candidateColumns, kdTree, treeRows = self.stepColumns(candidateStep)
+			if kdTree is None:
+				continue
+
+			#Where the halo should have been, moving back along its velocity.
+			expected = position
+			if (velocity is not None) and np.all(np.isfinite(velocity)):
+				expected = position - velocity * (step.time_gyr - candidateStep.time_gyr) * kpcPerGyrPerKms
+			candidateRows = treeRows[np.array(kdTree.query_ball_point(expected, self.positionTolerance), dtype=int)]
+			excluded = [number for extension, number in exclude if extension == candidateStep.extension]
+			candidateRows = candidateRows[~np.in1d(candidateColumns['halo_number()'][candidateRows], excluded)]
+			if len(candidateRows) == 0:
+				continue
+
+			#Each difference in units of its tolerance.  Candidates lacking a compared property fail.
+			score = np.sum((candidateColumns[self.positionKey][candidateRows] - expected)**2, axis=1) / self.positionTolerance**2
+			with np.errstate(invalid='ignore', divide='ignore'):
+				if (velocity is not None) and np.all(np.isfinite(velocity)):
+					velocityScore = np.sum((candidateColumns[self.velocityKey][candidateRows] - velocity)**2, axis=1) / \
+					self.velocityTolerance**2
+					score = np.where(velocityScore <= 1, score + velocityScore, np.nan)
+				if (mass is not None) and np.isfinite(mass) and (mass > 0):
+					massScore = (np.log10(candidateColumns[self.massKey][candidateRows] / mass) / self.massTolerance)**2
+					score = np.where(massScore <= 1, score + massScore, np.nan)
+			if np.all(np.isnan(score)):
+				continue
+			return candidateStep, candidateColumns['halo_number()'][candidateRows[np.nanargmin(score)]]
+		return None, None
+
+	def stitch(self, latestHalo, exclude=[]):
+		"""
+		Given the last halo before a break in the main progenitor branch, find the halo to continue from in the
+		maximumSkips steps before it.
+
+		:kwarg exclude - halos of type tangos.core.Halo that may not be matched
+
+		:returns halo - the halo to continue from, or None if stitching failed
+		"""
+
+		stepIndex = TimestepIndex.fromSimulation(latestHalo.timestep.simulation)
+		timesteps = stepIndex.timesteps
+		s_index = stepIndex.indexOf(latestHalo.timestep)
+		candidateSteps = timesteps[max(s_index-self.maximumSkips, 0):s_index][::-1]
+		candidateStep, haloNumber = self.match(latestHalo.timestep, latestHalo.halo_number, candidateSteps, \
+		exclude=[(halo.timestep.extension, halo.halo_number) for halo in exclude if halo is not None])
+		if candidateStep is None:
+			return None
+		return self.selector.halos(candidateStep, [haloNumber])[0]
@@ -8,8 +8,10 @@ import tangos as db
 from tangos.live_calculation import NoResultsError
 import numpy as np
 from stitched_reverse_property_cascade import *
+from timestepIndex import TimestepIndex
 
-def stitched_merger_finder(halo, maximumSkips=5, cutoffDistance=2, massForRatio='Mstar'):
+def stitched_merger_finder(halo, maximumSkips=5, cutoffDistance=2, massForRatio='Mstar', returnProgenitors=False, tree=None, \
+	spatialMatcher=None):
         """
         Given a halo and a list of properties, do a reverse property cascade and try to correct for missing halos
         by following central black holes.
@@ -22,26 +24,75 @@ def stitched_merger_finder(halo, maximumSkips=5, cutoffDistance=2, massForRatio=
         :kwarg cutoffDistance - the maximum number of kpc that the central black hole is allowed to be from the 
         center of its host halo for tracking
 	:kwarg massForRatio - the key to use for mass ratios
+	:kwarg returnProgenitors - also return the halo numbers of the merging progenitors
+	:kwarg tree - a MergerTree of the simulation, to find mergers without the database
+	:kwarg spatialMatcher - a spatialStitching.SpatialMatcher, as in stitched_reverse_property_cascade
 
         :returns mergerTimes - 2d array of merger times, since we only know the interval of merger times
 	:returns mergerRatios - ratios taken with the mass specified
+	:returns mergerProgenitors - (only if returnProgenitors) 2d array with the halo numbers of the most massive
+	progenitor and of the one that sets the ratio
         """
 
+	return findMergers(gatherMergerCandidates(halo, maximumSkips=maximumSkips, cutoffDistance=cutoffDistance, \
+	massForRatio=massForRatio, tree=tree, spatialMatcher=spatialMatcher), returnProgenitors=returnProgenitors)
+
+def historyBranch(rawHistory):
+	"""
+	The t() and halo_number() of a history cascade, if its main branch is the one gatherMergerCandidates would cascade
+	on its own.  Tangos drops steps that lack any of the properties asked for, so a history with black hole properties
+	stops where the black hole does and cannot be used.
+
+	:arg rawHistory - the output of queryHistory
+
+	:returns times, halo_numbers - the branch, or None, None if it has to be cascaded again
+	"""
+
+	rawColumns, schema, usedKeys = rawHistory
+	if ("t()" not in rawColumns) or ("halo_number()" not in rawColumns) or any([schema[key][2] for key in usedKeys]):
+		return None, None
+	return rawColumns["t()"], rawColumns["halo_number()"]
+
+def gatherMergerCandidates(halo, maximumSkips=5, cutoffDistance=2, massForRatio='Mstar', times=None, halo_numbers=None, \
+	tree=None, spatialMatcher=None):
+	"""
+	The database half of stitched_merger_finder.  Collect the masses of the children of every halo along the
+	main progenitor branch that has more than one of them.
+
+	:kwarg times, halo_numbers - the t() and halo_number() of the stitched main progenitor branch, if they
+	have already been cascaded.  Otherwise, a cascade is done here.
+	:kwarg tree - a MergerTree of the simulation.  If given, the branch and the children are found in the tree
+	instead of the database.  massForRatio must have been extracted into the tree.
+	:kwarg spatialMatcher - a spatialStitching.SpatialMatcher, for the cascade done here
+
+	:returns candidates - list of (previousTime, currentTime, childMasses, childHaloNumbers)
+	"""
+
+	if tree is not None:
+		if (times is None) | (halo_numbers is None):
+			branch = tree.stitchedBranch(tree.nodeOf(halo), maximumSkips=maximumSkips, cutoffDistance=cutoffDistance)
+		else:
+			branch = tree.findNodes(tree.stepIndexOf(times), halo_numbers)
+			branch = branch[branch >= 0]
+		return tree.mergerCandidates(branch, massForRatio=massForRatio)
+
 	#First, get all progenitor halos in this roundabout way.
-        times, halo_numbers = stitched_reverse_property_cascade(halo, ["t()", "halo_number()"], maximumSkips=maximumSkips, cutoffDistance=cutoffDistance)
-	timesteps = halo.timestep.simulation.timesteps
+	if (times is None) | (halo_numbers is None):
+		times, halo_numbers = stitched_reverse_property_cascade(halo, ["t()", "halo_number()"], maximumSkips=maximumSkips, cutoffDistance=cutoffDistance, \
+		spatialMatcher=spatialMatcher)
+	stepIndex = TimestepIndex.fromSimulation(halo.timestep.simulation)
 	halos = []
-	allTimes = np.array([step.time_gyr for step in timesteps])
-	for t, h_number in zip(times, halo_numbers):
-		matchedStep = timesteps[np.where(allTimes==t)[0][0]]
+	for s_index, h_number, t in zip(stepIndex.exact(times), halo_numbers, times):
+		if s_index < 0:
+			raise ValueError("No timestep of {0} is at t = {1} Gyr.".format(halo.timestep.simulation.basename, t))
+		matchedStep = stepIndex.timesteps[s_index]
 		all_halo_numbers, = matchedStep.gather_property('halo_number()')
 		matchedHaloIndex = np.where(all_halo_numbers == h_number)[0][0]
 		halos.append(matchedStep.halos[matchedHaloIndex])
 	halos = np.array(halos)
 
 	#Next, we're going to look at all of the halos along the main progenitor branch and see how many children there are.
-	mergerTimes = []
-	mergerRatios = []
+	candidates = []
 	for halo in halos[:-1]:
 		currentTime = halo.timestep.time_gyr
 		previousTime = halo.timestep.previous.time_gyr
@@ -63,11 +114,29 @@ def stitched_merger_finder(halo, maximumSkips=5, cutoffDistance=2, massForRatio=
 		if len(children) < 2:
 			continue
 
+		candidates.append((previousTime, currentTime, np.array([child[massForRatio] for child in children]), \
+		np.array([child.halo_number for child in children])))
+
+	return candidates
+
+def findMergers(candidates, returnProgenitors=False):
+	"""
+	The numerical half of stitched_merger_finder.  Turn the output of gatherMergerCandidates into merger times
+	and ratios, and optionally the halo numbers of the progenitors.
+	"""
+
+	mergerTimes = []
+	mergerRatios = []
+	mergerProgenitors = []
+	for previousTime, currentTime, childMasses, childHaloNumbers in candidates:
 		#If you've made it this far, you can compute mass ratios and times.
-		childMasses = np.array([child[massForRatio] for child in children])
 		maximumMass = np.max(childMasses)
-		mergerRatio = np.max(childMasses[childMasses!=maximumMass]) / maximumMass
+		secondaryMass = np.max(childMasses[childMasses!=maximumMass])
+		mergerRatio = secondaryMass / maximumMass
 		mergerTimes.append([previousTime,currentTime])
 		mergerRatios.append(mergerRatio)
-		
+		mergerProgenitors.append([childHaloNumbers[childMasses==maximumMass][0], childHaloNumbers[childMasses==secondaryMass][0]])
+
+	if returnProgenitors:
+		return np.array(mergerTimes), np.array(mergerRatios), np.array(mergerProgenitors, dtype=int)
 	return np.array(mergerTimes), np.array(mergerRatios)
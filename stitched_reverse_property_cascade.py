@@ -7,8 +7,12 @@ Attempts to correct for errors in reverse_property_cascade due to poor halo find
 import tangos as db
 from tangos.live_calculation import NoResultsError
 import numpy as np
+from timestepIndex import TimestepIndex
 
-def stitched_reverse_property_cascade(halo, propertyList, maximumSkips=5, cutoffDistance=2):
+#The number of gaps searched across and of those stitched, for costEstimator.
+stitchCounts = {'searches': 0, 'stitched': 0}
+
+def stitched_reverse_property_cascade(halo, propertyList, maximumSkips=5, cutoffDistance=2, tree=None, spatialMatcher=None):
         """
         Given a halo and a list of properties, do a reverse property cascade and try to correct for missing halos
         by following central black holes.
@@ -20,14 +24,21 @@ def stitched_reverse_property_cascade(halo, propertyList, maximumSkips=5, cutoff
         tracking the central black hole backwards in time
         :kwarg cutoffDistance - the maximum number of kpc that the central black hole is allowed to be from the 
         center of its host halo for tracking
+	:kwarg tree - a MergerTree of the simulation.  If given, the cascade is done with the tree instead of the
+	database, and only properties extracted into the tree can be asked for.
+	:kwarg spatialMatcher - a spatialStitching.SpatialMatcher, to stitch by position, velocity and mass where the
+	central black hole cannot be followed
 
         :returns outputList - a list of properties going back in time, just like halo.reverse_property_cascade() 
         is supposed to return.  Note that this is indeed list instead of array format, due to shape inconsistencies
 	 with raw histograms.
         """
 
+	if tree is not None:
+		return tree.reverse_property_cascade(tree.nodeOf(halo), propertyList, maximumSkips=maximumSkips, cutoffDistance=cutoffDistance)
+
         #Try to get as many values as the index of the halo's timestep.
-        expectedLength = halo.timestep.simulation.timesteps.index(halo.timestep) + 1
+        expectedLength = TimestepIndex.fromSimulation(halo.timestep.simulation).indexOf(halo.timestep) + 1
         outputList = [[] for prop in propertyList]
 
         while True:
@@ -49,64 +60,215 @@ def stitched_reverse_property_cascade(halo, propertyList, maximumSkips=5, cutoff
                                 latestHalo = halo
                         else:
                                 latestHalo = halo.calculate('earlier({0})'.format(len(cascadedProperties[0])-1))
-                        problemHalo = latestHalo.previous
-                        if problemHalo is None:
-                                #That means the halo just didn't exist in the previous time step.  You should be done.
-                                break
-                        else:
-                                try:
-                                        #Let's find the most central black hole.  We'll track its halo history backwards.
-                                        holeBeforeProblem = latestHalo.calculate("bh('BH_central_distance', 'min', 'BH_central')")
-                                except NoResultsError:
-                                        #Too bad, there are no central black holes to do this with.  Abort.
-                                        break
-
-				problemHole = holeBeforeProblem.previous
-				if problemHole is None:
-					#The BH just got seeded and there's nothing else to do.
-					break
-				if 'host_halo' in problemHole.keys():
-					#Make sure there really is a kink in the tree going forward in time.
-					relatedHalos = problemHalo['ptcls_in_common']
-					if not hasattr(relatedHalos, '__len__'):
-						relatedHalos = [relatedHalos]
-					redshiftsOfChildHalos = [h.timestep.redshift for h in relatedHalos]
-					if (redshiftsOfChildHalos.count(latestHalo.timestep.redshift) == 1) & (latestHalo in relatedHalos):
-						#There was no problem with identifying the halo; something else went wrong.  Maybe a key you're after went missing.
-						break
-
-                                if holeBeforeProblem['BH_central_distance'] > cutoffDistance:
-                                        #Alas, that's not much of a central black hole.  Abort.
-                                        break
-
-                                #Retrace its steps to before the problem
-				try:
-					holePastProblem = holeBeforeProblem.calculate('earlier(2)')
-					hostPastProblem = holePastProblem['host_halo']
-				except:
-					#No previous time step, or the SMBH has no host.
-					break
-                                nSkips = 1
-                                stitchFound = False
-                                while (nSkips <= maximumSkips) & (holePastProblem.previous is not None):
-                                        if holePastProblem['BH_central_distance'] <= cutoffDistance:
-                                                #The gap has been breached!
-                                                stitchFound = True
-                                                break
-                                        else:
-                                                #This probably means that this SMBH is actually in a satellite that the halo finder did not detect.
-                                                holePastProblem = holePastProblem.previous
-						if holePastProblem is None:
-							#The SMBH doesn't have previous time steps.  Tough.
-							break
-						else:
-							hostPastProblem = holePastProblem['host_halo']
-							nSkips += 1
-                                if stitchFound:
-                                        #Continue from the newly found halo.
-                                        halo = hostPastProblem
-                                else:
-                                        #Stitching failed.  Just exit now.
-                                        break
+			halo = _stitchAcrossGap(latestHalo, maximumSkips=maximumSkips, cutoffDistance=cutoffDistance, \
+			spatialMatcher=spatialMatcher)
+			if halo is None:
+				#Stitching failed.  Just exit now.
+				break
 
         return outputList
+
+def batched_reverse_property_cascade(halos, propertyList, maximumSkips=5, cutoffDistance=2, spatialMatcher=None):
+	"""
+	The same as stitched_reverse_property_cascade, but for many halos at once.  The main progenitor branches
+	are walked together one timestep at a time, with a single query per timestep for all of the halos that
+	are in it.  Breaks in the branches are stitched just like in stitched_reverse_property_cascade.
+
+	:arg halos - a list of halos of type tangos.core.Halo
+	:arg propertyList - list of strings corresponding to halo keys
+
+	:kwarg maximumSkips - as in stitched_reverse_property_cascade
+	:kwarg cutoffDistance - as in stitched_reverse_property_cascade
+	:kwarg spatialMatcher - as in stitched_reverse_property_cascade
+
+	:returns outputLists - for each halo, what stitched_reverse_property_cascade would return
+	"""
+
+	from tangos import live_calculation
+
+	#The first column is the link to the main progenitor.
+	calculation = live_calculation.parser.parse_property_names('earlier(1)', *propertyList)
+
+	outputLists = [[[] for prop in propertyList] for halo in halos]
+	expectedLengths = [TimestepIndex.fromSimulation(halo.timestep.simulation).indexOf(halo.timestep) + 1 for halo in halos]
+
+	#For each halo, the halo currently being queried and the last one along this stretch of branch with data.
+	currentHalos = list(halos)
+	latestHalos = [None] * len(halos)
+
+	while True:
+		activeIndices = [i for i in range(len(halos)) if currentHalos[i] is not None]
+		if len(activeIndices) == 0:
+			break
+
+		#One query for each timestep that has active halos.  Later timesteps first, so stitched halos join their new step.
+		activeSteps = {}
+		for i in activeIndices:
+			activeSteps.setdefault(currentHalos[i].timestep_id, []).append(i)
+		stepId = max(activeSteps.keys(), key=lambda s: currentHalos[activeSteps[s][0]].timestep.time_gyr)
+		stepIndices = activeSteps[stepId]
+
+		try:
+			values = calculation.values([currentHalos[i] for i in stepIndices])
+		except live_calculation.NoResultsError:
+			#Missing properties that you wanted.
+			for i in stepIndices:
+				currentHalos[i] = None
+			continue
+
+		for column, i in enumerate(stepIndices):
+			progenitor = values[0,column]
+			properties = values[1:,column]
+			if all([value is not None for value in properties]):
+				for p_index in range(len(propertyList)):
+					outputLists[i][p_index].append(_toList(properties[p_index]))
+				latestHalos[i] = currentHalos[i]
+
+			if len(outputLists[i][0]) == expectedLengths[i]:
+				#You did it!
+				currentHalos[i] = None
+			elif progenitor is not None:
+				currentHalos[i] = progenitor
+			elif latestHalos[i] is None:
+				#Nothing along this stretch had the properties you wanted.
+				currentHalos[i] = None
+			else:
+				currentHalos[i] = _stitchAcrossGap(latestHalos[i], maximumSkips=maximumSkips, cutoffDistance=cutoffDistance, \
+				spatialMatcher=spatialMatcher)
+				latestHalos[i] = None
+
+	return outputLists
+
+def _toList(value):
+	"""
+	Match the list conversion done by stitched_reverse_property_cascade.
+	"""
+
+	if hasattr(value, 'tolist'):
+		return value.tolist()
+	else:
+		return value
+
+def _stitchAcrossGap(latestHalo, maximumSkips=5, cutoffDistance=2, spatialMatcher=None):
+	"""
+	Given the last halo before a break in the main progenitor branch, try to find the halo on the other side of
+	the break by following the central black hole backwards in time.  If that fails and there is a spatialMatcher,
+	try matching by position, velocity and mass instead.
+
+	:arg latestHalo - the last halo for which there is data
+
+	:returns halo - the halo to continue from, or None if stitching failed
+	"""
+
+	stitchCounts['searches'] += 1
+	halo = _stitchWithBlackHole(latestHalo, maximumSkips=maximumSkips, cutoffDistance=cutoffDistance)
+	if (halo is None) and (spatialMatcher is not None):
+		#The halo the branch broke at is not a match, or the cascade would go through it again.
+		halo = spatialMatcher.stitch(latestHalo, exclude=[latestHalo.previous])
+	if halo is not None:
+		stitchCounts['stitched'] += 1
+	return halo
+
+def _stitchWithBlackHole(latestHalo, maximumSkips=5, cutoffDistance=2):
+	"""
+	The black hole half of _stitchAcrossGap.
+	"""
+
+	problemHalo = latestHalo.previous
+	if problemHalo is None:
+		#That means the halo just didn't exist in the previous time step.  You should be done.
+		return None
+
+	try:
+		#Let's find the most central black hole.  We'll track its halo history backwards.
+		holeBeforeProblem = latestHalo.calculate("bh('BH_central_distance', 'min', 'BH_central')")
+	except NoResultsError:
+		#Too bad, there are no central black holes to do this with.  Abort.
+		return None
+
+	problemHole = holeBeforeProblem.previous
+	if problemHole is None:
+		#The BH just got seeded and there's nothing else to do.
+		return None
+	if 'host_halo' in problemHole.keys():
+		#Make sure there really is a kink in the tree going forward in time.
+		relatedHalos = problemHalo['ptcls_in_common']
+		if not hasattr(relatedHalos, '__len__'):
+			relatedHalos = [relatedHalos]
+		redshiftsOfChildHalos = [h.timestep.redshift for h in relatedHalos]
+		if (redshiftsOfChildHalos.count(latestHalo.timestep.redshift) == 1) & (latestHalo in relatedHalos):
+			#There was no problem with identifying the halo; something else went wrong.  Maybe a key you're after went missing.
+			return None
+
+	if holeBeforeProblem['BH_central_distance'] > cutoffDistance:
+		#Alas, that's not much of a central black hole.  Abort.
+		return None
+
+	#Retrace its steps to before the problem.  The whole trajectory is fetched at once; offset k is k steps before the hole.
+	present, distances, hosts = _blackHoleTrajectory(holeBeforeProblem)
+
+	stitchOffset = _firstStitch(present, distances, maximumSkips=maximumSkips, cutoffDistance=cutoffDistance)
+	if stitchOffset is None:
+		return None
+	#Continue from the newly found halo.
+	return hosts[stitchOffset]
+
+def _firstStitch(present, distances, maximumSkips=5, cutoffDistance=2):
+	"""
+	Find where a black hole's trajectory breaches a gap in the main progenitor branch of its host.
+
+	:arg present - boolean array, True where the progenitor k steps back has a distance and a host
+	:arg distances - BH_central_distance of the progenitor k steps back
+
+	:returns offset - the number of steps back of the first progenitor close to the center of its host, or None
+	"""
+
+	#Candidates start two steps back.  Each needs an earlier step of its own, just like hopping along with previous.
+	candidateOffsets = np.arange(2, min(2+maximumSkips, len(present)-1))
+	if (len(present) < 3) or (not present[2]):
+		#No previous time step, or the SMBH has no host.
+		return None
+	if len(candidateOffsets) == 0:
+		return None
+
+	#The gap is breached at the first candidate close to the center of its host.  A candidate without data ends the search.
+	stitched = present[candidateOffsets] & (distances[candidateOffsets] <= cutoffDistance)
+	ended = stitched | ~present[candidateOffsets]
+	if not np.any(ended):
+		#This SMBH stayed in a satellite that the halo finder did not detect.  Stitching failed.
+		return None
+	firstEvent = np.argmax(ended)
+	if stitched[firstEvent]:
+		return candidateOffsets[firstEvent]
+	else:
+		return None
+
+def _blackHoleTrajectory(hole):
+	"""
+	Fetch the central distance and host halo of a black hole and all of its progenitors in one query.
+
+	:arg hole - a black hole of type tangos.core.Halo
+
+	:returns present - boolean array, True where the progenitor k steps back has both properties
+	:returns distances - BH_central_distance of the progenitor k steps back (nan if not present)
+	:returns hosts - host_halo of the progenitor k steps back (None if not present)
+	"""
+
+	try:
+		times, distances, hosts = hole.calculate_for_progenitors('t()', 'BH_central_distance', 'host_halo')
+	except NoResultsError:
+		#No progenitor has both properties, so there is nothing to stitch along.
+		return np.zeros(0, dtype=bool), np.zeros(0), np.empty(0, dtype=object)
+
+	#Rows lacking a property are dropped by tangos, so place the rest by the number of steps back they are.
+	stepIndex = TimestepIndex.fromSimulation(hole.timestep.simulation)
+	offsets = stepIndex.indexOf(hole.timestep) - stepIndex.nearest(times).astype(int)
+
+	nOffsets = np.max(offsets)+1 if len(offsets) > 0 else 0
+	present = np.zeros(nOffsets, dtype=bool)
+	alignedDistances = np.full(nOffsets, np.nan)
+	alignedHosts = np.empty(nOffsets, dtype=object)
+	present[offsets] = True
+	alignedDistances[offsets] = distances
+	alignedHosts[offsets] = list(hosts)
+	return present, alignedDistances, alignedHosts
@@ -0,0 +1,104 @@
+"""
+ARR: 10.19.26
+
+One place to turn times into timesteps.  The times of a simulation are sorted once, and every lookup is a vectorized
+binary search instead of a scan through all of the steps.
+"""
+
+import numpy as np
+
+#Times closer than this, in Gyr, are the same time.
+defaultTolerance = 1e-6
+
+#One TimestepIndex per simulation, by basename.
+_simulationIndexes = {}
+
+class TimestepIndex(object):
+
+	def __init__(self, times, redshifts=None, stepIds=None, timesteps=None, tolerance=defaultTolerance):
+		"""
+		:arg times - the time of each step, in Gyr, in any order.  Positions returned by lookups refer to this order.
+
+		:kwarg redshifts - the redshift of each step
+		:kwarg stepIds - the database id of each step, for indexOf
+		:kwarg timesteps - the steps themselves, in the same order
+		:kwarg tolerance - the default tolerance of exact, in Gyr
+		"""
+
+		self.times = np.asarray(times, dtype=float)
+		self.redshifts = None if redshifts is None else np.asarray(redshifts, dtype=float)
+		self.stepIds = None if stepIds is None else np.asarray(stepIds, dtype=int)
+		self.timesteps = timesteps
+		self.tolerance = tolerance
+
+		#A stable sort, so that of equal times the first one is found, as np.argmin would.
+		self._order = np.argsort(self.times, kind='mergesort')
+		self._sortedTimes = self.times[self._order]
+		if self.stepIds is not None:
+			self._positionOfId = dict([(stepId, position) for position, stepId in enumerate(self.stepIds)])
+
+	@classmethod
+	def fromSimulation(cls, simulation):
+		"""
+		The index of a simulation of type tangos.core.Simulation.  It is made once and then shared until forget.
+		"""
+
+		if simulation.basename not in _simulationIndexes:
+			timesteps = simulation.timesteps
+			_simulationIndexes[simulation.basename] = cls([step.time_gyr for step in timesteps], \
+			redshifts=[step.redshift for step in timesteps], stepIds=[step.id for step in timesteps], timesteps=timesteps)
+		return _simulationIndexes[simulation.basename]
+
+	@staticmethod
+	def forget(simulation=None):
+		"""
+		Drop the shared index of one simulation, or of all of them, along with the timesteps it holds.  The next
+		fromSimulation reads the timesteps again in the current session.
+		"""
+
+		if simulation is None:
+			_simulationIndexes.clear()
+		else:
+			_simulationIndexes.pop(simulation.basename, None)
+
+	def __len__(self):
+		return len(self.times)
+
+	def nearest(self, times):
+		"""
+		The position of the step closest to each time.  The same as np.argmin(np.abs(self.times - t)) for each t.
+		"""
+
+		times = np.asarray(times, dtype=float)
+		if len(self.times) == 0:
+			raise ValueError("There are no steps to look up.")
+		above = np.clip(np.searchsorted(self._sortedTimes, times, side='left'), 0, len(self._sortedTimes)-1)
+		#The first of any equal times below.
+		below = np.searchsorted(self._sortedTimes, self._sortedTimes[np.maximum(above-1, 0)], side='left')
+
+		distanceAbove = np.abs(self._sortedTimes[above] - times)
+		distanceBelow = np.abs(self._sortedTimes[below] - times)
+		takeAbove = (distanceAbove < distanceBelow) | ((distanceAbove == distanceBelow) & \
+		(self._order[above] < self._order[below]))
+		return self._order[np.where(takeAbove, above, below)]
+
+	def exact(self, times, tolerance=None):
+		"""
+		The position of the step at each time, or -1 where no step is within tolerance.
+		"""
+
+		if tolerance is None:
+			tolerance = self.tolerance
+		times = np.asarray(times, dtype=float)
+		positions = self.nearest(times)
+		return np.where(np.abs(self.times[positions] - times) <= tolerance, positions, -1)
+
+	def indexOf(self, step):
+		"""
+		The position of a timestep, found by its id.
+		"""
+
+		return self._positionOfId[step.id]
+
+	def redshiftNearest(self, times):
+		return self.redshifts[self.nearest(times)]
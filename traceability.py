@@ -0,0 +1,79 @@
+"""
+ARR: 10.19.26
+
+Find out which halos can be traced before tracing any of them.  The main branches of all halos are cascaded
+together with only cheap stand-ins for the expressions makeHistory needs:  raw histograms are left out, and those of
+the black hole are replaced by the link to the black hole itself, which is what is usually missing.  Each halo is then
+traceable, partially traceable back to some time, or untraceable.
+"""
+
+import numpy as np
+from stitched_reverse_property_cascade import batched_reverse_property_cascade
+from propertySchema import getPropertySchema, selectQuery, timeExpression
+from timestepIndex import TimestepIndex
+
+TRACEABLE = 'traceable'
+PARTIAL = 'partial'
+UNTRACEABLE = 'untraceable'
+
+def probeExpressions(expressions, bhString):
+	"""
+	Cheap stand-ins for a list of expressions.  Raw histograms are too large to check, so they are assumed to be there
+	whenever their halo or black hole is.
+
+	:returns probes - list of unique expressions, starting with the time
+	"""
+
+	probes = [timeExpression]
+	for expression in expressions:
+		if 'raw(' in expression:
+			if expression.startswith(bhString + '.'):
+				probe = bhString
+			else:
+				continue
+		else:
+			probe = expression
+		if probe not in probes:
+			probes.append(probe)
+	return probes
+
+def checkTraceability(halos, bhString="bh('BH_central_distance', 'min', 'BH_central')", keys=None, maximumSkips=5, \
+	cutoffDistance=2, spatialMatcher=None):
+	"""
+	Sort halos by how far back makeHistory will be able to trace them, with one batched cascade for all of them.
+
+	:arg halos - a list of halos of type tangos.core.Halo
+
+	:kwarg bhString, keys, maximumSkips, cutoffDistance, spatialMatcher - as they will be given to makeHistory
+
+	:returns report - dictionary with lists of the halo numbers that are TRACEABLE, PARTIAL and UNTRACEABLE, and for
+	PARTIAL halos, 'truncationTimes' and 'truncationSteps', the earliest time and step extension that will be reached
+	"""
+
+	#Halos that need the same expressions are probed together, as in queryHistories.
+	groups = {}
+	for h_index, halo in enumerate(halos):
+		hasBH = 'BH_central' in halo.keys()
+		schema = getPropertySchema(halo.timestep.simulation.basename)
+		probes = probeExpressions(selectQuery(schema, keys, hasBH, bhString)[0], bhString)
+		groups.setdefault(tuple(probes), []).append(h_index)
+
+	report = {TRACEABLE: [], PARTIAL: [], UNTRACEABLE: [], 'truncationTimes': {}, 'truncationSteps': {}}
+	for probes, indices in groups.items():
+		print "Checking the main branches of {0} halos for {1}.".format(len(indices), list(probes))
+		probeLists = batched_reverse_property_cascade([halos[i] for i in indices], list(probes), maximumSkips=maximumSkips, \
+		cutoffDistance=cutoffDistance, spatialMatcher=spatialMatcher)
+		for h_index, probeList in zip(indices, probeLists):
+			halo = halos[h_index]
+			times = probeList[0]
+			stepIndex = TimestepIndex.fromSimulation(halo.timestep.simulation)
+			#Stitches skip steps, so a halo is traceable if it reaches the first step, however many rows it has.
+			if len(times) == 0:
+				report[UNTRACEABLE].append(halo.halo_number)
+			elif stepIndex.exact(np.min(times)) == np.argmin(stepIndex.times):
+				report[TRACEABLE].append(halo.halo_number)
+			else:
+				report[PARTIAL].append(halo.halo_number)
+				report['truncationTimes'][halo.halo_number] = np.min(times)
+				report['truncationSteps'][halo.halo_number] = stepIndex.timesteps[stepIndex.nearest(np.min(times))].extension
+	return report
@@ -1,5 +1,7 @@
 import cPickle as pickle
 import numpy as np
+from timestepIndex import TimestepIndex
+import compiledKernels
 
 class ProximityCalculator(object):
 
@@ -15,18 +17,37 @@ class ProximityCalculator(object):
 		self.mass = table[massType]
 		self.Rvir = table['Rvir']
 		self.distanceMatrix = table['distanceMatrix']
+		self.timeIndex = TimestepIndex(self.time)
 		
 		#Save kwargs
 		self.mode = mode
 		self.ratioThreshold = ratioThreshold
 
+		#The table flattened for compiledKernels, made when first needed.
+		self._flatTable = None
+
+	def _flattenTable(self):
+		if self._flatTable is None:
+			numbers, offsets = compiledKernels.flatten(self.haloNumber, dtype=np.int64)
+			masses = compiledKernels.flatten(self.mass)[0]
+			radii = compiledKernels.flatten(self.Rvir)[0]
+			distances, distanceOffsets = compiledKernels.flatten(self.distanceMatrix)
+			self._flatTable = (numbers, masses, radii, offsets, distances, distanceOffsets)
+		return self._flatTable
+
 	def retraceProximity(self, haloNumbers, times):
 
 		assert len(haloNumbers) == len(times)
 
 		output = np.zeros(len(haloNumbers))
+		timeIndices = self.timeIndex.nearest(times)
+		if compiledKernels.useCompiled & (self.mode in ['threshold', 'tidal']):
+			numbers, masses, radii, offsets, distances, distanceOffsets = self._flattenTable()
+			return compiledKernels.retraceProximityLoop(timeIndices.astype(np.int64), np.asarray(haloNumbers, dtype=np.int64), \
+			numbers, masses, radii, offsets, distances, distanceOffsets, self.mode == 'tidal', float(self.ratioThreshold))
+
 		for i in range(len(haloNumbers)):
-			t_index = np.argmin(np.abs(self.time - times[i]))
+			t_index = timeIndices[i]
 			haloMatch = self.haloNumber[t_index] == haloNumbers[i]
 			if any(haloMatch):
 				if self.mode == 'threshold':
@@ -59,8 +80,9 @@ class ProximityCalculator(object):
 		usedNumbers2 = haloNumbers2[np.in1d(times2, times1)]
 
 		output = np.zeros(len(usedtimes))
+		timeIndices = self.timeIndex.nearest(usedtimes)
 		for i in range(len(usedtimes)):
-			t_index = np.argmin(np.abs(self.time - usedtimes[i]))
+			t_index = timeIndices[i]
 			haloMatch1 = self.haloNumber[t_index] == usedNumbers1[i]
 			haloMatch2 = self.haloNumber[t_index] == usedNumbers2[i]
 			if (any(haloMatch1) & any(haloMatch2)):
@@ -78,8 +100,9 @@ class ProximityCalculator(object):
                 assert len(haloNumbers) == len(times)
 
                 output = np.zeros(len(haloNumbers))
+                timeIndices = self.timeIndex.nearest(times)
                 for i in range(len(haloNumbers)):
-                        t_index = np.argmin(np.abs(self.time - times[i]))
+                        t_index = timeIndices[i]
                         haloMatch = self.haloNumber[t_index] == haloNumbers[i]
                         if any(haloMatch):
 				output[i] = self.distanceMatrix[t_index][haloMatch,0]
@@ -92,8 +115,9 @@ class ProximityCalculator(object):
                 assert len(haloNumbers) == len(times)
 
                 output = np.zeros(len(haloNumbers))
+                timeIndices = self.timeIndex.nearest(times)
                 for i in range(len(haloNumbers)):
-                        t_index = np.argmin(np.abs(self.time - times[i]))
+                        t_index = timeIndices[i]
                         haloMatch = self.haloNumber[t_index] == haloNumbers[i]
                         if any(haloMatch):
 				output[i] = self.Rvir[t_index][haloMatch]
@@ -0,0 +1,53 @@
+""" A small on-disk cache for quantities that are slow to compute from the database but never change
+for a given simulation and timestep.
+"""
+import os
+import cPickle as pickle
+
+defaultCacheDirectory = os.path.join(os.path.expanduser('~'), '.historyMaker_cache')
+
+def cachePath(category, simulationName, stepName=None, cacheDirectory=None):
+	"""
+	The name of the cache file of something computed for a simulation, or for one of its timesteps.
+
+	:arg category - what is cached, e.g. 'clusterProfile'
+	:arg simulationName - the basename of the simulation
+
+	:kwarg stepName - the extension of the timestep, if the cached quantity depends on it
+	:kwarg cacheDirectory - where cache files go.  Default is defaultCacheDirectory.
+	"""
+
+	if cacheDirectory is None:
+		cacheDirectory = defaultCacheDirectory
+	parts = [category, simulationName]
+	if stepName is not None:
+		parts.append(stepName)
+	fileName = '_'.join([str(part).replace('/', '%') for part in parts]) + '.pkl'
+	return os.path.join(cacheDirectory, fileName)
+
+def loadCache(path):
+	"""
+	Read a cache file.  Returns None if it does not exist or cannot be read.
+	"""
+
+	if not os.path.exists(path):
+		return None
+	try:
+		with open(path, 'rb') as myfile:
+			return pickle.load(myfile)
+	except (IOError, EOFError, pickle.UnpicklingError):
+		return None
+
+def saveCache(path, value):
+	"""
+	Write a cache file, creating its directory if needed.  The file is written under a temporary name first so that
+	a partly written file is never read.
+	"""
+
+	directory = os.path.dirname(path)
+	if (directory != '') and (not os.path.isdir(directory)):
+		os.makedirs(directory)
+	temporaryPath = path + '.tmp{0}'.format(os.getpid())
+	with open(temporaryPath, 'wb') as myfile:
+		pickle.dump(value, myfile, protocol=pickle.HIGHEST_PROTOCOL)
+	os.rename(temporaryPath, path)
@@ -0,0 +1,61 @@
+""" Run a function over a sequence in a background thread, keeping a bounded number of results
+ready ahead of the consumer.
+"""
+import sys
+import threading
+import Queue
+
+_finished = object()
+
+def prefetch(function, items, depth=2):
+	"""
+	Generator yielding function(item) for each item, in order.  The calls are made in a single
+	background thread that runs at most depth results ahead of the caller, so memory stays capped.
+
+	Exceptions raised by function are re-raised in the caller when their result is reached.
+
+	:arg function - called once per item
+	:arg items - iterable of arguments for function
+
+	:kwarg depth - the maximum number of finished results waiting to be consumed
+	"""
+
+	resultQueue = Queue.Queue(maxsize=max(int(depth), 1))
+	stopRequested = threading.Event()
+
+	def _put(entry):
+		#Give up if the consumer has gone away, rather than blocking forever.
+		while not stopRequested.is_set():
+			try:
+				resultQueue.put(entry, timeout=0.1)
+				return True
+			except Queue.Full:
+				continue
+		return False
+
+	def _producer():
+		try:
+			for item in items:
+				try:
+					entry = (True, function(item))
+				except Exception:
+					entry = (False, sys.exc_info())
+				if not _put(entry):
+					return
+		finally:
+			_put((True, _finished))
+
+	worker = threading.Thread(target=_producer)
+	worker.daemon = True
+	worker.start()
+
+	try:
+		while True:
+			succeeded, result = resultQueue.get()
+			if result is _finished:
+				break
+			if not succeeded:
+				raise result[0], result[1], result[2]
+			yield result
+	finally:
+		stopRequested.set()